@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+import os
+import json
+import queue
+import atexit
+import sqlite3
+import logging
+import argparse
+import threading
+from glob import glob
+from contextlib import closing
+from pathlib import Path
+from datetime import datetime
+from multiprocessing.util import Finalize
+
+from utils import get_config, date_from_filename, json_encoder, get_file_paths, write_activity_log, save_activity_log
+
+__all__ = ['JsonActivityStore', 'SqliteActivityStore', 'get_activity_store', 'get_upstream_activity_logs']
+
+
+def get_activity_date(activity_id):
+	'''Return the date of an activity from its id, or None if the id does not contain a date'''
+	try:
+		return date_from_filename(activity_id)
+	except ValueError:
+		return None
+
+
+def get_activity_files(activity_info):
+	'''Return the input and output files of an activity'''
+	# The activity logs written before the lineage was recorded only have the function output
+	if 'function_outputs' in activity_info:
+		return activity_info['function_inputs'], activity_info['function_outputs']
+	else:
+		return list(), get_file_paths(activity_info['function_output'])
+
+
+class JsonActivityStore:
+	'''Store each activity log in a separate JSON file named after the activity id
+	The lineage of the files is appended to a JSON lines index file, to find the activity that generated a file without reading all the activity logs'''
+	
+	LINEAGE_FILENAME = 'lineage.jsonl'
+	
+	def __init__(self, output_directory):
+		self.output_directory = Path(output_directory)
+		self.lineage = None
+	
+	def add(self, activity_info):
+		write_activity_log(activity_info, self.output_directory)
+		
+		inputs, outputs = get_activity_files(activity_info)
+		line = json.dumps({'activity_id': activity_info['activity_id'], 'inputs': inputs, 'outputs': outputs}) + '\n'
+		
+		# A single write in append mode, so that the lines of concurrent processes are not mixed
+		with open(self.output_directory / self.LINEAGE_FILENAME, 'at') as file:
+			file.write(line)
+		
+		if self.lineage is not None:
+			self.index_lineage(activity_info['activity_id'], outputs)
+	
+	def index_lineage(self, activity_id, outputs):
+		for output in outputs:
+			activity_ids = self.lineage.setdefault(output, list())
+			if activity_id not in activity_ids:
+				activity_ids.append(activity_id)
+	
+	def load_lineage(self):
+		'''Read the lineage index file'''
+		self.lineage = dict()
+		try:
+			with open(self.output_directory / self.LINEAGE_FILENAME, 'rt') as file:
+				for line in file:
+					entry = json.loads(line)
+					self.index_lineage(entry['activity_id'], entry['outputs'])
+		except FileNotFoundError:
+			logging.warning('Lineage index file %s does not exist', self.output_directory / self.LINEAGE_FILENAME)
+	
+	def get(self, activity_id):
+		'''Return the activity log with the specified id'''
+		with open(self.output_directory / (activity_id + '.json'), 'rt') as file:
+			return json.load(file)
+	
+	def find(self, function_name = None, start_date = None, end_date = None):
+		'''Return the activity logs of a function, with a date between start date (inclusive) and end date (exclusive)'''
+		for filepath in sorted(glob(str(self.output_directory / ('%s.*.json' % (function_name or '*'))))):
+			date = get_activity_date(Path(filepath).stem)
+			if (start_date and (date is None or date < start_date)) or (end_date and (date is None or date >= end_date)):
+				continue
+			with open(filepath, 'rt') as file:
+				yield json.load(file)
+	
+	def find_by_output(self, path):
+		'''Return the activity logs that have the path in their output'''
+		if self.lineage is None:
+			self.load_lineage()
+		
+		for activity_id in self.lineage.get(os.path.abspath(path), []):
+			yield self.get(activity_id)
+	
+	def flush(self):
+		pass
+	
+	def close(self):
+		pass
+
+
+class SqliteActivityStore:
+	'''Append the activity logs to a single SQLite database, indexed by activity id, function name, date and output path
+	The records are written by a background thread, so that the decorated functions do not wait on the database'''
+	
+	SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS activity (
+			activity_id TEXT PRIMARY KEY,
+			function_name TEXT NOT NULL,
+			date TEXT,
+			record TEXT NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS activity_function_name_date ON activity (function_name, date);
+		CREATE INDEX IF NOT EXISTS activity_date ON activity (date);
+		CREATE TABLE IF NOT EXISTS output (
+			path TEXT NOT NULL,
+			activity_id TEXT NOT NULL,
+			PRIMARY KEY (path, activity_id)
+		);
+		CREATE INDEX IF NOT EXISTS output_activity_id ON output (activity_id);
+		CREATE TABLE IF NOT EXISTS input (
+			path TEXT NOT NULL,
+			activity_id TEXT NOT NULL,
+			PRIMARY KEY (path, activity_id)
+		);
+		CREATE INDEX IF NOT EXISTS input_activity_id ON input (activity_id);
+	'''
+	
+	# Maximum number of records written in a single transaction
+	BATCH_SIZE = 1000
+	
+	# Time in seconds to wait for the database to be unlocked by another process
+	TIMEOUT = 60
+	
+	def __init__(self, filepath):
+		self.filepath = Path(filepath)
+		self.filepath.parent.mkdir(parents = True, exist_ok = True)
+		
+		with closing(self.connect()) as connection:
+			# The write-ahead log allows the worker processes to append records while the database is read
+			connection.execute('PRAGMA journal_mode = WAL')
+			connection.executescript(self.SCHEMA)
+		
+		self.queue = queue.Queue()
+		self.writer = threading.Thread(target = self.write_records, name = 'activity store writer', daemon = True)
+		self.writer.start()
+		
+		# Make sure the pending records are written when the process exits, atexit is not called in multiprocessing workers
+		self.finalizer = Finalize(self, self.close, exitpriority = 10)
+		atexit.register(self.close)
+	
+	def connect(self):
+		return sqlite3.connect(self.filepath, timeout = self.TIMEOUT)
+	
+	def add(self, activity_info):
+		'''Queue an activity log to be written to the database'''
+		# The record is serialized immediately, in case the call arguments are modified after the call
+		record = json.dumps(activity_info, default = json_encoder)
+		date = get_activity_date(activity_info['activity_id'])
+		inputs, outputs = get_activity_files(activity_info)
+		self.queue.put((
+			activity_info['activity_id'],
+			activity_info['function_name'],
+			date.isoformat() if date else None,
+			record,
+			inputs,
+			outputs
+		))
+	
+	def write_records(self):
+		'''Write the queued records to the database, in batches'''
+		connection = self.connect()
+		stop = False
+		
+		while not stop:
+			batch = [self.queue.get()]
+			while len(batch) < self.BATCH_SIZE:
+				try:
+					batch.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			
+			# None is the signal to stop the writer
+			stop = None in batch
+			records = [record for record in batch if record is not None]
+			
+			try:
+				with connection:
+					for activity_id, function_name, date, record, inputs, outputs in records:
+						# An activity that is run again replaces the previous record, like the JSON file would be overwritten
+						connection.execute('INSERT OR REPLACE INTO activity (activity_id, function_name, date, record) VALUES (?, ?, ?, ?)', (activity_id, function_name, date, record))
+						connection.execute('DELETE FROM input WHERE activity_id = ?', (activity_id, ))
+						connection.execute('DELETE FROM output WHERE activity_id = ?', (activity_id, ))
+						connection.executemany('INSERT OR IGNORE INTO input (path, activity_id) VALUES (?, ?)', [(path, activity_id) for path in inputs])
+						connection.executemany('INSERT OR IGNORE INTO output (path, activity_id) VALUES (?, ?)', [(path, activity_id) for path in outputs])
+			except Exception as why:
+				logging.exception('Could not write %s activity logs to database %s: %s', len(records), self.filepath, why)
+			finally:
+				for record in batch:
+					self.queue.task_done()
+		
+		connection.close()
+	
+	def flush(self):
+		'''Wait for all the queued records to be written'''
+		if self.writer.is_alive():
+			self.queue.join()
+	
+	def close(self):
+		'''Write the queued records and stop the writer'''
+		if self.writer.is_alive():
+			self.queue.put(None)
+			self.writer.join()
+	
+	def get(self, activity_id):
+		'''Return the activity log with the specified id'''
+		self.flush()
+		with closing(self.connect()) as connection:
+			row = connection.execute('SELECT record FROM activity WHERE activity_id = ?', (activity_id, )).fetchone()
+		if row is None:
+			raise KeyError('No activity log with id %s in database %s' % (activity_id, self.filepath))
+		return json.loads(row[0])
+	
+	def find(self, function_name = None, start_date = None, end_date = None):
+		'''Return the activity logs of a function, with a date between start date (inclusive) and end date (exclusive)'''
+		self.flush()
+		
+		conditions = list()
+		parameters = list()
+		if function_name:
+			conditions.append('function_name = ?')
+			parameters.append(function_name)
+		if start_date:
+			conditions.append('date >= ?')
+			parameters.append(start_date.isoformat())
+		if end_date:
+			conditions.append('date < ?')
+			parameters.append(end_date.isoformat())
+		
+		query = 'SELECT record FROM activity %s ORDER BY activity_id' % ('WHERE ' + ' AND '.join(conditions) if conditions else '')
+		
+		with closing(self.connect()) as connection:
+			for row in connection.execute(query, parameters):
+				yield json.loads(row[0])
+	
+	def find_by_output(self, path):
+		'''Return the activity logs that have the path in their output'''
+		self.flush()
+		with closing(self.connect()) as connection:
+			for row in connection.execute('SELECT activity.record FROM output JOIN activity USING (activity_id) WHERE output.path = ? ORDER BY activity_id', (os.path.abspath(path), )):
+				yield json.loads(row[0])
+
+
+def get_upstream_activity_logs(store, path):
+	'''Return the activity logs of the activity that generated a file, and recursively of the activities that generated its inputs'''
+	
+	activity_logs = dict()
+	paths = [path]
+	visited_paths = set()
+	
+	while paths:
+		path = paths.pop()
+		if path in visited_paths:
+			continue
+		visited_paths.add(path)
+		
+		for activity_info in store.find_by_output(path):
+			if activity_info['activity_id'] not in activity_logs:
+				activity_logs[activity_info['activity_id']] = activity_info
+				paths.extend(get_activity_files(activity_info)[0])
+	
+	# The upstream activities first
+	return list(reversed(activity_logs.values()))
+
+
+def get_activity_store(config):
+	'''Return the activity store specified in the LOGGING section of the config, and setup the profiling of the activities'''
+	
+	# The profiling is setup with the store, so that it can be enabled in the config of any script
+	save_activity_log.profile_rate = float(config.get('profile_rate', 0) or 0)
+	save_activity_log.profile_directory = config.get('profile_directory') or save_activity_log.profile_directory
+	
+	store = config.get('store', 'json')
+	if store == 'json':
+		return JsonActivityStore(config.get('output_directory'))
+	elif store == 'sqlite':
+		return SqliteActivityStore(config.get('database_file'))
+	else:
+		raise ValueError('Unknown activity store %s' % store)
+
+
+# Start point of the script
+
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Export the activity logs of the SQLite activity store to JSON files, or import JSON activity log files into it')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	parser.add_argument('--function-name', '-f', help = 'Only export the activity logs of that function')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Only export the activity logs from that date (inclusive)')
+	parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'Only export the activity logs until that date (exclusive)')
+	group = parser.add_mutually_exclusive_group(required = True)
+	group.add_argument('--export-directory', metavar = 'DIRPATH', help = 'Directory where to write one JSON file per activity log')
+	group.add_argument('--import-files', metavar = 'FILEPATH', nargs = '+', help = 'The JSON activity log files to import')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	store = SqliteActivityStore(config.get('LOGGING', 'database_file'))
+	
+	if args.export_directory:
+		count = 0
+		for activity_info in store.find(args.function_name, args.start_date, args.end_date):
+			write_activity_log(activity_info, args.export_directory)
+			count += 1
+		logging.info('Exported %s activity logs to directory %s', count, args.export_directory)
+	else:
+		for filepath in args.import_files:
+			try:
+				with open(filepath, 'rt') as file:
+					store.add(json.load(file))
+			except Exception as why:
+				logging.exception('Could not import activity log file %s: %s', filepath, why)
+		store.close()
+		logging.info('Imported %s activity log files to database %s', len(args.import_files), store.filepath)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import sys
+import time
+import math
+import logging
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from synthetic_data import SyntheticCoronalHoles, write_region_maps
+from get_epn_core_tap_parameters import get_epn_core_tap_parameters_from_file
+from get_tracking_tap_parameters import get_tracking_tap_parameters_from_file
+from get_longlived_regions_colors import get_longlived_regions_colors
+from utils import get_config, append_benchmark_results, check_benchmark_threshold
+
+__all__ = ['benchmark', 'get_benchmarks']
+
+SCRIPTS_DIRECTORY = Path(__file__).absolute().parent
+
+
+def benchmark(function, *args, rounds = 10, warmup_rounds = 1):
+	'''Call a function several times and return the statistics of the time of the calls in seconds, like pytest-benchmark'''
+	
+	for round in range(warmup_rounds):
+		function(*args)
+	
+	times = list()
+	for round in range(rounds):
+		start = time.perf_counter()
+		function(*args)
+		times.append(time.perf_counter() - start)
+	
+	return {
+		'min': min(times),
+		'max': max(times),
+		'mean': statistics.mean(times),
+		'stddev': statistics.stdev(times) if len(times) > 1 else 0.,
+		'median': statistics.median(times),
+		'rounds': rounds,
+	}
+
+
+def get_benchmarks(region_maps, config):
+	'''Return the functions to benchmark with their arguments, for a list of tracked region maps'''
+	
+	# The extractors are benchmarked on a single map, from the middle of the list so that it has tracking relations
+	region_map = region_maps[len(region_maps) // 2]
+	
+	return {
+		'get_epn_core_tap_parameters_from_file': (get_epn_core_tap_parameters_from_file, region_map, region_map, None, None, None, config['TAP_PARAMETERS']),
+		'get_tracking_tap_parameters_from_file': (get_tracking_tap_parameters_from_file, region_map, None),
+		# The lifespan computation without the activity log, that would measure the activity store instead
+		'get_longlived_regions_colors': (get_longlived_regions_colors.__wrapped__, region_maps, config['LIFESPAN_CLEANING']),
+	}
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Measure the time of the TAP parameters extractors and of the lifespan computation on synthetic tracked region maps, for several numbers of regions per map')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', default = SCRIPTS_DIRECTORY.parent / 'configs' / 'rob_spoca_ch.ini', help = 'Path to the config file of the script (default is configs/rob_spoca_ch.ini)')
+	parser.add_argument('--output', '-o', metavar = 'FILEPATH', help = 'The file path for the output JSON file, results are appended to it to track the extraction time over time')
+	parser.add_argument('--threshold', '-t', type = float, metavar = 'MILLISECONDS', help = 'Exit with an error if the mean time of a benchmark per region is larger than the threshold')
+	parser.add_argument('--regions', type = int, nargs = '+', default = [10, 100, 1000], help = 'Mean numbers of regions per map to benchmark (default is 10 100 1000)')
+	parser.add_argument('--count', '-n', type = int, default = 20, help = 'Number of maps for the lifespan computation (default is 20)')
+	parser.add_argument('--rounds', '-r', type = int, default = 10, help = 'Number of measured calls of each benchmark (default is 10)')
+	parser.add_argument('--size', type = int, default = 1024, help = 'Size in pixels of the synthetic maps (default is 1024)')
+	parser.add_argument('--seed', type = int, default = 0, help = 'Seed of the synthetic regions (default is 0)')
+	parser.add_argument('--benchmark', '-b', action = 'append', help = 'Name of a benchmark to run (default is all)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	results = dict()
+	times = dict()
+	
+	with tempfile.TemporaryDirectory() as output_directory:
+		
+		for regions in args.regions:
+			
+			# The regions are smaller when there are more of them, so that they do not all overlap
+			coronal_holes = SyntheticCoronalHoles(seed = args.seed, regions_per_map = regions, max_radius = min(10, 60 / math.sqrt(regions)))
+			
+			logging.info('Writing %s synthetic maps with %s regions per map', args.count, regions)
+			region_maps = write_region_maps(Path(output_directory) / str(regions), datetime(2012, 1, 1), args.count, timedelta(hours = 6), coronal_holes, args.size, args.seed)
+			
+			results[regions] = dict()
+			for name, (function, *function_args) in get_benchmarks(region_maps, config).items():
+				if args.benchmark and name not in args.benchmark:
+					continue
+				
+				try:
+					stats = benchmark(function, *function_args, rounds = args.rounds)
+				except Exception as why:
+					logging.error('Could not run benchmark %s with %s regions: %s', name, regions, why)
+					continue
+				
+				results[regions][name] = stats
+				logging.info('%-40s %5s regions: min %8.2f ms, mean %8.2f ms, stddev %8.2f ms', name, regions, stats['min'] * 1000, stats['mean'] * 1000, stats['stddev'] * 1000)
+				
+				times['%s with %s regions' % (name, regions)] = stats['mean'] * 1000 / regions
+	
+	if args.output:
+		append_benchmark_results(args.output, {'size': args.size, 'count': args.count, 'benchmarks': results})
+	
+	if check_benchmark_threshold(times, args.threshold, 'The mean time per region in ms of benchmarks'):
+		sys.exit(1)
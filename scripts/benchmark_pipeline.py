@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import shlex
+import logging
+import argparse
+import tempfile
+import subprocess
+import configparser
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from synthetic_data import write_sdo_image
+from utils import date_range, append_benchmark_results, check_benchmark_threshold
+
+__all__ = ['create_benchmark_tree', 'run_benchmark']
+
+SCRIPTS_DIRECTORY = Path(__file__).absolute().parent
+
+# The SPoCA program executed in each section of the config, replaced by the stub
+PROGRAMS = {
+	'GET_CLASS_CENTERS': 'ch_classification',
+	'GET_SEGMENTATION_MAP': 'ch_attribution',
+	'GET_REGION_MAP': 'get_ch_map',
+	'GET_TRACKED_MAP': 'tracking',
+	'GET_OVERLAY_IMAGE': 'overlay',
+}
+
+
+def write_stub_executables(bin_directory, loads, stub_options):
+	'''Write an executable shell script for each SPoCA program, that executes the stub with the load of the program'''
+	bin_directory.mkdir(parents = True, exist_ok = True)
+	executables = dict()
+	for section, program in PROGRAMS.items():
+		sleep, cpu = loads[program]
+		executable = executables[section] = bin_directory / (program + '.x')
+		with open(executable, 'wt') as file:
+			file.write('#!/bin/sh\nexec %s %s %s --stub-sleep %s --stub-cpu %s %s "$@"\n' % (shlex.quote(sys.executable), shlex.quote(str(SCRIPTS_DIRECTORY / 'stub_spoca.py')), program, sleep, cpu, ' '.join(shlex.quote(str(option)) for option in stub_options)))
+		executable.chmod(0o755)
+	return executables
+
+
+def create_benchmark_tree(work_directory, config_file, start_date, end_date, interval, loads, stub_options, process_count = 0, thread_count = 0, overlay_engine = None):
+	'''Create the input SDO files, the stub SPoCA programs and the config file to run the pipeline between start date and end date, and return the path to the config file'''
+	
+	work_directory = Path(work_directory)
+	executables = write_stub_executables(work_directory / 'bin', loads, stub_options)
+	
+	# The config is rewritten without interpolation, so that the placeholders of the other values are kept as is
+	config = configparser.ConfigParser(interpolation = None)
+	config.read(config_file)
+	
+	config['DEFAULT']['OUTPUT'] = str(work_directory / 'output')
+	config['DEFAULT']['SPOCA_CONFIG'] = str(SCRIPTS_DIRECTORY.parent / 'configs')
+	for section, executable in executables.items():
+		config[section]['executable'] = str(executable)
+	
+	config['AIA_DATA']['file_pattern'] = str(work_directory / 'aia' / '{wavelength:04d}' / '{date:%%Y/%%m/%%d}' / 'aia.{wavelength:04d}.{date:%%Y%%m%%d_%%H%%M%%S}.fits')
+	config['HMI_DATA']['file_pattern'] = str(work_directory / 'hmi' / '{date:%%Y/%%m/%%d}' / 'hmi.magnetogram.{date:%%Y%%m%%d_%%H%%M%%S}.fits')
+	config['TAP_PARAMETERS']['aia_image_base_dir'] = str(work_directory / 'aia')
+	config['TAP_PARAMETERS']['hmi_image_base_dir'] = str(work_directory / 'hmi')
+	config['EXECUTOR']['process_count'] = str(process_count)
+	config['EXECUTOR']['thread_count'] = str(thread_count)
+	if overlay_engine:
+		config['GET_OVERLAY_IMAGE']['engine'] = overlay_engine
+	
+	benchmark_config_file = work_directory / 'benchmark.ini'
+	with open(benchmark_config_file, 'wt') as file:
+		config.write(file)
+	
+	# The stubs do not read the content of the SDO files, so all the dates are links to a single file of each instrument
+	wavelengths = set(map(int, config['GET_SEGMENTATION_MAP']['aia_wavelengths'].split(','))) | {int(config['GET_REGION_MAP']['aia_wavelength']), int(config['GET_OVERLAY_IMAGE']['aia_wavelength'])}
+	aia_template = write_sdo_image(work_directory / 'aia_template.fits', start_date, 'AIA')
+	hmi_template = write_sdo_image(work_directory / 'hmi_template.fits', start_date, 'HMI')
+	
+	for date in date_range(start_date, end_date, timedelta(hours = interval)):
+		filepaths = [(aia_template, config['AIA_DATA']['file_pattern'].replace('%%', '%').format(date = date, wavelength = wavelength)) for wavelength in wavelengths]
+		filepaths.append((hmi_template, config['HMI_DATA']['file_pattern'].replace('%%', '%').format(date = date)))
+		for template, filepath in filepaths:
+			Path(filepath).parent.mkdir(parents = True, exist_ok = True)
+			os.symlink(template, filepath)
+	
+	# The segmentation uses the median class centers, computed beforehand in production
+	output_directory = work_directory / 'output'
+	output_directory.mkdir(parents = True, exist_ok = True)
+	subprocess.run([str(executables['GET_CLASS_CENTERS']), '--centersFile', str(output_directory / 'median_class_centers.txt'), str(aia_template)], check = True)
+	
+	return benchmark_config_file
+
+
+def run_benchmark(work_directory, config_file, start_date, end_date, interval):
+	'''Run the pipeline in the benchmark tree, and return the wall time of the run and the metrics of each stage'''
+	
+	work_directory = Path(work_directory)
+	metrics_file = work_directory / 'metrics.json'
+	
+	command = [
+		sys.executable, str(SCRIPTS_DIRECTORY / 'rob_spoca_ch_pipeline.py'),
+		'--verbose', 'ERROR',
+		'--config-file', str(config_file),
+		'--start-date', start_date.isoformat(),
+		'--end-date', end_date.isoformat(),
+		'--interval', str(interval),
+		'--regions-colors', str(work_directory / 'longlived_regions_colors.txt'),
+		'--metrics-file', str(metrics_file),
+	]
+	
+	start = time.perf_counter()
+	process = subprocess.run(command, cwd = work_directory, stderr = subprocess.PIPE, text = True)
+	wall_time = time.perf_counter() - start
+	
+	if process.returncode != 0:
+		raise RuntimeError('Pipeline failed with return code %s: %s' % (process.returncode, process.stderr[-2000:]))
+	
+	if process.stderr:
+		logging.warning('Pipeline errors: %s', process.stderr[-2000:])
+	
+	with open(metrics_file, 'rt') as file:
+		return wall_time, json.load(file)
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Measure the orchestration overhead of the pipeline over several simulated years, with stubs of the SPoCA programs that simulate their load and write small synthetic outputs')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', default = SCRIPTS_DIRECTORY.parent / 'configs' / 'rob_spoca_ch.ini', help = 'Path to the config file of the pipeline to benchmark (default is configs/rob_spoca_ch.ini)')
+	parser.add_argument('--output', '-o', metavar = 'FILEPATH', help = 'The file path for the output JSON file, results are appended to it to track the performance over time')
+	parser.add_argument('--threshold', '-t', type = float, metavar = 'SECONDS', help = 'Exit with an error if the wall time of the pipeline per simulated year is larger than the threshold')
+	parser.add_argument('--years', '-y', type = int, nargs = '+', default = [1, 5, 13], help = 'Number of years to simulate for each run (default is 1 5 13)')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, default = datetime(2012, 1, 1), help = 'Start date of the simulated years (default is 2012-01-01)')
+	parser.add_argument('--interval', '-i', type = int, default = 6, help = 'Number of hours between two maps (default is 6)')
+	parser.add_argument('--sleep', type = float, default = 0.05, help = 'Number of seconds each SPoCA program waits, like waiting for I/O (default is 0.05)')
+	parser.add_argument('--cpu', type = float, default = 0.05, help = 'Number of seconds of CPU each SPoCA program uses (default is 0.05)')
+	parser.add_argument('--load', metavar = ('PROGRAM', 'SLEEP', 'CPU'), nargs = 3, action = 'append', default = [], help = 'The sleep and CPU seconds of a SPoCA program, instead of --sleep and --cpu')
+	parser.add_argument('--size', type = int, default = 256, help = 'Size in pixels of the synthetic maps (default is 256)')
+	parser.add_argument('--regions', type = int, default = 10, help = 'Mean number of regions on a synthetic map (default is 10)')
+	parser.add_argument('--process-count', type = int, default = 0, help = 'Number of worker processes of the pipeline (0 means the number of CPUs)')
+	parser.add_argument('--thread-count', type = int, default = 0, help = 'Number of worker threads of the pipeline (0 means the number of CPUs)')
+	parser.add_argument('--overlay-engine', choices = ['spoca', 'python'], help = 'Engine to create the overlay images (default is the engine of the config)')
+	parser.add_argument('--work-directory', '-w', metavar = 'DIRPATH', help = 'Directory where to create the benchmark trees and keep them, instead of a temporary directory')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	loads = {program: (args.sleep, args.cpu) for program in PROGRAMS.values()}
+	for program, sleep, cpu in args.load:
+		if program not in loads:
+			parser.error('Unknown SPoCA program %s, must be one of %s' % (program, ', '.join(loads)))
+		loads[program] = (float(sleep), float(cpu))
+	
+	stub_options = ['--stub-size', args.size, '--stub-regions', args.regions, '--stub-interval', args.interval]
+	
+	results = dict()
+	
+	with tempfile.TemporaryDirectory(prefix = 'benchmark_pipeline_') as temporary_directory:
+		
+		for years in args.years:
+			work_directory = Path(args.work_directory or temporary_directory) / ('%s_years' % years)
+			end_date = args.start_date.replace(year = args.start_date.year + years)
+			
+			logging.info('Creating benchmark tree for %s years in %s', years, work_directory)
+			config_file = create_benchmark_tree(work_directory, args.config_file, args.start_date, end_date, args.interval, loads, stub_options, args.process_count, args.thread_count, args.overlay_engine)
+			
+			try:
+				wall_time, metrics = run_benchmark(work_directory, config_file, args.start_date, end_date, args.interval)
+			except Exception as why:
+				logging.error('Could not run the pipeline for %s years: %s', years, why)
+				continue
+			
+			results[years] = {'wall_time': wall_time, 'parent_peak_memory': metrics['parent_peak_memory'], 'stages': metrics['stages']}
+			
+			logging.info('Pipeline for %s years ran in %.1f s, with a peak memory of %.1f MB', years, wall_time, metrics['parent_peak_memory'] / 2**20)
+			for stage, stage_metrics in metrics['stages'].items():
+				logging.info('Stage %-28s wall %8.1f s, idle %8.1f s, parent cpu %8.1f s, parent memory %8.1f MB', stage, stage_metrics['wall_time'], stage_metrics['idle_time'], stage_metrics['parent_cpu_time'], (stage_metrics['parent_memory'] or 0) / 2**20)
+	
+	if args.output:
+		append_benchmark_results(args.output, {'loads': loads, 'size': args.size, 'regions': args.regions, 'runs': results})
+	
+	if check_benchmark_threshold({'%s years' % years: result['wall_time'] / years for years, result in results.items()}, args.threshold, 'The wall time per simulated year in s of the runs for'):
+		sys.exit(1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import time
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+from datetime import datetime, timedelta
+from voprov.visualization.dot import prov_to_dot
+
+from rob_spoca_ch_provenance import get_provenance_document
+from provenance_preview import get_graph_layout, get_preview_dot, write_preview_images
+from utils import date_to_filename
+
+__all__ = ['get_synthetic_activity_logs']
+
+
+def get_synthetic_activity_logs(date):
+	'''Return activity logs like the ones written by the pipeline for the cleaned map of a date'''
+	name = date_to_filename(date)
+	segmentation_map = '/data/segmentation_map/%s.segmentation_map.fits' % name
+	ch_map = '/data/ch_map/%s.ch_map.fits' % name
+	cleaned_map = '/data/cleaned_ch_map/%s.cleaned_ch_map.fits' % name
+	aia_image = '/data/aia_science_level2/0193/aia_science_level2.0193.%s.fits' % name
+	hmi_image = '/data/hmi_science_level1_5/hmi_science_level1_5.magnetogram.%s.fits' % name
+	
+	return [
+		{
+			'activity_id': 'get_segmentation_map.%s' % name,
+			'function_name': 'get_segmentation_map',
+			'function_callargs': {'date': date.isoformat(), 'images': [aia_image], 'config': {'config_file': '/configs/ch_attribution.config', 'centers_file': '/data/class_centers/median_class_centers.txt'}},
+			'function_output': segmentation_map,
+		},
+		{
+			'activity_id': 'get_region_map.%s' % name,
+			'function_name': 'get_region_map',
+			'function_callargs': {'date': date.isoformat(), 'segmentation_map': segmentation_map, 'stat_images': {'aia_image': aia_image, 'hmi_image': hmi_image}, 'config': {'config_file': '/configs/get_ch_map.config'}},
+			'function_output': ch_map,
+		},
+		{
+			'activity_id': 'get_tracked_map.%s-%s' % (name, name),
+			'function_name': 'get_tracked_map',
+			'function_callargs': {'tracked_maps': [], 'untracked_maps': [ch_map], 'config': {'config_file': '/configs/tracking.config'}},
+			'function_output': None,
+		},
+		{
+			'activity_id': 'get_cleaned_map.%s' % name,
+			'function_name': 'get_cleaned_map',
+			'function_callargs': {'date': date.isoformat(), 'region_map': ch_map, 'longlived_regions_colors': [1, 2, 3], 'config': {}},
+			'function_output': cleaned_map,
+		},
+	]
+
+
+def benchmark(function, provenance_documents, output_directory, extension):
+	'''Return the time in seconds to write the preview of all the provenance documents'''
+	start = time.perf_counter()
+	function({output_directory / ('%06d.%s' % (i, extension)): prov_doc for i, prov_doc in enumerate(provenance_documents)})
+	return time.perf_counter() - start
+
+
+def write_graphviz_previews(provenance_documents):
+	'''Write the previews like before, with a Graphviz layout and a Graphviz process for each document'''
+	for filepath, prov_doc in provenance_documents.items():
+		prov_to_dot(prov_doc, use_labels = True, direction = 'LR').write_png(str(filepath))
+
+
+def write_cached_layout_previews(provenance_documents):
+	'''Write the previews with the cached layout, drawn by batch'''
+	write_preview_images({filepath: get_preview_dot(prov_doc) for filepath, prov_doc in provenance_documents.items()})
+
+
+# Start point of the script
+
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Measure the time to write the preview images of provenance documents, with a Graphviz layout per document and with the cached layout')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--count', '-n', type = int, default = 1000, help = 'Number of provenance documents (default is 1000)')
+	parser.add_argument('--graphviz-count', type = int, default = 50, help = 'Number of provenance documents to render with a Graphviz layout per document, the time is extrapolated to the total count (default is 50)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	logging.info('Creating %s provenance documents', args.count)
+	start_date = datetime(2024, 1, 1)
+	provenance_documents = [get_provenance_document(get_synthetic_activity_logs(start_date + i * timedelta(hours = 6))) for i in range(args.count)]
+	
+	with tempfile.TemporaryDirectory() as output_directory:
+		output_directory = Path(output_directory)
+		
+		count = min(args.graphviz_count, args.count)
+		seconds = benchmark(write_graphviz_previews, provenance_documents[:count], output_directory, 'png')
+		logging.info('Graphviz layout per document: %.1f ms per document, %.1f s for %s documents (extrapolated)', seconds / count * 1000, seconds / count * args.count, args.count)
+		
+		for extension in ['svg', 'png']:
+			get_graph_layout.cache.clear()
+			seconds = benchmark(write_cached_layout_previews, provenance_documents, output_directory, extension)
+			logging.info('Cached layout, %s output: %.1f ms per document, %.1f s for %s documents (%s layouts computed)', extension, seconds / args.count * 1000, seconds, args.count, len(get_graph_layout.cache))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import re
+import sys
+import logging
+import argparse
+import subprocess
+from pathlib import Path
+
+from utils import append_benchmark_results, check_benchmark_threshold
+
+__all__ = ['get_startup_time']
+
+# The scripts that are run many times per map, and must start quickly
+DEFAULT_SCRIPTS = [
+	'get_segmentation_map.py',
+	'get_region_map.py',
+	'get_tracked_map.py',
+	'get_cleaned_map.py',
+	'get_overlay_image.py',
+	'get_epn_core_tap_parameters.py',
+	'get_tracking_tap_parameters.py',
+	'get_datalink_tap_parameters.py',
+	'sdo_data.py',
+]
+
+# Format of the lines written by python -X importtime
+IMPORT_TIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+
+def get_startup_time(script, python = sys.executable):
+	'''Run a script with --help under python -X importtime and return the total import time and the cumulative import time of each top level module'''
+	
+	process = subprocess.run([python, '-X', 'importtime', str(script), '--help'], stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+	
+	modules = dict()
+	errors = list()
+	for line in process.stderr.splitlines():
+		match = IMPORT_TIME_LINE.match(line)
+		if match is None:
+			errors.append(line)
+		# Only the top level imports, the nested ones are included in the cumulative time of their parent
+		elif len(match[3]) == 1:
+			modules[match[4]] = int(match[2]) / 1000
+	
+	if process.returncode != 0:
+		raise RuntimeError('Script %s failed with return code %s: %s' % (script, process.returncode, '\n'.join(errors[-5:])))
+	
+	return sum(modules.values()), modules
+
+
+# Start point of the script
+
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Measure the import time of the scripts at startup, with python -X importtime')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--output', '-o', metavar = 'FILEPATH', help = 'The file path for the output JSON file, results are appended to it to track the startup time over time')
+	parser.add_argument('--threshold', '-t', type = float, metavar = 'MILLISECONDS', help = 'Exit with an error if the import time of a script is larger than the threshold')
+	parser.add_argument('--top', type = int, default = 5, help = 'Number of slowest top level imports to show for each script (default is 5)')
+	parser.add_argument('scripts', nargs = '*', metavar = 'FILEPATH', help = 'The file paths of the scripts (default is the step scripts)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	scripts = args.scripts or [Path(__file__).parent / script for script in DEFAULT_SCRIPTS]
+	
+	results = dict()
+	
+	for script in scripts:
+		try:
+			total, modules = get_startup_time(script)
+		except Exception as why:
+			logging.error('Could not measure the import time of script %s: %s', script, why)
+			continue
+		
+		results[Path(script).name] = {'total': total, 'modules': modules}
+		slowest = sorted(modules.items(), key = lambda item: item[1], reverse = True)[:args.top]
+		logging.info('Script %s imports in %.1f ms (slowest: %s)', script, total, ', '.join('%s %.1f ms' % item for item in slowest))
+	
+	if args.output:
+		append_benchmark_results(args.output, {'scripts': results})
+	
+	if check_benchmark_threshold({script: result['total'] for script, result in results.items()}, args.threshold, 'The import time in ms of scripts'):
+		sys.exit(1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import sys
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+import numpy
+
+from job import Job, JobError
+from overlay_image import create_overlay_image, read_image, write_image
+from utils import get_config
+
+__all__ = ['get_spoca_overlay_image', 'compare_overlay_images']
+
+
+def get_spoca_overlay_image(map, background_image, output_file, config):
+	'''Execute the SPoCA overlay program, like the spoca engine of get_overlay_image but without an activity log'''
+	
+	job = Job(
+		config.get('executable'),
+		positional_parameters = [map, background_image],
+		optional_parameters = {
+			'config' : config.get('config_file'),
+			'output': output_file
+		}
+	)
+	
+	exit_code, output, error = job.execute()
+	
+	if exit_code != 0 or not Path(output_file).is_file():
+		raise JobError(config.get('executable'), exit_code, output, error, map = map, background_image = background_image)
+	
+	return output_file
+
+
+def compare_overlay_images(spoca_image, python_image, pixel_threshold = 32):
+	'''Return the mean absolute difference of the pixel values of 2 overlay images, the fraction of pixels that differ by more than the threshold, and the image of the differences'''
+	
+	spoca_image = read_image(spoca_image).astype(numpy.int16)
+	python_image = read_image(python_image).astype(numpy.int16)
+	
+	if spoca_image.shape != python_image.shape:
+		raise ValueError('The overlay images have different sizes %s and %s' % (spoca_image.shape[1::-1], python_image.shape[1::-1]))
+	
+	difference = numpy.abs(spoca_image - python_image).max(axis = 2)
+	
+	return float(difference.mean()), float((difference > pixel_threshold).mean()), difference.astype(numpy.uint8)
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Create the overlay image of a region map with the SPoCA overlay program and with the python engine, and compare them')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	parser.add_argument('--spoca-image', metavar = 'FILEPATH', help = 'The path to an overlay image already created by the SPoCA overlay program, instead of executing it')
+	parser.add_argument('--diff-image', metavar = 'FILEPATH', help = 'Path to a PNG file to write the image of the differences')
+	parser.add_argument('--pixel-threshold', type = int, default = 32, help = 'Difference of value above which a pixel is counted as different (default is 32)')
+	parser.add_argument('--max-mean-difference', type = float, default = 10, help = 'Exit with an error if the mean absolute difference is above that value (default is 10)')
+	parser.add_argument('region_map', metavar = 'FILEPATH', help = 'The path to a region map')
+	parser.add_argument('background_image', metavar = 'FILEPATH', help = 'The path to an image FITS file for the background')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	with tempfile.TemporaryDirectory() as output_directory:
+		
+		spoca_image = args.spoca_image or get_spoca_overlay_image(args.region_map, args.background_image, Path(output_directory) / 'spoca.png', config['GET_OVERLAY_IMAGE'])
+		python_image = create_overlay_image(args.region_map, args.background_image, Path(output_directory) / 'python.png', config['GET_OVERLAY_IMAGE'])
+		
+		mean_difference, different_fraction, difference = compare_overlay_images(spoca_image, python_image, args.pixel_threshold)
+	
+	logging.info('Mean absolute difference: %.2f, pixels different by more than %s: %.2f%%', mean_difference, args.pixel_threshold, different_fraction * 100)
+	
+	if args.diff_image:
+		# The differences are amplified to be visible
+		write_image(args.diff_image, numpy.repeat((numpy.minimum(difference.astype(numpy.int16) * 4, 255)).astype(numpy.uint8)[..., numpy.newaxis], 3, axis = 2))
+		logging.info('Wrote image of the differences %s', args.diff_image)
+	
+	if mean_difference > args.max_mean_difference:
+		logging.error('The overlay images differ more than the maximum mean difference %s', args.max_mean_difference)
+		sys.exit(1)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy
+
+__all__ = ['Executor', 'SharedArray', 'set_worker_data', 'call_with_worker_data']
+
+# Read-only data shared by all the tasks of a stage, installed once in each worker process
+worker_data = dict()
+
+
+class SharedArray:
+	'''A 1 dimensional integer array in shared memory, sent to worker processes by name and attached only once per process'''
+	
+	# The arrays already attached in this process, by name
+	attached = dict()
+	
+	def __init__(self, name):
+		self.name = name
+		self.shared_memory = None
+	
+	def __getstate__(self):
+		# Only the name is sent to the worker processes
+		return {'name': self.name, 'shared_memory': None}
+	
+	def set(self, array):
+		'''Copy the array to the shared memory, must be called by the parent process before the workers use it'''
+		array = numpy.asarray(array, dtype = numpy.int64)
+		self.shared_memory = SharedMemory(name = self.name, create = True, size = (array.size + 1) * 8)
+		# The first value is the size of the array
+		buffer = numpy.ndarray((array.size + 1, ), dtype = numpy.int64, buffer = self.shared_memory.buf)
+		buffer[0] = array.size
+		buffer[1:] = array
+	
+	def get(self):
+		'''Return the array, attaching the shared memory the first time'''
+		try:
+			return self.attached[self.name][1]
+		except KeyError:
+			shared_memory = SharedMemory(name = self.name)
+			size = int(numpy.ndarray((1, ), dtype = numpy.int64, buffer = shared_memory.buf)[0])
+			array = numpy.ndarray((size, ), dtype = numpy.int64, buffer = shared_memory.buf, offset = 8)
+			array.flags.writeable = False
+			# Keep a reference to the shared memory, else the buffer is released
+			self.attached[self.name] = (shared_memory, array)
+			return array
+	
+	def unlink(self):
+		'''Release the shared memory, must be called by the parent process once the workers are done'''
+		if self.shared_memory is not None:
+			self.shared_memory.close()
+			self.shared_memory.unlink()
+			self.shared_memory = None
+
+
+def set_worker_data(data):
+	'''Pool initializer to install the read-only data of each stage in a worker process, so that it is not pickled again for every task'''
+	worker_data.clear()
+	worker_data.update(data)
+
+
+def call_with_worker_data(stage, function, *args):
+	'''Call a function with the task arguments and the worker data of the stage as keyword arguments'''
+	kwargs = dict()
+	for name, value in worker_data.get(stage, {}).items():
+		kwargs[name] = value.get() if isinstance(value, SharedArray) else value
+	return function(*args, **kwargs)
+
+
+def call_timed(function, *args):
+	'''Call a function and return its result, the time the call started and the time in seconds the call took, measured in the worker so that the time waiting in the queue is not included'''
+	# The start time is compared to the submit time in the parent process, so it must be the same clock in all processes
+	start = time.time()
+	result = function(*args)
+	return result, start, time.time() - start
+
+
+class Executor:
+	'''Long lived pools of worker processes and threads shared by all the stages of the pipeline, with a concurrency limit per stage'''
+	
+	# Modules imported once by the forkserver, so that the worker processes start with them already imported
+	PRELOAD_MODULES = ['__main__', 'numpy', 'pandas', 'astropy.io.fits', 'astropy.units', 'sunpy.map', 'sunpy.coordinates']
+	
+	# The statistics of the tasks of a stage, the queue wait includes the time waiting for the concurrency limit of the stage
+	STAGE_STATS = {'submitted': 0, 'running': 0, 'done': 0, 'failed': 0, 'busy_time': 0., 'queue_wait': 0., 'max_task_time': 0.}
+	
+	def __init__(self, process_count = None, thread_count = None, stage_limits = None, preload_modules = None, initializer = None, initargs = ()):
+		self.process_count = process_count or os.cpu_count()
+		self.thread_count = thread_count or os.cpu_count()
+		self.preload_modules = preload_modules if preload_modules is not None else self.PRELOAD_MODULES
+		self.initializer = initializer
+		self.initargs = initargs
+		
+		# The process pool and its forkserver are only started when the first task is submitted to the worker processes
+		self._process_pool = None
+		self.process_pool_lock = threading.Lock()
+		self.thread_pool = ThreadPoolExecutor(self.thread_count)
+		
+		# A limit of 0 or None means no limit other than the size of the pool
+		self.semaphores = {stage: threading.BoundedSemaphore(limit) for stage, limit in (stage_limits or {}).items() if limit}
+		
+		# The number of tasks and the time spent running them for each stage, to measure the utilisation of the workers
+		self.stage_stats = dict()
+		self.stats_lock = threading.Lock()
+		
+		# The tasks of each stage submitted to a pool and not yet done, with the number of workers of the pool
+		self.pending_tasks = dict()
+	
+	@property
+	def process_pool(self):
+		'''The pool of worker processes, created the first time it is used'''
+		with self.process_pool_lock:
+			if self._process_pool is None:
+				context = multiprocessing.get_context('forkserver')
+				context.set_forkserver_preload(self.preload_modules)
+				self._process_pool = ProcessPoolExecutor(self.process_count, mp_context = context, initializer = self.initializer, initargs = self.initargs)
+			return self._process_pool
+	
+	def get_stage_stats(self, stage):
+		'''Return a copy of the task statistics of a stage, running is the number of tasks that have started and are not done'''
+		with self.stats_lock:
+			stats = dict(self.stage_stats.get(stage, self.STAGE_STATS))
+			tasks, worker_count = self.pending_tasks.get(stage, (set(), 0))
+			# The process pool marks a task as running when it is sent to the workers, that can be a little before a worker starts it
+			stats['running'] = min(sum(task.running() for task in tasks), worker_count)
+			return stats
+	
+	def task_done(self, stage, task, future, semaphore, submit_time):
+		'''Record the statistics of a finished task and pass its result to the future returned to the caller'''
+		if semaphore is not None:
+			semaphore.release()
+		
+		with self.stats_lock:
+			self.pending_tasks[stage][0].discard(task)
+		
+		try:
+			result, start, duration = task.result()
+		except BaseException as why:
+			with self.stats_lock:
+				self.stage_stats[stage]['failed'] += 1
+			future.set_exception(why)
+		else:
+			with self.stats_lock:
+				stats = self.stage_stats[stage]
+				stats['done'] += 1
+				stats['busy_time'] += duration
+				stats['queue_wait'] += max(start - submit_time, 0.)
+				stats['max_task_time'] = max(stats['max_task_time'], duration)
+			future.set_result(result)
+	
+	def submit(self, pool, stage, function, *args):
+		'''Submit a task to a pool, waiting while the stage has reached its concurrency limit'''
+		semaphore = self.semaphores.get(stage)
+		submit_time = time.time()
+		
+		if semaphore is not None:
+			semaphore.acquire()
+		
+		try:
+			task = pool.submit(call_timed, function, *args)
+		except Exception:
+			if semaphore is not None:
+				semaphore.release()
+			raise
+		
+		with self.stats_lock:
+			self.stage_stats.setdefault(stage, dict(self.STAGE_STATS))['submitted'] += 1
+			self.pending_tasks.setdefault(stage, (set(), self.thread_count if pool is self.thread_pool else self.process_count))[0].add(task)
+		
+		# The caller gets the result of the function, without the duration
+		future = Future()
+		future.set_running_or_notify_cancel()
+		task.add_done_callback(lambda task: self.task_done(stage, task, future, semaphore, submit_time))
+		return future
+	
+	def submit_process(self, stage, function, *args):
+		'''Submit a task of a stage that runs python code to the worker processes, the worker data of the stage is added to the arguments'''
+		logging.debug('Submitting %s task %s to worker processes', stage, function.__name__)
+		return self.submit(self.process_pool, stage, call_with_worker_data, stage, function, *args)
+	
+	def submit_thread(self, stage, function, *args):
+		'''Submit a task of a stage that waits on a subprocess or on I/O to the worker threads'''
+		logging.debug('Submitting %s task %s to worker threads', stage, function.__name__)
+		return self.submit(self.thread_pool, stage, function, *args)
+	
+	def shutdown(self, cancel_futures = False):
+		'''Wait for the running tasks to be done and stop the workers, the tasks not yet started are also run unless cancel_futures is True'''
+		self.thread_pool.shutdown(wait = True, cancel_futures = cancel_futures)
+		if self._process_pool is not None:
+			self._process_pool.shutdown(wait = True, cancel_futures = cancel_futures)
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		# The tasks not yet started are cancelled if the block raised, e.g. on a keyboard interrupt
+		self.shutdown(cancel_futures = exc_type is not None)
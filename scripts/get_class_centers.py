@@ -3,9 +3,13 @@ import logging
 import argparse
 from datetime import datetime, timedelta
 from pathlib import Path
+from concurrent.futures import as_completed
 
 from sdo_data import SdoData
 from job import Job, JobError
+from executor import Executor
+from activity_store import get_activity_store
+from get_median_class_centers import ClassCentersAggregate, get_median_class_centers
 from utils import date_range, get_config, date_to_filename, save_activity_log
 
 __all__ = ['get_class_centers']
@@ -13,7 +17,10 @@ __all__ = ['get_class_centers']
 def get_activity_id(function_name, function_callargs):
 	return '%s.%s' % (function_name, date_to_filename(function_callargs['date']))
 
-@save_activity_log(get_activity_id)
+def get_activity_files(function_callargs, function_output):
+	return function_callargs['images'], function_output
+
+@save_activity_log(get_activity_id, get_activity_files)
 def get_class_centers(date, images, config):
 	'''Execute the SPoCA classification program on image FITS files to compute the class centers'''
 	
@@ -57,6 +64,8 @@ if __name__ == '__main__':
 	parser.add_argument('--start-date', '-s', required = True, type = datetime.fromisoformat, help = 'Start date of AIA files (ISO 8601 format)')
 	parser.add_argument('--end-date', '-e', default = datetime.utcnow(), type = datetime.fromisoformat, help = 'End date of AIA files (ISO 8601 format)')
 	parser.add_argument('--interval', '-i', default = 6, type = int, help = 'Number of hours between two results')
+	parser.add_argument('--checkpoint', default = 100, type = int, help = 'Number of class centers files after which the class centers aggregate is saved (default is 100)')
+	parser.add_argument('--median', action = 'store_true', help = 'Write the median class centers file at the end of the computation')
 
 	args = parser.parse_args()
 	
@@ -66,7 +75,7 @@ if __name__ == '__main__':
 	# Parse the script config file
 	config = get_config(args.config_file)
 	
-	save_activity_log.output_directory = config.get('LOGGING', 'output_directory')
+	save_activity_log.store = get_activity_store(config['LOGGING'])
 	
 	aia_data = SdoData(
 		file_pattern = config.get('AIA_DATA', 'file_pattern'),
@@ -74,12 +83,54 @@ if __name__ == '__main__':
 		ignore_quality_bits = config.getintlist('AIA_DATA', 'ignore_quality_bits'),
 	)
 	
-	for date in date_range(args.start_date, args.end_date, timedelta(hours=args.interval)):
-		images = [aia_data.get_good_quality_file(date = date, wavelength = wavelength) for wavelength in config.getintlist('GET_CLASS_CENTERS', 'aia_wavelengths')]
-		if None in images:
-			logging.info('Image missing for date %s, cannot compute class centers', date.isoformat())
-		else:
+	# The class centers are added to the aggregate as soon as they are computed, so that the median can be refreshed without reading all the files again
+	aggregate = ClassCentersAggregate(config.get('GET_MEDIAN_CLASS_CENTERS', 'aggregate_file'))
+	
+	# The classification program runs in a subprocess, so only the worker threads of the executor are used and the process pool is never started
+	executor = Executor(
+		thread_count = config.getint('EXECUTOR', 'thread_count', fallback = 0),
+		stage_limits = {'get_class_centers': config.getint('EXECUTOR', 'get_class_centers', fallback = 0)},
+	)
+	
+	jobs = dict()
+	
+	# If interrupted, the jobs not yet started are cancelled instead of waiting for all of them
+	cancel_futures = True
+	try:
+		for date in date_range(args.start_date, args.end_date, timedelta(hours=args.interval)):
+			images = [aia_data.get_good_quality_file(date = date, wavelength = wavelength) for wavelength in config.getintlist('GET_CLASS_CENTERS', 'aia_wavelengths')]
+			if None in images:
+				logging.info('Image missing for date %s, cannot compute class centers', date.isoformat())
+			else:
+				try:
+					jobs[executor.submit_thread('get_class_centers', get_class_centers, date, images, config['GET_CLASS_CENTERS'])] = date
+				except Exception as why:
+					logging.exception('Could not start job get_class_centers : %s', why)
+		
+		for count, job in enumerate(as_completed(jobs), start = 1):
+			date = jobs[job]
 			try:
-				class_centers_file = get_class_centers(date, images, config['GET_CLASS_CENTERS'])
+				aggregate.add_file(job.result(), date)
 			except Exception as why:
 				logging.exception('Could not compute class centers for date %s: %s', date.isoformat(), why)
+			
+			if count % args.checkpoint == 0:
+				aggregate.save()
+				logging.info('Computed class centers for %s dates out of %s', count, len(jobs))
+		
+		cancel_futures = False
+	finally:
+		# Save the aggregate even if interrupted, so that the class centers already computed are not read again
+		aggregate.save()
+		executor.shutdown(cancel_futures = cancel_futures)
+	
+	if args.median:
+		try:
+			get_median_class_centers(
+				aggregate.filepath,
+				datetime.fromisoformat(config.get('GET_MEDIAN_CLASS_CENTERS', 'start_date')),
+				datetime.fromisoformat(config.get('GET_MEDIAN_CLASS_CENTERS', 'end_date')),
+				config['GET_MEDIAN_CLASS_CENTERS']
+			)
+		except Exception as why:
+			logging.exception('Could not compute the median class centers: %s', why)
@@ -2,21 +2,24 @@
 import logging
 import argparse
 from pathlib import Path
+import numpy
+from astropy.io import fits
 
-# HACK to make sure that the SPoCA script are found
-import sys, os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
+from activity_store import get_activity_store
 from utils import get_config, date_to_filename, date_from_filename, save_activity_log
-from SPoCA.scripts.clean_map_of_shortlived_regions import clean_map
 from get_longlived_regions_colors import read_regions_colors
+from region_index import get_index_file, write_region_index
 
 __all__ = ['get_cleaned_map']
 
 def get_activity_id(function_name, function_callargs):
 	return '%s.%s' % (function_name, date_to_filename(function_callargs['date']))
 
-@save_activity_log(get_activity_id)
+def get_activity_files(function_callargs, function_output):
+	index_file = get_index_file(function_callargs['date'], function_callargs['config'])
+	return [function_callargs['region_map']], [function_output] if index_file is None else [function_output, index_file]
+
+@save_activity_log(get_activity_id, get_activity_files)
 def get_cleaned_map(date, region_map, longlived_regions_colors, config):
 	'''Clean a region map to only keep the long lived regions'''
 	
@@ -24,7 +27,19 @@ def get_cleaned_map(date, region_map, longlived_regions_colors, config):
 	
 	cleaned_map.parent.mkdir(exist_ok=True)
 	
-	return clean_map(region_map, config.get('image_hdu_name'), cleaned_map, longlived_regions_colors)
+	# The image is decompressed and cleaned once, and the cleaned map and the region index are written from the same array
+	with fits.open(region_map) as hdulist:
+		image = hdulist[config.get('image_hdu_name')].data
+		image[~numpy.isin(image, longlived_regions_colors)] = 0
+		hdulist.writeto(cleaned_map, overwrite = True)
+		
+		# The sparse index lets the consumers of the cleaned map get the pixels of a region without decompressing the whole image
+		index_file = get_index_file(date, config)
+		if index_file is not None:
+			write_region_index(index_file, image)
+			logging.info('Wrote region index "%s"', index_file)
+	
+	return cleaned_map
 
 # Start point of the script
 if __name__ == '__main__':
@@ -43,7 +58,7 @@ if __name__ == '__main__':
 	# Parse the script config file
 	config = get_config(args.config_file)
 	
-	save_activity_log.output_directory = config.get('LOGGING', 'output_directory')
+	save_activity_log.store = get_activity_store(config['LOGGING'])
 	
 	try:
 		longlived_regions_colors = read_regions_colors(args.regions_colors)
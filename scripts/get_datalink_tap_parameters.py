@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import os
 import logging
 import argparse
 
@@ -7,11 +8,18 @@ from utils import get_config, get_url, write_tap_parameters_to_csv
 __all__ = ['get_tracking_tap_parameters_from_file']
 
 
-def get_datalink_tap_parameters(granule_uids, overlay_image, aia_image, hmi_image, provenance_document, config):
+def get_datalink_tap_parameters(granule_uids, overlay_image, aia_image, hmi_image, provenance_document, config, thumbnail_files = None):
 	'''Extract the TAP parameters for the datalink table'''
 	tap_parameters = list()
 	
 	thumbnail_url = get_url(overlay_image, config.get('map_overlay_base_url'), config.get('map_overlay_base_dir', None))
+	# The thumbnails of the overlay image are next to it, one column per size, empty for the thumbnails not written because not smaller than the overlay image
+	thumbnail_urls = dict()
+	for size, thumbnail_file in sorted((thumbnail_files or {}).items()):
+		if thumbnail_file is not None and os.path.isfile(thumbnail_file):
+			thumbnail_urls['thumbnail_%s_url' % size] = get_url(thumbnail_file, config.get('map_overlay_base_url'), config.get('map_overlay_base_dir', None))
+		else:
+			thumbnail_urls['thumbnail_%s_url' % size] = ''
 	ch_stat_aia_image_url = get_url(aia_image, config.get('aia_image_base_url'), config.get('aia_image_base_dir', None))
 	ch_stat_hmi_image_url = get_url(hmi_image, config.get('hmi_image_base_url'), config.get('hmi_image_base_dir', None))
 	provenance_url = get_url(provenance_document, config.get('provenance_base_url'), config.get('provenance_base_dir', None))
@@ -21,6 +29,7 @@ def get_datalink_tap_parameters(granule_uids, overlay_image, aia_image, hmi_imag
 		tap_parameters.append({
 			'granule_uid': granule_uid,
 			'thumbnail_url': thumbnail_url,
+			**thumbnail_urls,
 			'ch_stat_aia_image_url': ch_stat_aia_image_url,
 			'ch_stat_hmi_image_url': ch_stat_hmi_image_url,
 			'provenance_url': provenance_url
@@ -38,6 +47,7 @@ if __name__ == '__main__':
 	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
 	parser.add_argument('--output', '-o', default = 'rob_spoca_ch.datalink.csv', help = 'The file path for the output CSV file (default is rob_spoca_ch.datalink.csv)')
 	parser.add_argument('--granule-uid', '-g', action = 'append', required = True, metavar = 'GRANULE UID', help = 'A granule uid corresponding to the following maps and image')
+	parser.add_argument('--thumbnail', '-t', action = 'append', nargs = 2, default = [], metavar = ('SIZE', 'FILEPATH'), help = 'The size and file path of a thumbnail of the overlay image')
 	parser.add_argument('overlay_image', metavar = 'FILEPATH', help = 'The file path to the overlay image of the cleaned SPoCA CH map')
 	parser.add_argument('aia_image', metavar = 'FILEPATH', help = 'The file path to AIA image used to compute the statistics')
 	parser.add_argument('hmi_image', metavar = 'FILEPATH', help = 'The file path to HMI image used to compute the statistics')
@@ -52,7 +62,7 @@ if __name__ == '__main__':
 	config = get_config(args.config_file)
 	
 	try:
-		tap_parameters = get_datalink_tap_parameters(args.granule_uid, args.overlay_image, args.aia_image, args.hmi_image, args.provenance_document, config['TAP_PARAMETERS'])
+		tap_parameters = get_datalink_tap_parameters(args.granule_uid, args.overlay_image, args.aia_image, args.hmi_image, args.provenance_document, config['TAP_PARAMETERS'], {int(size): filepath for size, filepath in args.thumbnail})
 	except Exception as why:
 		logging.exception('Could not extract TAP parameters for granule uids %s: %s', args.granule_uid, why)
 		raise
@@ -2,6 +2,7 @@
 import os
 import logging
 import argparse
+import numpy
 from datetime import datetime
 from astropy import units
 from astropy.io import fits
@@ -9,7 +10,10 @@ from sunpy.map import Map
 from sunpy.coordinates import frames
 
 from get_longlived_regions_colors import read_regions_colors
-from utils import get_config, get_url, write_tap_parameters_to_csv
+from region_index import RegionIndex, get_index_file
+from region_polygons import get_region_polygons, get_s_regions
+from region_catalog import get_region_coverages
+from utils import get_config, get_url, date_from_filename, write_tap_parameters_to_csv
 
 __all__ = ['get_epn_core_tap_parameters_from_file']
 
@@ -45,7 +49,7 @@ FIX_TAP_PARAMETERS = {
 }
 
 
-def get_epn_core_tap_parameters_from_file(tracked_map, cleaned_map, overlay_image, regions_colors, config):
+def get_epn_core_tap_parameters_from_file(tracked_map, cleaned_map, overlay_image, index_file, regions_colors, config):
 	'''Extract the TAP parameters for the epn_core table'''
 	file_date = datetime.fromtimestamp(os.path.getmtime(cleaned_map))
 	file_size = os.path.getsize(cleaned_map) * units.byte
@@ -90,6 +94,13 @@ def get_epn_core_tap_parameters_from_file(tracked_map, cleaned_map, overlay_imag
 		except Exception as why:
 			logging.warning('Could not extract TAP parameters for HMI regions stats from file %s: %s', tracked_map, why)
 			regions_stats_hmi_parameters = dict()
+		
+		# The polygons and coverages of the regions are NOT mandatory, just log a warning
+		try:
+			regions_shape_parameters = get_epn_core_tap_parameters_from_regions_shapes(hdulist[REGIONS_HDU_NAME], map, index_file, regions_colors, config)
+		except Exception as why:
+			logging.warning('Could not extract polygons and coverages of regions from file %s: %s', tracked_map, why)
+			regions_shape_parameters = dict()
 	
 	tap_parameters = list()
 	for id, region_parameters in regions_parameters.items():
@@ -100,6 +111,7 @@ def get_epn_core_tap_parameters_from_file(tracked_map, cleaned_map, overlay_imag
 			**region_parameters,
 			**regions_stats_aia_parameters.get(id, {}),
 			**regions_stats_hmi_parameters.get(id, {}),
+			**regions_shape_parameters.get(id, {}),
 		})
 	
 	return tap_parameters
@@ -129,13 +141,17 @@ def get_epn_core_tap_parameters_from_regions_hdu(hdu, map, regions_colors = None
 	'''Extract the TAP parameters from a FITS BinTableHDU of regions'''
 	tap_parameters = dict()
 	
-	for region in hdu.data:
+	regions = hdu.data
+	
+	# Test the membership of all regions at once instead of one region at a time
+	if regions_colors is not None:
+		selected = numpy.isin(regions['TRACKED_COLOR'], regions_colors)
+		logging.debug('Skipping regions with tracked color %s', regions['TRACKED_COLOR'][~selected])
+		regions = regions[selected]
+	
+	for region in regions:
 		tracked_color = int(region['TRACKED_COLOR'])
 		
-		if regions_colors is not None and tracked_color not in regions_colors:
-			logging.debug('Skipping region with tracked color %s', tracked_color)
-			continue
-		
 		date_obs = datetime.fromisoformat(region['DATE_OBS'])
 		boxmin_ra, boxmin_dec = pixel2hpc(map, region['XBOXMIN'], region['YBOXMIN'])
 		boxmax_ra, boxmax_dec = pixel2hpc(map, region['XBOXMAX'], region['YBOXMAX'])
@@ -160,6 +176,38 @@ def get_epn_core_tap_parameters_from_regions_hdu(hdu, map, regions_colors = None
 	return tap_parameters
 
 
+def get_epn_core_tap_parameters_from_regions_shapes(hdu, map, index_file = None, regions_colors = None, config = None):
+	'''Extract the s_region TAP parameter from the outer boundary of the regions on the cleaned map, simplified to the s_region_tolerance in pixels,
+	and the heliographic coverage of the regions as a MOC of HEALPix cells at coverage_order, for the spatial search of the region catalog'''
+	if config is None or not (config.get('s_region_tolerance', '') or config.get('coverage_order', '')):
+		return dict()
+	
+	regions = hdu.data
+	
+	if regions_colors is not None:
+		regions = regions[numpy.isin(regions['TRACKED_COLOR'], regions_colors)]
+	
+	# The sparse region index of the cleaned map avoids decompressing the image, the image of the tracked map has the same pixels for the long lived regions
+	if index_file is not None and os.path.isfile(index_file):
+		region_index = RegionIndex(index_file)
+	else:
+		region_index = RegionIndex.from_image(map.data)
+	
+	colors = [int(color) for color in regions['TRACKED_COLOR']]
+	shapes = {color: dict() for color in colors}
+	
+	if config.get('s_region_tolerance', ''):
+		polygons = get_region_polygons(region_index, colors, config.getfloat('s_region_tolerance'))
+		for color, s_region in get_s_regions(map, polygons, config.getint('s_region_precision', 4)).items():
+			shapes[color]['s_region'] = s_region
+	
+	if config.get('coverage_order', ''):
+		for color, coverage in get_region_coverages(map, region_index, colors, config.getint('coverage_order'), config.get('coverage_frame', 'carrington'), config.getint('coverage_stride', 2)).items():
+			shapes[color]['ch_coverage_moc'] = coverage
+	
+	return {region['ID']: shapes[int(region['TRACKED_COLOR'])] for region in regions}
+
+
 def get_epn_core_tap_parameters_from_regions_stats_hdu(hdu, image_template, prefix):
 	'''Extract the TAP parameters from a FITS BinTableHDU of region statistics'''
 	tap_parameters = dict()
@@ -222,7 +270,7 @@ if __name__ == '__main__':
 		regions_colors = None
 	
 	try:
-		tap_parameters = get_epn_core_tap_parameters_from_file(args.tracked_map, args.cleaned_map, args.overlay_image, regions_colors, config['TAP_PARAMETERS'])
+		tap_parameters = get_epn_core_tap_parameters_from_file(args.tracked_map, args.cleaned_map, args.overlay_image, get_index_file(date_from_filename(args.cleaned_map), config['LIFESPAN_CLEANING']), regions_colors, config['TAP_PARAMETERS'])
 	except Exception as why:
 		logging.exception('Could not extract TAP parameters for file %s: %s', args.tracked_map, why)
 		raise
@@ -1,15 +1,14 @@
 #!/usr/bin/env python3
 import logging
 import argparse
-import pandas
+import numpy
 
 # HACK to make sure that the SPoCA script are found
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from activity_store import get_activity_store
 from utils import get_config, date_to_filename, date_from_filename, save_activity_log
-from SPoCA.scripts.aggregate_tables_from_fits import get_dataframe_from_files
-from SPoCA.scripts.write_regions_lifespan_to_csv import get_regions_lifespan_by_color
 
 __all__ = ['get_longlived_regions_colors', 'read_regions_colors', 'write_regions_colors']
 
@@ -20,6 +19,11 @@ def get_activity_id(function_name, function_callargs):
 def get_longlived_regions_colors(region_maps, config):
 	'''Compute the lifespan of regions on tracked region maps and create the list of longlived regions colors'''
 	
+	# Imported here because pandas and the SPoCA scripts are slow to import, and read_regions_colors does not need them
+	import pandas
+	from SPoCA.scripts.aggregate_tables_from_fits import get_dataframe_from_files
+	from SPoCA.scripts.write_regions_lifespan_to_csv import get_regions_lifespan_by_color
+	
 	logging.info('Extracting info from regions maps')
 	
 	regions_dataframe = get_dataframe_from_files(region_maps, config.get('region_hdu_name'))
@@ -33,13 +37,13 @@ def get_longlived_regions_colors(region_maps, config):
 	regions_lifespan_dataframe = regions_lifespan_dataframe.loc[regions_lifespan_dataframe['LIFESPAN'] >= config.gettimedelta('min_lifespan')]
 	
 	# The index is the TRACKED_COLOR column
-	return set(regions_lifespan_dataframe.index)
+	return numpy.unique(regions_lifespan_dataframe.index.to_numpy())
 
 
 def read_regions_colors(filepath):
-	'''Read a list of regions colors from a text file'''
+	'''Read a list of regions colors from a text file and return them as a sorted array'''
 	with open(filepath, 'rt') as file:
-		regions_colors = [int(color) for color in file.read().split()]
+		regions_colors = numpy.unique([int(color) for color in file.read().split()])
 	return regions_colors
 
 
@@ -66,7 +70,7 @@ if __name__ == '__main__':
 	# Parse the script config file
 	config = get_config(args.config_file)
 	
-	save_activity_log.output_directory = config.get('LOGGING', 'output_directory')
+	save_activity_log.store = get_activity_store(config['LOGGING'])
 	
 	# Extract the colors of the longlived regions
 	try:
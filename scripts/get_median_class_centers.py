@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import os
+import re
+import logging
+import argparse
+from glob import glob
+from datetime import datetime
+from pathlib import Path
+import numpy
+
+from activity_store import get_activity_store
+from utils import get_config, date_to_filename, date_from_filename, save_activity_log
+
+__all__ = ['read_class_centers', 'write_class_centers', 'ClassCentersAggregate', 'get_median_class_centers']
+
+NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def read_class_centers(filepath):
+	'''Read a class centers file written by the SPoCA classification program, and return the channels, the class centers as an array of shape (number of classes, number of channels) sorted by the first channel, and the text of the centers'''
+	with open(filepath, 'rt') as file:
+		line = file.readline().strip()
+	
+	# The line is the list of channels followed by the list of class centers, e.g. [193]	[(25.3),(74.1),(163.8),(402.5)]
+	channels, text = line.split(None, 1)
+	channel_count = max(len(NUMBER.findall(channels)), 1)
+	centers = numpy.array([float(value) for value in NUMBER.findall(text)]).reshape(-1, channel_count)
+	
+	# The classes are not always in the same order, so they are matched by intensity
+	return channels, centers[numpy.argsort(centers[:, 0], kind = 'stable')], text
+
+
+def write_class_centers(channels, centers, text, filepath):
+	'''Write a class centers file for the SPoCA programs, using the text of the centers of an existing file as a template'''
+	values = iter(numpy.asarray(centers).reshape(-1))
+	with open(filepath, 'wt') as file:
+		file.write('%s\t%s\n' % (channels, NUMBER.sub(lambda match: '%g' % next(values), text)))
+
+
+class ClassCentersAggregate:
+	'''The class centers of all the dates in a compact array, stored in a numpy npz file, to compute the exact median without reading the class centers files again'''
+	
+	def __init__(self, filepath):
+		self.filepath = Path(filepath)
+		self.dates = dict()
+		self.centers = list()
+		self.channels = None
+		self.text = None
+		self.modified = False
+		
+		try:
+			with numpy.load(self.filepath) as data:
+				self.channels = str(data['channels'])
+				self.text = str(data['text'])
+				self.centers = list(data['centers'])
+				self.dates = {date.item(): index for index, date in enumerate(data['dates'].astype('datetime64[s]'))}
+		except FileNotFoundError:
+			logging.info('Class centers aggregate file %s does not exist, it will be created', self.filepath)
+	
+	def __len__(self):
+		return len(self.dates)
+	
+	def __contains__(self, date):
+		return date in self.dates
+	
+	def add(self, date, channels, centers, text):
+		'''Add or replace the class centers of a date'''
+		if self.channels is None:
+			self.channels, self.text = channels, text
+		elif channels != self.channels or centers.shape != self.centers[0].shape:
+			raise ValueError('Class centers of date %s for channels %s with shape %s do not match the aggregate channels %s with shape %s' % (date.isoformat(), channels, centers.shape, self.channels, self.centers[0].shape))
+		
+		if date in self.dates:
+			self.centers[self.dates[date]] = centers
+		else:
+			self.dates[date] = len(self.centers)
+			self.centers.append(centers)
+		self.modified = True
+	
+	def add_file(self, filepath, date = None):
+		'''Add the class centers of a class centers file'''
+		self.add(date or date_from_filename(filepath), *read_class_centers(filepath))
+	
+	def update(self, filepaths, force = False):
+		'''Add the class centers files of the dates that are not yet in the aggregate, and return the number of files read'''
+		count = 0
+		for filepath in filepaths:
+			date = date_from_filename(filepath)
+			if force or date not in self.dates:
+				try:
+					self.add_file(filepath, date)
+				except Exception as why:
+					logging.error('Could not read class centers file %s: %s', filepath, why)
+				else:
+					count += 1
+		return count
+	
+	def save(self):
+		'''Write the aggregate file, if it was modified'''
+		if not self.modified:
+			return
+		
+		dates = sorted(self.dates)
+		self.filepath.parent.mkdir(parents = True, exist_ok = True)
+		
+		# Write to a temporary file and rename, so that an interrupted save does not corrupt the aggregate
+		temporary_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+		with open(temporary_filepath, 'wb') as file:
+			numpy.savez(
+				file,
+				dates = numpy.array(dates, dtype = 'datetime64[s]'),
+				centers = numpy.array([self.centers[self.dates[date]] for date in dates]),
+				channels = self.channels,
+				text = self.text
+			)
+		os.replace(temporary_filepath, self.filepath)
+		
+		# The centers are stored in date order
+		self.centers = [self.centers[self.dates[date]] for date in dates]
+		self.dates = {date: index for index, date in enumerate(dates)}
+		self.modified = False
+	
+	def get_median(self, start_date = None, end_date = None):
+		'''Return the median of each class center for the dates between start date (inclusive) and end date (exclusive)'''
+		centers = [self.centers[index] for date, index in self.dates.items() if (start_date is None or date >= start_date) and (end_date is None or date < end_date)]
+		if not centers:
+			raise ValueError('No class centers between %s and %s' % (start_date, end_date))
+		return numpy.median(numpy.array(centers), axis = 0), len(centers)
+
+
+def get_activity_id(function_name, function_callargs):
+	return '%s.%s-%s' % (function_name, date_to_filename(function_callargs['start_date']), date_to_filename(function_callargs['end_date']))
+
+def get_activity_files(function_callargs, function_output):
+	return [function_callargs['aggregate_file']], function_output
+
+@save_activity_log(get_activity_id, get_activity_files)
+def get_median_class_centers(aggregate_file, start_date, end_date, config):
+	'''Compute the median of each class center through time from the class centers aggregate, and write the class centers file for the SPoCA attribution program'''
+	
+	aggregate = ClassCentersAggregate(aggregate_file)
+	median, count = aggregate.get_median(start_date, end_date)
+	
+	logging.info('Computed median of the class centers of %s dates between %s and %s', count, start_date.isoformat(), end_date.isoformat())
+	
+	median_class_centers_file = Path(config.get('output_file'))
+	median_class_centers_file.parent.mkdir(parents = True, exist_ok = True)
+	write_class_centers(aggregate.channels, median, aggregate.text, median_class_centers_file)
+	
+	logging.info('Wrote median class centers file "%s"', median_class_centers_file)
+	
+	return median_class_centers_file
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Add the new class centers files to the class centers aggregate, and write the median class centers file')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of the class centers for the median (ISO 8601 format, default is the start_date of the config)')
+	parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of the class centers for the median, exclusive (ISO 8601 format, default is the end_date of the config)')
+	parser.add_argument('--rebuild', action = 'store_true', help = 'Read all the class centers files again, instead of only the ones not yet in the aggregate')
+	parser.add_argument('class_centers_files', metavar = 'FILEPATH', nargs = '*', help = 'The class centers files to add to the aggregate (default is all the files matching the output_file of the GET_CLASS_CENTERS section)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	save_activity_log.store = get_activity_store(config['LOGGING'])
+	
+	aggregate_file = config.get('GET_MEDIAN_CLASS_CENTERS', 'aggregate_file')
+	aggregate = ClassCentersAggregate(aggregate_file)
+	
+	class_centers_files = args.class_centers_files or sorted(glob(config.get('GET_CLASS_CENTERS', 'output_file').format(date = '*')))
+	try:
+		count = aggregate.update(class_centers_files, force = args.rebuild)
+	finally:
+		# Save the aggregate even if interrupted, so that the files already read are not read again
+		aggregate.save()
+	logging.info('Added %s class centers files to the aggregate, it has the class centers of %s dates', count, len(aggregate))
+	
+	try:
+		get_median_class_centers(
+			aggregate_file,
+			args.start_date or datetime.fromisoformat(config.get('GET_MEDIAN_CLASS_CENTERS', 'start_date')),
+			args.end_date or datetime.fromisoformat(config.get('GET_MEDIAN_CLASS_CENTERS', 'end_date')),
+			config['GET_MEDIAN_CLASS_CENTERS']
+		)
+	except Exception as why:
+		logging.exception('Could not compute the median class centers: %s', why)
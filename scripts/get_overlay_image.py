@@ -4,16 +4,21 @@ import argparse
 from pathlib import Path
 
 from job import Job, JobError
-from utils import get_config, date_to_filename, date_from_filename, save_activity_log
+from activity_store import get_activity_store
+from utils import get_config, date_to_filename, date_from_filename, get_thumbnail_files, save_activity_log
 
 __all__ = ['get_overlay_image']
 
 def get_activity_id(function_name, function_callargs):
 	return '%s.%s' % (function_name, date_to_filename(function_callargs['date']))
 
-@save_activity_log(get_activity_id)
+def get_activity_files(function_callargs, function_output):
+	# The thumbnails not smaller than the overlay image are not written
+	return [function_callargs['map'], function_callargs['background_image']], [function_output, *[thumbnail_file for thumbnail_file in get_thumbnail_files(function_output, function_callargs['config']).values() if thumbnail_file.is_file()]]
+
+@save_activity_log(get_activity_id, get_activity_files)
 def get_overlay_image(date, map, background_image, config):
-	'''Execute the SPoCA overlay program on a region map to display the contours of the regions on top of an image FITS file'''
+	'''Execute the SPoCA overlay program, or the python engine, on a region map to display the contours of the regions on top of an image FITS file, and create the thumbnails of the overlay image'''
 	
 	logging.info('Creating overlay image for map %s', map)
 	
@@ -21,6 +26,16 @@ def get_overlay_image(date, map, background_image, config):
 	
 	overlay_image.parent.mkdir(exist_ok=True)
 	
+	thumbnail_files = get_thumbnail_files(overlay_image, config)
+	
+	# The python engine draws the overlay in process, instead of starting the SPoCA overlay program
+	if config.get('engine', 'spoca') == 'python':
+		# Imported here because numpy and astropy are slow to import and not needed by the SPoCA engine
+		from overlay_image import create_overlay_image
+		create_overlay_image(map, background_image, overlay_image, config, thumbnail_files)
+		logging.info('Wrote overlay image "%s"', overlay_image)
+		return overlay_image
+	
 	job = Job(
 		config.get('executable'),
 		positional_parameters = [map, background_image],
@@ -42,6 +57,12 @@ def get_overlay_image(date, map, background_image, config):
 	else:
 		raise JobError(config.get('executable'), exit_code, output, error, message = 'Job was successful but map {map} is missing', overlay_image = overlay_image)
 	
+	# All the thumbnails are reduced from a single decode of the overlay image
+	if thumbnail_files:
+		from overlay_image import read_image, write_thumbnails
+		write_thumbnails(read_image(overlay_image), thumbnail_files)
+		logging.info('Wrote thumbnails of overlay image "%s"', overlay_image)
+	
 	return overlay_image
 
 
@@ -63,7 +84,7 @@ if __name__ == '__main__':
 	# Parse the script config file
 	config = get_config(args.config_file)
 	
-	save_activity_log.output_directory = config.get('LOGGING', 'output_directory')
+	save_activity_log.store = get_activity_store(config['LOGGING'])
 	
 	try:
 		overlay_image = get_overlay_image(date_from_filename(args.region_map), args.region_map, args.background_image, config['GET_OVERLAY_IMAGE'])
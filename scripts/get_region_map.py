@@ -4,6 +4,7 @@ import argparse
 from pathlib import Path
 
 from job import Job, JobError
+from activity_store import get_activity_store
 from utils import get_config, date_to_filename, date_from_filename, save_activity_log
 
 __all__ = ['get_region_map']
@@ -11,7 +12,10 @@ __all__ = ['get_region_map']
 def get_activity_id(function_name, function_callargs):
 	return '%s.%s' % (function_name, date_to_filename(function_callargs['date']))
 
-@save_activity_log(get_activity_id)
+def get_activity_files(function_callargs, function_output):
+	return [function_callargs['segmentation_map'], *function_callargs['stat_images'].values()], function_output
+
+@save_activity_log(get_activity_id, get_activity_files)
 def get_region_map(date, segmentation_map, stat_images, config):
 	'''Execute the SPoCA get_ch_map or get_ar_map program on a segmentation map to create a region map'''
 	
@@ -63,7 +67,7 @@ if __name__ == '__main__':
 	# Parse the script config file
 	config = get_config(args.config_file)
 	
-	save_activity_log.output_directory = config.get('LOGGING', 'output_directory')
+	save_activity_log.store = get_activity_store(config['LOGGING'])
 	
 	try:
 		region_map = get_region_map(date_from_filename(args.segmentation_map), args.segmentation_map, dict(args.stat_image), config['GET_REGION_MAP'])
@@ -3,6 +3,7 @@ import logging
 import argparse
 
 from job import Job, JobError
+from activity_store import get_activity_store
 from utils import get_config, date_to_filename, date_from_filename, save_activity_log
 
 __all__ = ['get_tracked_map']
@@ -10,7 +11,12 @@ __all__ = ['get_tracked_map']
 def get_activity_id(function_name, function_callargs):
 	return '%s.%s-%s' % (function_name, date_to_filename(date_from_filename(function_callargs['untracked_maps'][0])), date_to_filename(date_from_filename(function_callargs['untracked_maps'][-1])))
 
-@save_activity_log(get_activity_id)
+def get_activity_files(function_callargs, function_output):
+	# The maps are tracked in place, and the previously tracked maps are only used to continue the tracking relations
+	# so they are not part of the lineage of the maps, else the lineage of a map would go back to the first tracked map
+	return list(), function_callargs['untracked_maps']
+
+@save_activity_log(get_activity_id, get_activity_files)
 def get_tracked_map(tracked_maps, untracked_maps, config):
 	'''Execute the SPoCA tracking program on region maps'''
 	
@@ -49,7 +55,7 @@ if __name__ == '__main__':
 	# Parse the script config file
 	config = get_config(args.config_file)
 	
-	save_activity_log.output_directory = config.get('LOGGING', 'output_directory')
+	save_activity_log.store = get_activity_store(config['LOGGING'])
 	
 	try:
 		get_tracked_map(args.tracked_map, args.untracked_maps, config['GET_TRACKED_MAP'])
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 import logging
 import argparse
+import numpy
 from datetime import datetime
-from astropy.io import fits
 
 from get_longlived_regions_colors import read_regions_colors
 from utils import write_tap_parameters_to_csv
@@ -14,6 +14,9 @@ TRACKING_HDU_NAME = 'TrackingRelations'
 def get_tracking_tap_parameters_from_file(tracked_map, regions_colors = None):
 	'''Extract the TAP parameters for the tracking table'''
 	
+	# Imported here because astropy is slow to import
+	from astropy.io import fits
+	
 	with fits.open(tracked_map) as hdulist:
 		return get_tracking_tap_parameters_from_tracking_hdu(hdulist[TRACKING_HDU_NAME], regions_colors)
 
@@ -22,18 +25,18 @@ def get_tracking_tap_parameters_from_tracking_hdu(hdu, regions_colors = None):
 	'''Extract the TAP parameters from a FITS BinTableHDU of tracking relations'''
 	tap_parameters = list()
 	
-	for tracking_relation in hdu.data:
+	tracking_relations = hdu.data
+	
+	# Test the membership of all relations at once instead of one relation at a time
+	if regions_colors is not None:
+		selected = numpy.isin(tracking_relations['PAST_COLOR'], regions_colors) & numpy.isin(tracking_relations['PRESENT_COLOR'], regions_colors)
+		logging.debug('Skipping tracking relations with past colors %s and present colors %s', tracking_relations['PAST_COLOR'][~selected], tracking_relations['PRESENT_COLOR'][~selected])
+		tracking_relations = tracking_relations[selected]
+	
+	for tracking_relation in tracking_relations:
 		past_color = int(tracking_relation['PAST_COLOR'])
 		present_color = int(tracking_relation['PRESENT_COLOR'])
 		
-		if regions_colors is not None:
-			if past_color not in regions_colors:
-				logging.debug('Skipping tracking relation with past color %s', past_color)
-				continue
-			if present_color not in regions_colors:
-				logging.debug('Skipping tracking relation with present color %s', present_color)
-				continue
-		
 		tap_parameters.append({
 			'previous': 'spoca_coronalhole_{tracked_color}_{date_obs}'.format(tracked_color = past_color, date_obs = datetime.fromisoformat(tracking_relation['PAST_DATE_OBS']).strftime('%Y%m%d_%H%M%S')), # e.g. spoca_coronalhole_198_20100112_160000
 			'next': 'spoca_coronalhole_{tracked_color}_{date_obs}'.format(tracked_color = present_color, date_obs = datetime.fromisoformat(tracking_relation['PRESENT_DATE_OBS']).strftime('%Y%m%d_%H%M%S')), # e.g. spoca_coronalhole_198_20100112_160000
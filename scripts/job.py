@@ -7,6 +7,9 @@ __all__ = ['Job', 'JobError']
 
 class Job:
 	'''Class to run an executable'''
+	
+	# Optional staging cache of the input files, the executables are given the paths of the local copies of the prefetched files
+	staging_cache = None
 
 	def __init__(self, executable, positional_parameters = [], optional_parameters = {}):
 		self.executable = executable
@@ -48,9 +51,18 @@ class Job:
 		
 		command = self.get_command(positional_parameters, optional_parameters)
 		
+		if self.staging_cache is None:
+			staged_files = list()
+		else:
+			command, staged_files = self.staging_cache.stage_command(command)
+		
 		logging.debug('Executing job %s', ' '.join(command))
 		
-		process = subprocess.run(command, input = input, stdout = subprocess.PIPE, stderr = subprocess.PIPE, encoding = 'utf8')
+		try:
+			process = subprocess.run(command, input = input, stdout = subprocess.PIPE, stderr = subprocess.PIPE, encoding = 'utf8')
+		finally:
+			if staged_files:
+				self.staging_cache.release(staged_files)
 		
 		return process.returncode, process.stdout, process.stderr
 	
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import re
+import logging
+from functools import lru_cache
+import numpy
+from astropy.io import fits
+from PIL import Image, ImageDraw, ImageFont
+
+__all__ = ['read_spoca_config', 'get_overlay', 'read_image', 'write_image', 'get_thumbnail_pyramid', 'write_thumbnails', 'create_overlay_image']
+
+# Colors of the contours, indexed by the color of the region modulo the number of colors
+CONTOUR_COLORS = numpy.array([
+	[255, 255, 0],
+	[255, 0, 0],
+	[0, 255, 0],
+	[0, 128, 255],
+	[255, 0, 255],
+	[0, 255, 255],
+	[255, 128, 0],
+	[128, 0, 255],
+	[255, 255, 255],
+	[128, 255, 0],
+	[255, 0, 128],
+	[0, 255, 128],
+], dtype = numpy.uint8)
+
+# The upper label written when the upperLabel option is set without a value, like the SPoCA overlay program
+DEFAULT_UPPER_LABEL = '{TELESCOP} {WAVELNTH}Å {DATE-OBS}'
+
+# Distance in pixels of the labels to the border of the image
+LABEL_MARGIN = 4
+
+# The options of the SPoCA overlay program that are not implemented, they are ignored with a warning
+UNSUPPORTED_OPTIONS = ['fill', 'imagePreprocessing', 'recenter', 'registerImages', 'scaling', 'straightenUp']
+
+
+@lru_cache()
+def read_spoca_config(filepath):
+	'''Parse the config file of a SPoCA program and return the options as strings'''
+	options = dict()
+	with open(filepath, 'rt') as file:
+		for line in file:
+			line = line.strip()
+			# Skip comments and section names
+			if not line or line.startswith('#') or line.endswith(':') or '=' not in line:
+				continue
+			key, value = line.split('=', 1)
+			options[key.strip()] = value.strip().strip('"')
+	return options
+
+
+def get_aia_color_table(wavelength):
+	'''Return the AIA color table of a wavelength as an array of 256 RGB colors, as defined in SunPy'''
+	c0 = numpy.arange(256, dtype = numpy.float64)
+	c1 = numpy.sqrt(c0) * numpy.sqrt(255.0)
+	c2 = c0 ** 2 / 255.0
+	c3 = (c1 + c2 / 2.0) * 255.0 / (c1.max() + c2.max() / 2.0)
+	# The other wavelengths use tabulated color tables, they are drawn in gray
+	color_tables = {
+		94: (c2, c3, c0),
+		193: (c1, c0, c2),
+		211: (c1, c0, c3),
+		335: (c2, c0, c1),
+	}
+	red, green, blue = color_tables.get(wavelength, (c0, c0, c0))
+	return numpy.stack([red, green, blue], axis = 1).clip(0, 255).astype(numpy.uint8)
+
+
+def resize_nearest(image, shape):
+	'''Resize an image to a shape by nearest neighbour sampling'''
+	rows = numpy.arange(shape[0]) * image.shape[0] // shape[0]
+	columns = numpy.arange(shape[1]) * image.shape[1] // shape[1]
+	return image[rows[:, numpy.newaxis], columns]
+
+
+def resize_mean(image, shape):
+	'''Resize an image to a smaller shape by averaging blocks of pixels, and by nearest neighbour sampling if the shape does not divide the image shape'''
+	row_factor, column_factor = max(image.shape[0] // shape[0], 1), max(image.shape[1] // shape[1], 1)
+	if row_factor > 1 or column_factor > 1:
+		rows, columns = image.shape[0] // row_factor, image.shape[1] // column_factor
+		image = image[:rows * row_factor, :columns * column_factor].reshape(rows, row_factor, columns, column_factor, *image.shape[2:]).mean(axis = (1, 3))
+	if image.shape[:2] != tuple(shape):
+		image = resize_nearest(image, shape)
+	return image
+
+
+def scale_background(image, min_percentile, max_percentile, stretch):
+	'''Scale the intensities of an image to bytes, clipping them to percentiles'''
+	image = numpy.nan_to_num(image.astype(numpy.float64), nan = 0.0)
+	
+	# A subsample of the pixels is enough to estimate the percentiles
+	vmin, vmax = numpy.percentile(image[::4, ::4], [min_percentile, max_percentile])
+	image = (image.clip(vmin, vmax) - vmin) / max(vmax - vmin, 1e-9)
+	
+	if stretch == 'log':
+		image = numpy.log1p(image * 1000) / numpy.log1p(1000)
+	elif stretch == 'sqrt':
+		image = numpy.sqrt(image)
+	
+	return (image * 255).round().astype(numpy.uint8)
+
+
+def get_neighbours(image):
+	'''Return the 4 neighbours of each pixel, the pixels on the border are their own neighbours'''
+	padded = numpy.pad(image, 1, mode = 'edge')
+	return [padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]]
+
+
+def get_contours(region_map, internal = False, width = 1):
+	'''Return an image of the contours of the regions, where each contour pixel has the color of its region and the other pixels are 0'''
+	
+	neighbours = get_neighbours(region_map)
+	
+	if internal:
+		# The pixels of a region that touch another region or the background
+		is_border = numpy.zeros(region_map.shape, dtype = bool)
+		for neighbour in neighbours:
+			is_border |= neighbour != region_map
+		contours = numpy.where(is_border & (region_map != 0), region_map, 0)
+	else:
+		# The background pixels that touch a region, with the color of that region
+		contours = numpy.maximum.reduce(neighbours)
+		contours[region_map != 0] = 0
+	
+	# Thicken the contours on the side they were drawn
+	for i in range(width - 1):
+		grown = numpy.maximum.reduce(get_neighbours(contours))
+		grown[(region_map == 0) if internal else (region_map != 0)] = 0
+		contours = numpy.where(contours != 0, contours, grown)
+	
+	return contours
+
+
+def format_label(label, header):
+	'''Replace the keywords between {} in a label by their value in a FITS header, a missing keyword is replaced by an empty string'''
+	return re.sub(r'\{([^}]+)\}', lambda match: str(header.get(match[1], '')) if header is not None else '', label).strip()
+
+
+def draw_labels(image, lower_label = None, upper_label = None):
+	'''Write the labels in white on the lower left and upper left corners of an RGB image'''
+	image = Image.fromarray(image)
+	draw = ImageDraw.Draw(image)
+	font = ImageFont.load_default()
+	
+	if upper_label:
+		draw.text((LABEL_MARGIN, LABEL_MARGIN), upper_label, fill = (255, 255, 255), font = font)
+	
+	if lower_label:
+		left, top, right, bottom = draw.textbbox((0, 0), lower_label, font = font)
+		draw.text((LABEL_MARGIN, image.height - LABEL_MARGIN - bottom), lower_label, fill = (255, 255, 255), font = font)
+	
+	return numpy.array(image)
+
+
+def get_overlay(region_map, background, color_table, options, size = None, header = None):
+	'''Return the RGB image of the contours of the regions of the map on top of the background image scaled to bytes
+	The keywords between {} in the labels are taken from the header of the map'''
+	
+	for option in UNSUPPORTED_OPTIONS:
+		if options.get(option, '').lower() not in ('', 'false', '0'):
+			logging.warning('Option %s of the SPoCA overlay program is not supported by the python engine, it will be ignored', option)
+	
+	if size is None:
+		size = background.shape
+	
+	region_map = numpy.nan_to_num(region_map, nan = 0).astype(numpy.int64)
+	
+	# Only plot the selected regions
+	if options.get('colors'):
+		colors = options['colors']
+		try:
+			colors = [int(color) for color in colors.split(',')]
+		except ValueError:
+			with open(colors, 'rt') as file:
+				colors = [int(color) for color in file.read().replace(',', ' ').split()]
+		region_map[~numpy.isin(region_map, colors)] = 0
+	
+	# The contours are computed at the size of the output image, so that they are not thinned by the resizing
+	contours = get_contours(resize_nearest(region_map, size), internal = options.get('internal', 'false').lower() == 'true', width = int(options.get('width') or 1))
+	
+	overlay = color_table[background if background.shape == tuple(size) else resize_nearest(background, size)]
+	
+	if options.get('uniqueColor'):
+		overlay[contours != 0] = CONTOUR_COLORS[int(options['uniqueColor']) % len(CONTOUR_COLORS)]
+	else:
+		overlay[contours != 0] = CONTOUR_COLORS[contours[contours != 0] % len(CONTOUR_COLORS)]
+	
+	# The first row of a FITS image is the bottom of the image, but the first row of a PNG is the top
+	overlay = numpy.flipud(overlay)
+	
+	# The upperLabel option set without a value means the default label
+	lower_label = format_label(options.get('lowerLabel', ''), header)
+	upper_label = format_label(options['upperLabel'] or DEFAULT_UPPER_LABEL, header) if 'upperLabel' in options else ''
+	if lower_label or upper_label:
+		overlay = draw_labels(overlay, lower_label, upper_label)
+	
+	return overlay
+
+
+def read_image(filepath):
+	'''Read an image file and return it as an array of RGB bytes'''
+	with Image.open(filepath) as image:
+		return numpy.asarray(image.convert('RGB'))
+
+
+def write_image(filepath, image, quality = 80):
+	'''Write an array of RGB bytes to a PNG or WebP file depending on the file extension'''
+	if str(filepath).lower().endswith('.webp'):
+		Image.fromarray(image).save(filepath, format = 'WEBP', quality = quality)
+	else:
+		Image.fromarray(image).save(filepath, format = 'PNG')
+
+
+def get_thumbnail_pyramid(image, sizes):
+	'''Return the thumbnails of an image for each size, the size being the width of the thumbnail
+	Each thumbnail is reduced from the next larger one, so the full resolution image is only reduced once
+	The sizes not smaller than the width of the image are skipped, as the thumbnail would be a copy of the image'''
+	thumbnails = dict()
+	height, width = image.shape[:2]
+	
+	for size in sorted(sizes, reverse = True):
+		if size >= width:
+			logging.debug('Thumbnail size %s is not smaller than the image width %s, skipping thumbnail', size, width)
+			continue
+		image = resize_mean(image, (max(round(height * size / width), 1), size)).round().astype(numpy.uint8)
+		thumbnails[size] = image
+	
+	return thumbnails
+
+
+def write_thumbnails(image, thumbnail_files):
+	'''Write the thumbnails of an image, thumbnail files being the path of the thumbnail for each size, and return the paths of the thumbnails written'''
+	written_files = dict()
+	for size, thumbnail in get_thumbnail_pyramid(image, thumbnail_files.keys()).items():
+		write_image(thumbnail_files[size], thumbnail)
+		written_files[size] = thumbnail_files[size]
+	return written_files
+
+
+def create_overlay_image(map, background_image, output_file, config, thumbnail_files = None):
+	'''Draw the contours of the regions of a map on top of a background image and write it to a PNG file, using the options of the SPoCA overlay program config file, and optionaly the thumbnails of the image'''
+	
+	options = read_spoca_config(config.get('config_file'))
+	
+	region_map, header = fits.getdata(map, config.get('map_hdu_name', 'CoronalHoleMap'), header = True)
+	background = fits.getdata(background_image, config.getint('background_hdu_index', 1))
+	
+	size = None
+	if options.get('size'):
+		width, height = (int(value) for value in options['size'].lower().split('x'))
+		size = (height, width)
+	
+	color_table = get_aia_color_table(config.getint('aia_wavelength'))
+	
+	# The background is reduced before it is scaled, so that the percentiles and the stretch are computed on fewer pixels
+	background = scale_background(
+		resize_mean(numpy.nan_to_num(background.astype(numpy.float64), nan = 0.0), size or background.shape),
+		config.getfloat('background_min_percentile', 1),
+		config.getfloat('background_max_percentile', 99.9),
+		config.get('background_stretch', 'log')
+	)
+	
+	overlay = get_overlay(region_map, background, color_table, options, size, header)
+	write_image(output_file, overlay)
+	
+	if thumbnail_files:
+		write_thumbnails(overlay, thumbnail_files)
+	
+	return output_file
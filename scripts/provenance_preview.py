@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import os
+import re
+import html
+import shutil
+import logging
+import hashlib
+import tempfile
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from voprov.visualization.dot import prov_to_dot
+
+__all__ = ['get_graph_signature', 'get_graph_layout', 'get_preview_dot', 'write_preview_images', 'write_provenance_preview']
+
+# The provenance documents of all the cleaned maps have the same graph, only the labels change
+# So the graph is laid out by Graphviz only once per topology, and the layout is reused for the other documents
+# The images are then drawn by Graphviz from the positions of the layout, by batch of documents
+
+
+def unquote(value):
+	'''Remove the quotes of a pydot attribute value'''
+	value = str(value)
+	if len(value) >= 2 and value[0] == value[-1] == '"':
+		return value[1:-1]
+	return value
+
+
+def get_label_lines(label):
+	'''Return the lines of text of a dot label, HTML labels are reduced to their text'''
+	label = unquote(label or '')
+	if label.startswith('<') and label.endswith('>'):
+		# HTML label (e.g. the annotations of the records), one line per table row
+		label = re.sub(r'</TR>', '\n', label[1:-1], flags = re.IGNORECASE)
+		label = html.unescape(re.sub(r'<[^>]*>', ' ', label))
+		return [' '.join(line.split()) for line in label.split('\n') if line.strip()]
+	else:
+		return label.replace('\\n', '\n').replace('\\l', '\n').replace('\\r', '\n').split('\n')
+
+
+def get_graph_signature(dot):
+	'''Return a hash of the topology of a graph, i.e. everything but the text of the labels'''
+	signature = [unquote(dot.get_attributes().get('rankdir', ''))]
+	
+	for node in sorted(dot.get_nodes(), key = lambda node: unquote(node.get_name())):
+		attributes = node.get_attributes()
+		lines = get_label_lines(attributes.get('label', unquote(node.get_name())))
+		# The size of the nodes depends on the size of the labels, so labels of a very different size need a different layout
+		signature.append(('node', unquote(node.get_name()), unquote(attributes.get('shape', '')), len(lines), max(map(len, lines), default = 0) // 10))
+	
+	for edge in dot.get_edges():
+		signature.append(('edge', unquote(edge.get_source()), unquote(edge.get_destination()), unquote(edge.get_attributes().get('label', ''))))
+	
+	return hashlib.sha1(repr(signature).encode('utf8')).hexdigest()
+
+
+def parse_plain_layout(plain):
+	'''Parse the output of Graphviz in plain format, and return the size of the graph, the position and size of the nodes, and the control points of the edges'''
+	
+	layout = {'nodes': dict(), 'edges': dict()}
+	
+	for line in plain.splitlines():
+		tokens = line.split()
+		if not tokens:
+			continue
+		elif tokens[0] == 'graph':
+			layout['width'], layout['height'] = float(tokens[2]), float(tokens[3])
+		elif tokens[0] == 'node':
+			layout['nodes'][unquote(tokens[1])] = tuple(float(token) for token in tokens[2:6])
+		elif tokens[0] == 'edge':
+			tail, head, count = unquote(tokens[1]), unquote(tokens[2]), int(tokens[3])
+			points = [(float(tokens[4 + 2*i]), float(tokens[5 + 2*i])) for i in range(count)]
+			rest = tokens[4 + 2*count:]
+			# The rest is the optional label and its position, then the style and the color
+			label_position = (float(rest[-4]), float(rest[-3])) if len(rest) >= 4 else None
+			# There can be several edges between the same nodes, they are kept in order
+			layout['edges'].setdefault((tail, head), list()).append((points, label_position))
+	
+	return layout
+
+
+def get_graph_layout(dot):
+	'''Return the layout of the graph, computed by Graphviz only once for each topology'''
+	signature = get_graph_signature(dot)
+	
+	try:
+		return get_graph_layout.cache[signature]
+	except KeyError:
+		logging.debug('Computing layout for graph topology %s', signature)
+		layout = get_graph_layout.cache[signature] = parse_plain_layout(dot.create(prog = 'dot', format = 'plain').decode('utf8'))
+		return layout
+
+get_graph_layout.cache = dict()
+
+
+def set_layout(dot, layout):
+	'''Set the positions of the nodes and edges of the graph from a precomputed layout, so that Graphviz only draws the graph and does not lay it out'''
+	
+	for node in dot.get_nodes():
+		if unquote(node.get_name()) in layout['nodes']:
+			x, y, w, h = layout['nodes'][unquote(node.get_name())]
+			node.set('pos', '"%.2f,%.2f!"' % (x * 72, y * 72))
+			node.set('width', '%.4f' % w)
+			node.set('height', '%.4f' % h)
+			node.set('fixedsize', 'true')
+	
+	# Match the edges of the graph with the edges of the layout, in order for the edges between the same nodes
+	edge_counts = dict()
+	for edge in dot.get_edges():
+		key = (unquote(edge.get_source()), unquote(edge.get_destination()))
+		index = edge_counts[key] = edge_counts.get(key, -1) + 1
+		try:
+			points, label_position = layout['edges'][key][index]
+		except (KeyError, IndexError):
+			continue
+		edge.set('pos', '"%s"' % ' '.join('%.2f,%.2f' % (x * 72, y * 72) for x, y in points))
+		if label_position:
+			edge.set('lp', '"%.2f,%.2f"' % (label_position[0] * 72, label_position[1] * 72))
+	
+	dot.set('splines', 'true')
+	return dot
+
+
+def get_preview_dot(prov_doc):
+	'''Return the Graphviz source of the preview image of a provenance document, with the positions of the cached layout'''
+	dot = prov_to_dot(prov_doc, use_labels = True, direction = 'LR')
+	return set_layout(dot, get_graph_layout(dot)).to_string()
+
+
+def draw_previews(previews, image_format):
+	'''Draw the Graphviz sources of a batch of preview images with a single Graphviz process, previews being the source of each image file path'''
+	
+	with tempfile.TemporaryDirectory() as directory:
+		source_files = dict()
+		for i, (filepath, source) in enumerate(previews.items()):
+			source_file = os.path.join(directory, '%s.gv' % i)
+			with open(source_file, 'wt') as file:
+				file.write(source)
+			source_files[source_file] = filepath
+		
+		# neato -n2 uses the positions of the nodes and edges as they are, without computing a layout, and -O writes the image of each source file next to it
+		process = subprocess.run(['neato', '-n2', '-T' + image_format, '-O', *source_files], capture_output = True, text = True)
+		if process.returncode != 0:
+			raise RuntimeError('Graphviz could not draw the preview images: %s' % process.stderr.strip())
+		
+		for source_file, filepath in source_files.items():
+			Path(filepath).parent.mkdir(parents = True, exist_ok = True)
+			shutil.move(source_file + '.' + image_format, filepath)
+
+
+def write_preview_images(previews, batch_size = 200, thread_count = None):
+	'''Write preview images from their Graphviz sources, in SVG or PNG depending on the file extension, previews being the source of each image file path
+	The images are drawn by batch, each batch by a single Graphviz process, and the batches in parallel'''
+	
+	batches = list()
+	for image_format in ['svg', 'png']:
+		sources = [(filepath, source) for filepath, source in previews.items() if (Path(filepath).suffix.lower() == '.svg') == (image_format == 'svg')]
+		batches.extend((dict(sources[i:i + batch_size]), image_format) for i in range(0, len(sources), batch_size))
+	
+	with ThreadPoolExecutor(thread_count) as executor:
+		for job in [executor.submit(draw_previews, batch, image_format) for batch, image_format in batches]:
+			job.result()
+
+
+def write_provenance_preview(prov_doc, filepath):
+	'''Write a preview image of a provenance document, in SVG or PNG depending on the file extension'''
+	write_preview_images({filepath: get_preview_dot(prov_doc)})
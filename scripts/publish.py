@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import os
+import sys
+import gzip
+import json
+import shutil
+import logging
+import argparse
+from glob import glob
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import get_config, get_file_checksum
+
+__all__ = ['PublishManifest', 'get_changed_files', 'publish_file', 'publish']
+
+
+class PublishManifest:
+	'''The size, modification time and checksum of the files already published, by target root and by path relative to the source root'''
+	
+	def __init__(self, filepath):
+		self.filepath = Path(filepath)
+		try:
+			with gzip.open(self.filepath, 'rt') as file:
+				self.targets = json.load(file)
+		except FileNotFoundError:
+			logging.info('Publish manifest file %s does not exist yet, all files will be published', self.filepath)
+			self.targets = dict()
+	
+	@staticmethod
+	def get_target_key(target_root):
+		'''Return the key of a target root, so that the same directory given by different paths has the same files'''
+		return os.path.realpath(target_root)
+	
+	def get(self, target_root, relative_path):
+		return self.targets.get(self.get_target_key(target_root), {}).get(relative_path)
+	
+	def set(self, target_root, relative_path, size, mtime, checksum):
+		self.targets.setdefault(self.get_target_key(target_root), {})[relative_path] = {'size': size, 'mtime': mtime, 'checksum': checksum}
+	
+	def save(self):
+		'''Write the manifest to a temporary file and rename it, so that an interrupted publish does not corrupt the manifest'''
+		self.filepath.parent.mkdir(parents = True, exist_ok = True)
+		temporary_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+		with gzip.open(temporary_filepath, 'wt') as file:
+			json.dump(self.targets, file, separators = (',', ':'), sort_keys = True)
+		os.replace(temporary_filepath, self.filepath)
+
+
+def get_source_files(source_root, patterns):
+	'''Return the relative paths of the files under the source root matching the glob patterns'''
+	source_root = Path(source_root)
+	relative_paths = set()
+	for pattern in patterns:
+		for filepath in glob(str(source_root / pattern), recursive = True):
+			if os.path.isfile(filepath):
+				relative_paths.add(os.path.relpath(filepath, source_root))
+	return sorted(relative_paths)
+
+
+def get_changed_files(source_root, target_root, relative_paths, manifest, force = False):
+	'''Return the files whose size or modification time changed since they were published to the target root, with their size, modification time and published checksum
+	The checksums are only computed later by the publish jobs, so that unchanged files are not read'''
+	
+	changed_files = list()
+	for relative_path in relative_paths:
+		stat = os.stat(Path(source_root) / relative_path)
+		published = manifest.get(target_root, relative_path)
+		
+		if force or not published:
+			changed_files.append((relative_path, stat.st_size, stat.st_mtime, None))
+		elif published['size'] != stat.st_size or published['mtime'] != stat.st_mtime:
+			changed_files.append((relative_path, stat.st_size, stat.st_mtime, published['checksum']))
+	
+	return changed_files
+
+
+def publish_file(source_root, target_root, relative_path, published_checksum = None, dry_run = False):
+	'''Copy a file to the target root unless its checksum is the published checksum, and return its checksum and whether it needed to be copied
+	The file is copied to a temporary file renamed once complete so that the readers of the target never see a partial file'''
+	checksum = get_file_checksum(Path(source_root) / relative_path)
+	
+	# The file was rewritten with the same content, only the manifest needs updating
+	if checksum == published_checksum:
+		return checksum, False
+	
+	if not dry_run:
+		target_path = Path(target_root) / relative_path
+		target_path.parent.mkdir(parents = True, exist_ok = True)
+		temporary_path = target_path.with_name('.%s.tmp' % target_path.name)
+		try:
+			shutil.copy2(Path(source_root) / relative_path, temporary_path)
+			os.replace(temporary_path, target_path)
+		except BaseException:
+			temporary_path.unlink(missing_ok = True)
+			raise
+	
+	return checksum, True
+
+
+def publish(source_root, target_root, patterns, manifest, worker_count = 4, force = False, dry_run = False, save_interval = 1000):
+	'''Publish the new or changed files matching the patterns from the source root to the target root, and return the number of files published and failed'''
+	
+	relative_paths = get_source_files(source_root, patterns)
+	changed_files = get_changed_files(source_root, target_root, relative_paths, manifest, force)
+	
+	logging.info('%s files to check out of %s files matching the patterns', len(changed_files), len(relative_paths))
+	
+	published_count = failed_count = updated_count = 0
+	
+	# The checksums of the changed files are computed by the jobs, in parallel with the copies
+	with ThreadPoolExecutor(worker_count) as executor:
+		jobs = {executor.submit(publish_file, source_root, target_root, relative_path, published_checksum, dry_run): (relative_path, size, mtime) for relative_path, size, mtime, published_checksum in changed_files}
+		
+		for job in as_completed(jobs):
+			relative_path, size, mtime = jobs[job]
+			try:
+				checksum, copied = job.result()
+			except Exception as why:
+				logging.error('Could not publish %s: %s', relative_path, why)
+				failed_count += 1
+				continue
+			
+			if dry_run:
+				if copied:
+					logging.info('Would publish %s', relative_path)
+					published_count += 1
+				continue
+			
+			if copied:
+				logging.debug('Published %s to %s', relative_path, target_root)
+				published_count += 1
+			
+			manifest.set(target_root, relative_path, size, mtime, checksum)
+			updated_count += 1
+			
+			# The manifest is saved regularly, so that an interrupted publish does not start over
+			if updated_count % save_interval == 0:
+				manifest.save()
+	
+	if not dry_run:
+		manifest.save()
+	
+	return published_count, failed_count
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Publish the new or changed products and byproducts of the pipeline to the target root, keeping a manifest of the published files')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	parser.add_argument('--target-root', '-t', metavar = 'DIRPATH', help = 'The directory where to publish the files (default is the target_root of the PUBLISH section)')
+	parser.add_argument('--pattern', '-p', action = 'append', help = 'Glob pattern of the files to publish relative to the source root (default is the patterns of the PUBLISH section)')
+	parser.add_argument('--force', '-f', action = 'store_true', help = 'Publish all the files matching the patterns, even if they were already published')
+	parser.add_argument('--dry-run', '-n', action = 'store_true', help = 'Only show the files that would be published')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	target_root = args.target_root or config.get('PUBLISH', 'target_root')
+	if not target_root:
+		logging.error('No target root, set the target_root of the PUBLISH section or the --target-root option')
+		sys.exit(1)
+	
+	manifest = PublishManifest(config.get('PUBLISH', 'manifest_file'))
+	
+	published_count, failed_count = publish(
+		config.get('PUBLISH', 'source_root'),
+		target_root,
+		args.pattern or config.get('PUBLISH', 'patterns').split(),
+		manifest,
+		worker_count = config.getint('PUBLISH', 'worker_count', fallback = 4),
+		force = args.force,
+		dry_run = args.dry_run
+	)
+	
+	logging.info('%s %s files to %s, %s failed', 'Would publish' if args.dry_run else 'Published', published_count, target_root, failed_count)
+	
+	if failed_count:
+		sys.exit(1)
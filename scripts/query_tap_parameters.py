@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+from glob import glob
+from pathlib import Path
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy
+
+from region_catalog import datetime_to_jd, read_tap_parameters_from_csv
+from utils import get_config
+
+__all__ = ['load_table', 'RTree', 'TapParametersIndex', 'parse_adql']
+
+
+# The columns of the epn_core and tracking TAP parameters that are indexed, with their type
+EPN_CORE_COLUMNS = {
+	'granule_uid': str,
+	'granule_gid': str,
+	'obs_id': str,
+	'time_min': float,
+	'time_max': float,
+	'c1min': float,
+	'c1max': float,
+	'c2min': float,
+	'c2max': float,
+	'ch_c1_centroid': float,
+	'ch_c2_centroid': float,
+	'ch_area_projected': float,
+	'ch_area_deprojected': float,
+	'ch_area_pixels': int,
+}
+
+# The value of the missing integers, numpy integers have no NaN, same as the nullLiteral of the epn_core table
+INT_NULL = -9999
+
+# The kind of the numpy arrays of each type of column, to check the columns of the cache
+COLUMN_KINDS = {float: 'f', int: 'i', str: 'U'}
+
+TRACKING_COLUMNS = {
+	'previous': str,
+	'next': str,
+}
+
+OPERATORS = {
+	'=': numpy.equal,
+	'<>': numpy.not_equal,
+	'!=': numpy.not_equal,
+	'<': numpy.less,
+	'<=': numpy.less_equal,
+	'>': numpy.greater,
+	'>=': numpy.greater_equal,
+}
+
+ADQL_PATTERN = re.compile(r'^\s*SELECT\s+(?:TOP\s+(?P<top>\d+)\s+)?(?P<columns>.+?)\s+FROM\s+(?P<table>[\w.]+)(?:\s+WHERE\s+(?P<where>.+?))?\s*;?\s*$', re.IGNORECASE | re.DOTALL)
+
+# A string literal with the quotes escaped by doubling them, or the AND operator between 2 conditions
+LITERAL_OR_AND_PATTERN = re.compile(r"(?P<literal>'(?:[^']|'')*')|\s+AND\s+", re.IGNORECASE)
+
+CONDITION_PATTERN = re.compile(r"^\s*(?P<column>\w+)\s*(?P<operator><=|>=|<>|!=|=|<|>)\s*(?P<value>'(?:[^']|'')*'|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*$")
+
+
+def get_file_info(filepath):
+	'''Return the size and modification time of a file'''
+	stat = os.stat(filepath)
+	return int(stat.st_size), float(stat.st_mtime)
+
+
+def load_table(filepaths, columns, cache_file = None):
+	'''Return the columns of the rows of CSV files as numpy arrays, with the number of the file and of the row in the file of each row
+	If a cache file is given, only the files that changed since the cache was written are read, and the cache is updated'''
+	
+	filepaths = sorted(str(filepath) for filepath in filepaths)
+	file_infos = {filepath: get_file_info(filepath) for filepath in filepaths}
+	file_numbers = {filepath: number for number, filepath in enumerate(filepaths)}
+	
+	table = {name: list() for name in ['file_number', 'row_number', *columns]}
+	files_to_read = set(filepaths)
+	
+	# The rows of the files that did not change are taken from the cache
+	if cache_file and os.path.exists(cache_file):
+		try:
+			with numpy.load(cache_file) as cache:
+				cached_numbers = numpy.full(len(cache['files']), -1)
+				for number, (filepath, size, mtime) in enumerate(zip(cache['files'], cache['file_sizes'], cache['file_mtimes'])):
+					if file_infos.get(str(filepath)) == (int(size), float(mtime)):
+						cached_numbers[number] = file_numbers[str(filepath)]
+						files_to_read.discard(str(filepath))
+				kept = cached_numbers[cache['file_number']] >= 0
+				table['file_number'].append(cached_numbers[cache['file_number']][kept])
+				table['row_number'].append(cache['row_number'][kept])
+				for name, column_type in columns.items():
+					# A cache written when the column had another type must be read again
+					if cache[name].dtype.kind != COLUMN_KINDS[column_type]:
+						raise ValueError('column %s is not of type %s' % (name, column_type.__name__))
+					table[name].append(cache[name][kept])
+		except Exception as why:
+			logging.warning('Could not read cache file %s, all the files will be read: %s', cache_file, why)
+			table = {name: list() for name in ['file_number', 'row_number', *columns]}
+			files_to_read = set(filepaths)
+	
+	logging.info('Reading %s files out of %s', len(files_to_read), len(filepaths))
+	
+	for filepath in sorted(files_to_read):
+		records = read_tap_parameters_from_csv(filepath)
+		table['file_number'].append(numpy.full(len(records), file_numbers[filepath]))
+		table['row_number'].append(numpy.arange(len(records)))
+		for name, column_type in columns.items():
+			if column_type is float:
+				table[name].append(numpy.array([float(record.get(name) or 'nan') for record in records], dtype = float))
+			elif column_type is int:
+				# The integers can be written as floats, e.g. 12.0, by older versions of the pipeline
+				table[name].append(numpy.array([int(float(record[name])) if record.get(name) else INT_NULL for record in records], dtype = numpy.int64))
+			else:
+				table[name].append(numpy.array([record.get(name, '') for record in records], dtype = str))
+	
+	# The columns of an empty table still need the type of their values
+	types = {'file_number': int, 'row_number': int, **columns}
+	table = {name: numpy.concatenate(arrays) if arrays else numpy.array([], dtype = types[name]) for name, arrays in table.items()}
+	
+	if cache_file and files_to_read:
+		Path(cache_file).parent.mkdir(parents = True, exist_ok = True)
+		# Write to a temporary file and rename, so that a concurrent reader never sees a partial cache
+		temporary_file = str(cache_file) + '.tmp'
+		with open(temporary_file, 'wb') as file:
+			numpy.savez(file, files = numpy.array(filepaths, dtype = str), file_sizes = numpy.array([file_infos[filepath][0] for filepath in filepaths], dtype = numpy.int64), file_mtimes = numpy.array([file_infos[filepath][1] for filepath in filepaths], dtype = float), **table)
+		os.replace(temporary_file, cache_file)
+	
+	return filepaths, table
+
+
+class RTree:
+	'''Static R-tree of boxes, bulk loaded with the Sort-Tile-Recursive algorithm and searched one level at a time with numpy
+	The children of a node are contiguous in the level below, so the nodes of a level are only arrays of bounding boxes'''
+	
+	def __init__(self, x_min, x_max, y_min, y_max, node_size = 16):
+		self.node_size = node_size
+		count = len(x_min)
+		
+		# The boxes are sorted by x in vertical slices, and by y in each slice
+		leaf_count = -(-count // node_size)
+		slice_size = int(numpy.ceil(numpy.sqrt(leaf_count))) * node_size
+		by_x = numpy.argsort((x_min + x_max) / 2, kind = 'stable')
+		by_slice_and_y = numpy.lexsort((((y_min + y_max) / 2)[by_x], numpy.arange(count) // max(slice_size, 1)))
+		self.order = by_x[by_slice_and_y]
+		
+		self.boxes = numpy.stack([x_min, x_max, y_min, y_max], axis = 1)[self.order]
+		
+		# Each level has the bounding boxes of the groups of node_size nodes of the level below, up to a single root level
+		self.levels = list()
+		boxes = self.boxes
+		while len(boxes) > node_size:
+			starts = numpy.arange(0, len(boxes), node_size)
+			boxes = numpy.stack([numpy.minimum.reduceat(boxes[:, 0], starts), numpy.maximum.reduceat(boxes[:, 1], starts), numpy.minimum.reduceat(boxes[:, 2], starts), numpy.maximum.reduceat(boxes[:, 3], starts)], axis = 1)
+			self.levels.append(boxes)
+	
+	@staticmethod
+	def intersects(boxes, x_min, x_max, y_min, y_max):
+		return (boxes[:, 0] <= x_max) & (boxes[:, 1] >= x_min) & (boxes[:, 2] <= y_max) & (boxes[:, 3] >= y_min)
+	
+	def query(self, x_min = -numpy.inf, x_max = numpy.inf, y_min = -numpy.inf, y_max = numpy.inf):
+		'''Return the indices of the boxes that intersect a box'''
+		nodes = numpy.arange(len(self.levels[-1]) if self.levels else len(self.boxes))
+		
+		for level in range(len(self.levels) - 1, -1, -1):
+			nodes = nodes[self.intersects(self.levels[level][nodes], x_min, x_max, y_min, y_max)]
+			below_count = len(self.levels[level - 1]) if level > 0 else len(self.boxes)
+			nodes = (nodes[:, numpy.newaxis] * self.node_size + numpy.arange(self.node_size)).ravel()
+			nodes = nodes[nodes < below_count]
+		
+		return self.order[nodes[self.intersects(self.boxes[nodes], x_min, x_max, y_min, y_max)]]
+
+
+class TapParametersIndex:
+	'''In memory index of the epn_core and tracking TAP parameters CSV files, to search the regions by time, bounding box, granule_gid and area
+	The regions are indexed by time with a sorted array of time_min, by bounding box with a R-tree of the c1 and c2 boxes, and by granule_gid with a dict'''
+	
+	def __init__(self, epn_core_files, tracking_files = [], cache_directory = None):
+		self.files, self.columns = load_table(epn_core_files, EPN_CORE_COLUMNS, Path(cache_directory) / 'epn_core.npz' if cache_directory else None)
+		self.tracking_files, self.tracking_columns = load_table(tracking_files, TRACKING_COLUMNS, Path(cache_directory) / 'tracking.npz' if cache_directory else None)
+		self.count = len(self.columns['granule_uid'])
+		
+		# The time index, the duration of a region is used to search on time_max
+		self.time_order = numpy.argsort(self.columns['time_min'], kind = 'stable')
+		self.sorted_time_min = self.columns['time_min'][self.time_order]
+		self.time_rank = numpy.empty(self.count, dtype = numpy.int64)
+		self.time_rank[self.time_order] = numpy.arange(self.count)
+		durations = self.columns['time_max'] - self.columns['time_min']
+		self.max_duration = float(numpy.nanmax(durations)) if self.count else 0.
+		
+		self.rtree = RTree(self.columns['c1min'], self.columns['c1max'], self.columns['c2min'], self.columns['c2max'])
+		
+		# The regions of each granule_gid
+		gids, self.gid_codes = numpy.unique(self.columns['granule_gid'], return_inverse = True)
+		by_gid = numpy.argsort(self.gid_codes, kind = 'stable')
+		self.gid_regions = dict(zip(gids.tolist(), numpy.split(by_gid, numpy.cumsum(numpy.bincount(self.gid_codes, minlength = len(gids)))[:-1])))
+		
+		self.lineage = None
+		
+		logging.info('Indexed %s regions of %s files and %s tracking relations of %s files', self.count, len(self.files), len(self.tracking_columns['previous']), len(self.tracking_files))
+	
+	def get_lineage(self, granule_gid):
+		'''Return the granule_gid of the regions related to the regions of a granule_gid by tracking relations, e.g. when regions merge or split'''
+		if self.lineage is None:
+			# The graph of the granule_gid, with an edge for each tracking relation between regions of different granule_gid
+			gid_of_uid = dict(zip(self.columns['granule_uid'].tolist(), self.columns['granule_gid'].tolist()))
+			self.lineage = dict()
+			for previous_uid, next_uid in zip(self.tracking_columns['previous'].tolist(), self.tracking_columns['next'].tolist()):
+				previous_gid, next_gid = gid_of_uid.get(previous_uid), gid_of_uid.get(next_uid)
+				if previous_gid and next_gid and previous_gid != next_gid:
+					self.lineage.setdefault(previous_gid, set()).add(next_gid)
+					self.lineage.setdefault(next_gid, set()).add(previous_gid)
+		
+		related = {granule_gid}
+		queue = [granule_gid]
+		while queue:
+			for related_gid in self.lineage.get(queue.pop(), ()):
+				if related_gid not in related:
+					related.add(related_gid)
+					queue.append(related_gid)
+		return related
+	
+	def query(self, conditions = [], limit = None, lineage = False):
+		'''Return the indices of the regions that match all the conditions, sorted by time
+		A condition is a column, an operator and a value, the indexes select the candidates and the conditions are checked on the candidates'''
+		
+		for column, operator, value in conditions:
+			if column not in self.columns:
+				raise ValueError('Column %s is not indexed, must be one of %s' % (column, ', '.join(self.columns)))
+			if operator not in OPERATORS:
+				raise ValueError('Unknown operator %s' % operator)
+			# The values of the numpy arrays of strings can only be compared to strings, and the numbers to numbers
+			if self.columns[column].dtype.kind == 'U' and not isinstance(value, str):
+				raise ValueError('Column %s expects a string' % column)
+			if self.columns[column].dtype.kind != 'U' and (isinstance(value, bool) or not isinstance(value, (int, float))):
+				raise ValueError('Column %s expects a number' % column)
+		
+		candidates = None
+		
+		# The time index gives the range of time_min, a region ends at most max_duration after its time_min
+		time_min_lower, time_min_upper = -numpy.inf, numpy.inf
+		for column, operator, value in conditions:
+			if column == 'time_min' and operator in ('>', '>=', '='):
+				time_min_lower = max(time_min_lower, value)
+			if column == 'time_min' and operator in ('<', '<=', '='):
+				time_min_upper = min(time_min_upper, value)
+			if column == 'time_max' and operator in ('>', '>=', '='):
+				time_min_lower = max(time_min_lower, value - self.max_duration)
+			if column == 'time_max' and operator in ('<', '<=', '='):
+				time_min_upper = min(time_min_upper, value)
+		if time_min_lower > -numpy.inf or time_min_upper < numpy.inf:
+			first, last = numpy.searchsorted(self.sorted_time_min, time_min_lower, 'left'), numpy.searchsorted(self.sorted_time_min, time_min_upper, 'right')
+			candidates = numpy.sort(self.time_order[first:last])
+		
+		# The R-tree gives the regions whose box intersects the box of the conditions, the minimum of a box is lower than its maximum
+		box = {'x_min': -numpy.inf, 'x_max': numpy.inf, 'y_min': -numpy.inf, 'y_max': numpy.inf}
+		for column, operator, value in conditions:
+			if column in ('c1min', 'c1max') and operator in ('>', '>=', '='):
+				box['x_min'] = max(box['x_min'], value)
+			if column in ('c1min', 'c1max') and operator in ('<', '<=', '='):
+				box['x_max'] = min(box['x_max'], value)
+			if column in ('c2min', 'c2max') and operator in ('>', '>=', '='):
+				box['y_min'] = max(box['y_min'], value)
+			if column in ('c2min', 'c2max') and operator in ('<', '<=', '='):
+				box['y_max'] = min(box['y_max'], value)
+		if any(numpy.isfinite(value) for value in box.values()):
+			regions = numpy.sort(self.rtree.query(**box))
+			candidates = regions if candidates is None else numpy.intersect1d(candidates, regions, assume_unique = True)
+		
+		# The granule_gid index gives the regions of a granule_gid, and of the related granule_gid with the lineage
+		gids = {value for column, operator, value in conditions if column == 'granule_gid' and operator == '='}
+		if len(gids) > 1:
+			# A region has a single granule_gid, so no region matches 2 different granule_gid
+			return numpy.array([], dtype = numpy.int64)
+		if gids:
+			if lineage:
+				gids = set().union(*(self.get_lineage(gid) for gid in gids))
+			regions = numpy.sort(numpy.concatenate([self.gid_regions.get(gid, numpy.array([], dtype = numpy.int64)) for gid in gids]))
+			candidates = regions if candidates is None else numpy.intersect1d(candidates, regions, assume_unique = True)
+		
+		if candidates is None:
+			candidates = numpy.arange(self.count)
+		
+		# The conditions are checked exactly on the candidates, the granule_gid conditions are replaced by the lineage
+		for column, operator, value in conditions:
+			if column == 'granule_gid' and operator == '=':
+				continue
+			values = self.columns[column][candidates]
+			matches = OPERATORS[operator](values, value)
+			# The missing integers never match, like the NaN of the float columns
+			if values.dtype.kind == 'i':
+				matches &= values != INT_NULL
+			candidates = candidates[matches]
+		
+		candidates = candidates[numpy.argsort(self.time_rank[candidates])]
+		return candidates[:limit] if limit is not None else candidates
+	
+	def get_rows(self, indices, columns = ['*']):
+		'''Return the rows of the regions, with all the columns of the CSV files if columns is * or has a column that is not indexed'''
+		if columns != ['*'] and all(column in self.columns for column in columns):
+			return [{column: get_value(self.columns[column][index]) for column in columns} for index in indices]
+		
+		rows = [None] * len(indices)
+		positions = dict()
+		for position, index in enumerate(indices):
+			positions.setdefault(int(self.columns['file_number'][index]), list()).append((position, int(self.columns['row_number'][index])))
+		
+		for file, file_positions in positions.items():
+			records = read_tap_parameters_from_csv(self.files[file])
+			for position, row in file_positions:
+				rows[position] = records[row] if columns == ['*'] else {column: records[row].get(column, '') for column in columns}
+		
+		return rows
+
+
+def get_value(value):
+	'''Return a value of a column as a python value, with None for a missing integer'''
+	value = value.item()
+	return None if isinstance(value, int) and value == INT_NULL else value
+
+
+def split_conditions(where):
+	'''Split a WHERE clause on the AND operators that are not in a string literal'''
+	conditions = ['']
+	position = 0
+	# The string literals are matched first, so that an AND in a literal is kept in its condition
+	for match in LITERAL_OR_AND_PATTERN.finditer(where):
+		conditions[-1] += where[position:match.start()]
+		if match.group('literal') is not None:
+			conditions[-1] += match.group('literal')
+		else:
+			conditions.append('')
+		position = match.end()
+	conditions[-1] += where[position:]
+	return conditions
+
+
+def parse_adql(query):
+	'''Parse an ADQL query restricted to a conjunction of comparisons of a column to a literal, and return the columns, the table, the conditions and the limit'''
+	match = ADQL_PATTERN.match(query)
+	if match is None:
+		raise ValueError('Unsupported ADQL query, must be SELECT [TOP n] columns FROM table [WHERE condition AND condition ...]')
+	
+	columns = [column.strip() for column in match.group('columns').split(',')]
+	limit = int(match.group('top')) if match.group('top') else None
+	
+	conditions = list()
+	if match.group('where'):
+		for condition in split_conditions(match.group('where').strip()):
+			# The conditions can be enclosed in parenthesis
+			condition_match = CONDITION_PATTERN.match(condition.strip().lstrip('(').rstrip(')'))
+			if condition_match is None:
+				raise ValueError('Unsupported ADQL condition %s, must be column operator literal' % condition)
+			value = condition_match.group('value')
+			value = value[1:-1].replace("''", "'") if value.startswith("'") else float(value)
+			conditions.append((condition_match.group('column').lower(), condition_match.group('operator'), value))
+	
+	return columns, match.group('table'), conditions, limit
+
+
+class TapSyncRequestHandler(BaseHTTPRequestHandler):
+	'''Answer the synchronous TAP queries on the epn_core table, to test the TAP clients without a TAP server'''
+	
+	index = None
+	
+	def do_GET(self):
+		url = urlparse(self.path)
+		self.answer(url.path, parse_qs(url.query))
+	
+	def do_POST(self):
+		url = urlparse(self.path)
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8')
+		self.answer(url.path, {**parse_qs(url.query), **parse_qs(body)})
+	
+	def answer(self, path, parameters):
+		if path.rstrip('/') not in ('/sync', '/tap/sync'):
+			return self.send_text(404, 'Unknown path %s, the TAP sync endpoint is /tap/sync' % path)
+		
+		# The names of the TAP parameters are case insensitive
+		parameters = {name.upper(): values[-1] for name, values in parameters.items()}
+		
+		if parameters.get('REQUEST', 'doQuery') != 'doQuery' or parameters.get('LANG', 'ADQL').upper() != 'ADQL':
+			return self.send_text(400, 'Only REQUEST=doQuery with LANG=ADQL is supported')
+		
+		if 'QUERY' not in parameters:
+			return self.send_text(400, 'Missing QUERY parameter')
+		
+		try:
+			columns, table, conditions, limit = parse_adql(parameters['QUERY'])
+			if not table.lower().endswith('epn_core'):
+				raise ValueError('Unknown table %s, only the epn_core table can be queried' % table)
+			if parameters.get('MAXREC'):
+				limit = min(limit or int(parameters['MAXREC']), int(parameters['MAXREC']))
+			start = time.perf_counter()
+			rows = self.index.get_rows(self.index.query(conditions, limit), columns)
+			logging.info('Query %s returned %s rows in %.1f ms', parameters['QUERY'], len(rows), (time.perf_counter() - start) * 1000)
+		except ValueError as why:
+			return self.send_text(400, str(why))
+		
+		response_format = parameters.get('RESPONSEFORMAT', parameters.get('FORMAT', 'csv')).lower()
+		if response_format in ('json', 'application/json'):
+			self.send_body(200, 'application/json', json.dumps(rows))
+		elif response_format in ('csv', 'text/csv'):
+			self.send_body(200, 'text/csv', format_csv(rows))
+		else:
+			self.send_text(400, 'Unsupported format %s, must be csv or json' % response_format)
+	
+	def send_text(self, status, text):
+		self.send_body(status, 'text/plain', text + '\n')
+	
+	def send_body(self, status, content_type, body):
+		body = body.encode('utf8')
+		self.send_response(status)
+		self.send_header('Content-Type', content_type + '; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, format, *args):
+		logging.debug('%s %s', self.address_string(), format % args)
+
+
+def format_csv(rows):
+	'''Return the rows as CSV, with the columns in the order of first appearance'''
+	fieldnames = dict()
+	for row in rows:
+		fieldnames.update(dict.fromkeys(row))
+	
+	lines = list()
+	writer = csv.DictWriter(FileLines(lines), fieldnames = list(fieldnames), restval = '', lineterminator = '\n')
+	writer.writeheader()
+	writer.writerows(rows)
+	return ''.join(lines)
+
+
+class FileLines:
+	'''File-like object that appends the written strings to a list'''
+	
+	def __init__(self, lines):
+		self.write = lines.append
+
+
+def get_files(file_pattern):
+	'''Return the files matching a file pattern with a {date} placeholder'''
+	return glob(file_pattern.replace('{date}', '*'))
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Search the regions of the epn_core TAP parameters CSV files of the pipeline by time, bounding box, granule_gid lineage and area (query command), or answer synchronous TAP queries on them with a local HTTP endpoint (serve command)')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	
+	subparsers = parser.add_subparsers(dest = 'command', required = True)
+	
+	query_parser = subparsers.add_parser('query', help = 'Search the regions and write them as CSV or JSON')
+	query_parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of the time window, the regions that end before are not returned')
+	query_parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of the time window (exclusive), the regions that start after are not returned')
+	query_parser.add_argument('--box', nargs = 4, type = float, metavar = ('C1MIN', 'C1MAX', 'C2MIN', 'C2MAX'), help = 'Box in HPC coordinates in degrees, only the regions whose bounding box intersect it are returned')
+	query_parser.add_argument('--granule-gid', '-g', help = 'The granule_gid of the regions, e.g. spoca_coronalhole_198')
+	query_parser.add_argument('--lineage', '-l', action = 'store_true', help = 'Also return the regions whose granule_gid is related to the granule_gid by tracking relations, e.g. when regions merge or split')
+	query_parser.add_argument('--min-area', type = float, help = 'Minimum area of the regions, in the unit of the area column')
+	query_parser.add_argument('--max-area', type = float, help = 'Maximum area of the regions, in the unit of the area column')
+	query_parser.add_argument('--area-column', default = 'ch_area_deprojected', choices = ['ch_area_projected', 'ch_area_deprojected', 'ch_area_pixels'], help = 'The area column for the minimum and maximum area (default is ch_area_deprojected in km²)')
+	query_parser.add_argument('--adql', metavar = 'QUERY', help = 'An ADQL query on the epn_core table with a conjunction of comparisons of a column to a literal, instead of the other options')
+	query_parser.add_argument('--limit', '-n', type = int, help = 'Maximum number of regions to return')
+	query_parser.add_argument('--columns', nargs = '+', default = ['*'], help = 'The columns to return (default is all the columns of the CSV files)')
+	query_parser.add_argument('--format', '-f', choices = ['csv', 'json'], default = 'csv', help = 'The format of the output (default is csv)')
+	query_parser.add_argument('--output', '-o', metavar = 'FILEPATH', help = 'The file path for the output (default is the standard output)')
+	
+	serve_parser = subparsers.add_parser('serve', help = 'Answer synchronous TAP queries on the epn_core table at http://HOST:PORT/tap/sync')
+	serve_parser.add_argument('--host', help = 'The host of the HTTP endpoint (default is the host of the QUERY section)')
+	serve_parser.add_argument('--port', type = int, help = 'The port of the HTTP endpoint (default is the port of the QUERY section)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	start = time.perf_counter()
+	index = TapParametersIndex(
+		get_files(config.get('TAP_PARAMETERS', 'epn_core_output_file')),
+		get_files(config.get('TAP_PARAMETERS', 'tracking_output_file')),
+		config.get('QUERY', 'cache_directory', fallback = '') or None
+	)
+	logging.info('Loaded the index in %.1f s', time.perf_counter() - start)
+	
+	if args.command == 'query':
+		if args.adql:
+			columns, table, conditions, limit = parse_adql(args.adql)
+			limit = args.limit if limit is None else limit
+			if args.columns != ['*']:
+				columns = args.columns
+		else:
+			columns, limit = args.columns, args.limit
+			conditions = list()
+			# The time window and the box select the regions that overlap them
+			if args.start_date:
+				conditions.append(('time_max', '>=', datetime_to_jd(args.start_date)))
+			if args.end_date:
+				conditions.append(('time_min', '<', datetime_to_jd(args.end_date)))
+			if args.box:
+				c1min, c1max, c2min, c2max = args.box
+				conditions.extend([('c1max', '>=', c1min), ('c1min', '<=', c1max), ('c2max', '>=', c2min), ('c2min', '<=', c2max)])
+			if args.granule_gid:
+				conditions.append(('granule_gid', '=', args.granule_gid))
+			if args.min_area is not None:
+				conditions.append((args.area_column, '>=', args.min_area))
+			if args.max_area is not None:
+				conditions.append((args.area_column, '<=', args.max_area))
+		
+		start = time.perf_counter()
+		try:
+			indices = index.query(conditions, limit, args.lineage if not args.adql else False)
+		except ValueError as why:
+			logging.error('Invalid query: %s', why)
+			sys.exit(1)
+		logging.info('Found %s regions in %.1f ms', len(indices), (time.perf_counter() - start) * 1000)
+		
+		rows = index.get_rows(indices, columns)
+		output = json.dumps(rows, indent = 1) + '\n' if args.format == 'json' else format_csv(rows)
+		
+		if args.output:
+			with open(args.output, 'wt') as file:
+				file.write(output)
+		else:
+			sys.stdout.write(output)
+	
+	elif args.command == 'serve':
+		TapSyncRequestHandler.index = index
+		address = (args.host or config.get('QUERY', 'host', fallback = 'localhost'), args.port or config.getint('QUERY', 'port', fallback = 8080))
+		server = ThreadingHTTPServer(address, TapSyncRequestHandler)
+		logging.info('Answering TAP sync queries at http://%s:%s/tap/sync', *address)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import os
+import json
+import logging
+import argparse
+import hashlib
+import multiprocessing
+import numpy
+from datetime import datetime
+from glob import glob
+from pathlib import Path
+from astropy.io import fits
+
+from sdo_data import SdoData
+from get_longlived_regions_colors import read_regions_colors
+from get_epn_core_tap_parameters import get_epn_core_tap_parameters_from_file, REGIONS_HDU_NAME
+from get_tracking_tap_parameters import get_tracking_tap_parameters_from_file, TRACKING_HDU_NAME
+from get_datalink_tap_parameters import get_datalink_tap_parameters
+from region_index import get_index_file
+from tap_parameters_changes import PublishedState, write_tap_parameters_changes
+from executor import set_worker_data, call_with_worker_data
+from utils import get_config, date_to_filename, date_from_filename, get_thumbnail_files, get_file_checksum, write_tap_parameters_to_csv
+
+__all__ = ['Manifest', 'get_extractor_version', 'find_maps', 'reextract_tap_parameters']
+
+# The version of the TAP parameters extraction, to increase when a change outside of the extractor files, e.g. in utils.py, changes the TAP parameters
+EXTRACTOR_VERSION = 1
+
+# The source files of the TAP parameters extraction, a change to any of them requires to re-extract all the maps
+EXTRACTOR_FILES = [
+	Path(__file__).parent / 'get_epn_core_tap_parameters.py',
+	Path(__file__).parent / 'get_tracking_tap_parameters.py',
+	Path(__file__).parent / 'get_datalink_tap_parameters.py',
+	Path(__file__).parent / 'region_index.py',
+	Path(__file__).parent / 'region_polygons.py',
+	Path(__file__).parent / 'region_catalog.py',
+]
+
+
+class Manifest:
+	'''Record of the inputs and extractor version used to extract the TAP parameters of each map'''
+	
+	def __init__(self, filepath):
+		self.filepath = Path(filepath)
+		try:
+			with open(self.filepath, 'rt') as file:
+				self.entries = json.load(file)
+		except FileNotFoundError:
+			logging.info('Manifest file %s does not exist yet, all maps will be extracted', self.filepath)
+			self.entries = dict()
+	
+	def get(self, date):
+		return self.entries.get(date_to_filename(date))
+	
+	def set(self, date, entry):
+		self.entries[date_to_filename(date)] = entry
+	
+	def save(self):
+		'''Write the manifest to a temporary file and rename it, so that an interrupted run does not corrupt the manifest'''
+		self.filepath.parent.mkdir(parents = True, exist_ok = True)
+		temporary_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+		with open(temporary_filepath, 'wt') as file:
+			json.dump(self.entries, file, indent = 1, sort_keys = True)
+		os.replace(temporary_filepath, self.filepath)
+
+
+def get_extractor_version(config):
+	'''Return a checksum of the extractor version, of the extractor source files and of the TAP parameters config'''
+	checksum = hashlib.sha256(('version=%s\n' % EXTRACTOR_VERSION).encode('utf8'))
+	
+	for filepath in EXTRACTOR_FILES:
+		checksum.update(filepath.read_bytes())
+	
+	for key, value in sorted(config.items()):
+		checksum.update(('%s=%s\n' % (key, value)).encode('utf8'))
+	
+	return checksum.hexdigest()
+
+
+def get_colors_checksum(colors):
+	'''Return a checksum of a list of region colors'''
+	return hashlib.sha256(','.join(str(color) for color in sorted(colors)).encode('utf8')).hexdigest()
+
+
+def get_file_info(filepath):
+	'''Return the size and modification time of a file'''
+	if filepath is None:
+		return None
+	stat = os.stat(filepath)
+	return {'path': str(filepath), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def find_maps(file_pattern):
+	'''Return the files matching a file pattern with a {date} placeholder, indexed by date'''
+	maps = dict()
+	for filepath in sorted(glob(file_pattern.format(date = '*'))):
+		try:
+			maps[date_from_filename(filepath)] = Path(filepath)
+		except ValueError:
+			logging.warning('Skipping file %s: no date in file name', filepath)
+	return maps
+
+
+def get_map_colors(tracked_map):
+	'''Return all the region colors present in the regions and tracking relations of a tracked map'''
+	with fits.open(tracked_map) as hdulist:
+		colors = set(int(color) for color in hdulist[REGIONS_HDU_NAME].data['TRACKED_COLOR'])
+		tracking_relations = hdulist[TRACKING_HDU_NAME].data
+		colors.update(int(color) for color in tracking_relations['PAST_COLOR'])
+		colors.update(int(color) for color in tracking_relations['PRESENT_COLOR'])
+	return sorted(colors)
+
+
+def is_up_to_date(inputs, entry, extractor_version, regions_colors):
+	'''Check from the file sizes and modification times only if the map inputs and the extractor are unchanged since the last extraction'''
+	if entry is None or entry['extractor_version'] != extractor_version:
+		return False
+	
+	for name, filepath in inputs.items():
+		info = get_file_info(filepath)
+		previous_info = entry['inputs'].get(name)
+		if info is None or previous_info is None:
+			if info != previous_info:
+				return False
+		elif (info['path'], info['size'], info['mtime']) != (previous_info['path'], previous_info['size'], previous_info['mtime']):
+			return False
+	
+	return entry['selected_colors'] == get_colors_checksum(numpy.intersect1d(regions_colors, entry['colors']))
+
+
+def reextract_map(date, inputs, entry, extractor_version, regions_colors, aia_data, aia_wavelength, hmi_data, provenance_file_pattern, config):
+	'''Re-extract the TAP parameters of a map if its inputs or the extractor changed, and return the new manifest entry and the TAP parameters by table'''
+	
+	# Only compute the checksums of the files whose size or modification time has changed
+	new_inputs = dict()
+	for name, filepath in inputs.items():
+		info = get_file_info(filepath)
+		if info is not None:
+			previous_info = (entry or {}).get('inputs', {}).get(name)
+			if previous_info is not None and (info['path'], info['size'], info['mtime']) == (previous_info['path'], previous_info['size'], previous_info['mtime']):
+				info['checksum'] = previous_info['checksum']
+			else:
+				info['checksum'] = get_file_checksum(filepath)
+		new_inputs[name] = info
+	
+	colors = get_map_colors(inputs['tracked_map'])
+	
+	new_entry = {
+		'extractor_version': extractor_version,
+		'inputs': new_inputs,
+		'colors': colors,
+		'selected_colors': get_colors_checksum(numpy.intersect1d(regions_colors, colors)),
+	}
+	
+	if entry is not None and entry['extractor_version'] == extractor_version and entry['selected_colors'] == new_entry['selected_colors'] and all(
+		(info or {}).get('checksum') == (entry['inputs'].get(name) or {}).get('checksum') for name, info in new_inputs.items()
+	):
+		logging.debug('Content of inputs of map %s is unchanged, skipping extraction', inputs['cleaned_map'])
+		return new_entry, None
+	
+	logging.info('Re-extracting TAP parameters for map %s', inputs['cleaned_map'])
+	
+	epn_core_tap_parameters = get_epn_core_tap_parameters_from_file(inputs['tracked_map'], inputs['cleaned_map'], inputs['overlay_image'], inputs.get('index_file'), regions_colors, config)
+	write_tap_parameters_to_csv(epn_core_tap_parameters, config.get('epn_core_output_file').format(date = date_to_filename(date)))
+	
+	tracking_tap_parameters = get_tracking_tap_parameters_from_file(inputs['tracked_map'], regions_colors)
+	write_tap_parameters_to_csv(tracking_tap_parameters, config.get('tracking_output_file').format(date = date_to_filename(date)))
+	
+	provenance = provenance_file_pattern.format(date = date_to_filename(date))
+	granule_uids = [epn_core_tap_parameter['granule_uid'] for epn_core_tap_parameter in epn_core_tap_parameters]
+	thumbnail_files = {int(name[len('thumbnail_'):]): filepath for name, filepath in inputs.items() if name.startswith('thumbnail_')}
+	datalink_tap_parameters = get_datalink_tap_parameters(granule_uids, inputs['overlay_image'], aia_data.get_good_quality_file(date = date, wavelength = aia_wavelength), hmi_data.get_good_quality_file(date = date), provenance, config, thumbnail_files)
+	write_tap_parameters_to_csv(datalink_tap_parameters, config.get('datalink_output_file').format(date = date_to_filename(date)))
+	
+	return new_entry, {
+		'epn_core': epn_core_tap_parameters,
+		'tracking': tracking_tap_parameters,
+		'datalink': datalink_tap_parameters,
+	}
+
+
+def reextract_tap_parameters(manifest, tracked_maps, cleaned_maps, overlay_images, index_files, thumbnail_files, regions_colors, aia_data, aia_wavelength, hmi_data, provenance_file_pattern, config, force = False, dry_run = False):
+	'''Re-extract in parralel the TAP parameters of the maps whose inputs or extractor version changed'''
+	
+	extractor_version = get_extractor_version(config)
+	
+	candidates = dict()
+	
+	# As in the pipeline, TAP parameters are only extracted for the tracked maps that have a cleaned map
+	for date, cleaned_map in cleaned_maps.items():
+		try:
+			tracked_map = tracked_maps[date]
+		except KeyError:
+			logging.info('No tracked map found for map %s', cleaned_map)
+			continue
+		
+		inputs = {
+			'tracked_map': tracked_map,
+			'cleaned_map': cleaned_map,
+			'overlay_image': overlay_images.get(date),
+		}
+		
+		# The sparse region index of the cleaned map is an input of the polygons and coverages of the regions
+		index_file = index_files.get(date)
+		if index_file is not None and index_file.is_file():
+			inputs['index_file'] = index_file
+		
+		# The thumbnails of the overlay image are inputs too, so that the maps are re-extracted when the thumbnails are created
+		# A thumbnail not written, e.g. because it is not smaller than the overlay image, is an input without file
+		for size, thumbnail_file in thumbnail_files.get(date, {}).items():
+			inputs['thumbnail_%s' % size] = thumbnail_file if thumbnail_file.is_file() else None
+		
+		if force or not is_up_to_date(inputs, manifest.get(date), extractor_version, regions_colors):
+			candidates[date] = inputs
+	
+	logging.info('%s maps out of %s may need to be re-extracted', len(candidates), len(cleaned_maps))
+	
+	if dry_run:
+		for date, inputs in candidates.items():
+			print(inputs['cleaned_map'])
+		return {date: inputs['cleaned_map'] for date, inputs in candidates.items()}, dict()
+	
+	reextracted_maps = dict()
+	tap_parameters = {'epn_core': dict(), 'tracking': dict(), 'datalink': dict()}
+	
+	# The data that is the same for all maps is sent only once to each worker
+	worker_data = {
+		'extractor_version': extractor_version,
+		'regions_colors': regions_colors,
+		'aia_data': aia_data,
+		'aia_wavelength': aia_wavelength,
+		'hmi_data': hmi_data,
+		'provenance_file_pattern': provenance_file_pattern,
+		'config': config,
+	}
+	
+	with multiprocessing.Pool(initializer = set_worker_data, initargs = ({'reextract_map': worker_data},)) as pool:
+		jobs = dict()
+		
+		for date, inputs in candidates.items():
+			entry = None if force else manifest.get(date)
+			try:
+				jobs[date] = pool.apply_async(call_with_worker_data, ('reextract_map', reextract_map, date, inputs, entry))
+			except Exception as why:
+				logging.exception('Could not start job reextract_map : %s', why)
+		
+		try:
+			for date, job in jobs.items():
+				try:
+					entry, map_tap_parameters = job.get()
+				except Exception as why:
+					logging.exception('Could not re-extract TAP parameters for map %s : %s', candidates[date]['cleaned_map'], why)
+				else:
+					manifest.set(date, entry)
+					if map_tap_parameters is not None:
+						reextracted_maps[date] = candidates[date]['cleaned_map']
+						for table, records in map_tap_parameters.items():
+							tap_parameters[table][date] = records
+		finally:
+			# Save the manifest even if interrupted, so that the maps already done are not re-extracted
+			manifest.save()
+	
+	logging.info('Re-extracted TAP parameters for %s maps', len(reextracted_maps))
+	
+	return reextracted_maps, tap_parameters
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Re-extract the TAP parameters of the existing maps whose inputs or extractor version changed since the last extraction')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	parser.add_argument('--regions-colors', '-r', metavar = 'FILEPATH', nargs = '+', required = True, help = 'The path to the files with the list of regions color numbers for which to extract TAP parameters (e.g. one per year)')
+	parser.add_argument('--force', '-f', action = 'store_true', help = 'Re-extract all maps, even if unchanged')
+	parser.add_argument('--dry-run', '-n', action = 'store_true', help = 'Only print the maps that may need to be re-extracted')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	regions_colors = list()
+	for regions_colors_file in args.regions_colors:
+		try:
+			regions_colors.append(read_regions_colors(regions_colors_file))
+		except Exception as why:
+			logging.exception('Could not read regions colors from file %s: %s', regions_colors_file, why)
+			raise
+	
+	regions_colors = numpy.unique(numpy.concatenate(regions_colors))
+	
+	aia_data = SdoData(
+		file_pattern = config.get('AIA_DATA', 'file_pattern'),
+		hdu_name_or_index = config.getint('AIA_DATA', 'hdu_index'),
+		ignore_quality_bits = config.getintlist('AIA_DATA', 'ignore_quality_bits'),
+	)
+	
+	hmi_data = SdoData(
+		file_pattern = config.get('HMI_DATA', 'file_pattern'),
+		hdu_name_or_index = config.getint('HMI_DATA', 'hdu_index'),
+		ignore_quality_bits = config.getintlist('HMI_DATA', 'ignore_quality_bits'),
+	)
+	
+	manifest = Manifest(config.get('TAP_PARAMETERS', 'manifest_file'))
+	
+	tracked_maps = find_maps(config.get('GET_REGION_MAP', 'output_file'))
+	cleaned_maps = find_maps(config.get('LIFESPAN_CLEANING', 'output_file'))
+	overlay_images = find_maps(config.get('GET_OVERLAY_IMAGE', 'output_file'))
+	index_files = {date: get_index_file(date, config['LIFESPAN_CLEANING']) for date in cleaned_maps}
+	thumbnail_files = {date: get_thumbnail_files(overlay_image, config['GET_OVERLAY_IMAGE']) for date, overlay_image in overlay_images.items()}
+	
+	reextracted_maps, tap_parameters = reextract_tap_parameters(manifest, tracked_maps, cleaned_maps, overlay_images, index_files, thumbnail_files, regions_colors, aia_data, config.getint('GET_REGION_MAP', 'aia_wavelength'), hmi_data, config.get('PROVENANCE', 'output_file'), config['TAP_PARAMETERS'], force = args.force, dry_run = args.dry_run)
+	
+	if not args.dry_run:
+		published_state = PublishedState(config.get('TAP_PARAMETERS', 'published_state_file'))
+		run = date_to_filename(datetime.utcnow())
+		
+		for table, table_tap_parameters in tap_parameters.items():
+			try:
+				write_tap_parameters_changes(table_tap_parameters, table, published_state, config.get('TAP_PARAMETERS', 'changes_output_file'), run)
+			except Exception as why:
+				logging.exception('Error while writing TAP parameters changes for table %s : %s', table, why)
+		
+		published_state.save()
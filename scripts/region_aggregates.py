@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import os
+import sys
+import csv
+import json
+import math
+import sqlite3
+import logging
+import argparse
+from contextlib import closing
+from pathlib import Path
+
+from region_catalog import read_tap_parameters_from_csv
+from utils import get_config, date_from_filename
+
+__all__ = ['get_map_aggregate', 'RegionAggregates', 'write_series_to_csv']
+
+
+# The levels of the aggregates, with the column of the map aggregates that gives the key of each level
+LEVELS = {
+	'map': 'date',
+	'day': 'day',
+	'rotation': 'carrington_rotation',
+}
+
+# The sums of the map aggregates that are summed again for the day and rotation aggregates
+SUM_COLUMNS = ['region_count', 'area_projected', 'area_deprojected', 'area_pixels', 'aia_sample_size', 'aia_intensity_sum', 'hmi_sample_size', 'hmi_intensity_sum']
+
+
+def get_float(record, name):
+	'''Return the value of a column of a TAP parameters record as a float, or None if it is missing'''
+	try:
+		value = float(record[name])
+	except (KeyError, TypeError, ValueError):
+		return None
+	return value if math.isfinite(value) else None
+
+
+def get_carrington_rotation(date):
+	'''Return the number of the Carrington rotation of a date'''
+	# Imported here because sunpy is slow to import and not needed to read the aggregates
+	from sunpy.coordinates.sun import carrington_rotation_number
+	return int(carrington_rotation_number(date))
+
+
+def get_map_aggregate(date, tap_parameters, failed = False):
+	'''Return the sums over the regions of a map of the area and of the intensity of the AIA and HMI stats
+	The intensity sums are the means of the regions weighted by their sample size, so that the mean intensity of several regions or maps is the mean over all their pixels
+	A map whose TAP parameters could not be extracted is marked as failed, with sums of 0'''
+	aggregate = {
+		'date': date.isoformat(),
+		'day': date.date().isoformat(),
+		'carrington_rotation': get_carrington_rotation(date),
+		'failed': int(failed),
+		**dict.fromkeys(SUM_COLUMNS, 0),
+	}
+	
+	for record in tap_parameters:
+		aggregate['region_count'] += 1
+		for column in ['area_projected', 'area_deprojected', 'area_pixels']:
+			aggregate[column] += get_float(record, 'ch_' + column) or 0
+		
+		# The regions without stats do not count in the mean intensity
+		for instrument in ['aia', 'hmi']:
+			sample_size = get_float(record, 'ch_stat_%s_sample_size' % instrument)
+			mean = get_float(record, 'ch_stat_%s_mean' % instrument)
+			if sample_size and mean is not None:
+				aggregate[instrument + '_sample_size'] += sample_size
+				aggregate[instrument + '_intensity_sum'] += mean * sample_size
+	
+	return aggregate
+
+
+class RegionAggregates:
+	'''SQLite tables of the aggregates of the regions per map, per day and per Carrington rotation
+	The map aggregates are replaced when a map is updated, and only the days and rotations of the updated maps are computed again from the map aggregates
+	The maps that failed are counted in the days and rotations, so that the days and rotations with missing maps are flagged as incomplete'''
+	
+	SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS map_aggregate (
+			date TEXT PRIMARY KEY,
+			day TEXT NOT NULL,
+			carrington_rotation INTEGER NOT NULL,
+			failed INTEGER NOT NULL,
+			region_count INTEGER NOT NULL,
+			area_projected REAL NOT NULL,
+			area_deprojected REAL NOT NULL,
+			area_pixels REAL NOT NULL,
+			aia_sample_size REAL NOT NULL,
+			aia_intensity_sum REAL NOT NULL,
+			hmi_sample_size REAL NOT NULL,
+			hmi_intensity_sum REAL NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS map_aggregate_day ON map_aggregate (day);
+		CREATE INDEX IF NOT EXISTS map_aggregate_carrington_rotation ON map_aggregate (carrington_rotation);
+		CREATE TABLE IF NOT EXISTS day_aggregate (
+			day TEXT PRIMARY KEY,
+			map_count INTEGER NOT NULL,
+			failed_count INTEGER NOT NULL,
+			region_count INTEGER NOT NULL,
+			area_projected REAL NOT NULL,
+			area_deprojected REAL NOT NULL,
+			area_pixels REAL NOT NULL,
+			aia_sample_size REAL NOT NULL,
+			aia_intensity_sum REAL NOT NULL,
+			hmi_sample_size REAL NOT NULL,
+			hmi_intensity_sum REAL NOT NULL
+		);
+		CREATE TABLE IF NOT EXISTS rotation_aggregate (
+			carrington_rotation INTEGER PRIMARY KEY,
+			map_count INTEGER NOT NULL,
+			failed_count INTEGER NOT NULL,
+			region_count INTEGER NOT NULL,
+			area_projected REAL NOT NULL,
+			area_deprojected REAL NOT NULL,
+			area_pixels REAL NOT NULL,
+			aia_sample_size REAL NOT NULL,
+			aia_intensity_sum REAL NOT NULL,
+			hmi_sample_size REAL NOT NULL,
+			hmi_intensity_sum REAL NOT NULL
+		);
+	'''
+	
+	# Maximum number of parameters of a query
+	BATCH_SIZE = 500
+	
+	# Time in seconds to wait for the database to be unlocked by another process
+	TIMEOUT = 60
+	
+	def __init__(self, filepath):
+		self.filepath = Path(filepath)
+		self.filepath.parent.mkdir(parents = True, exist_ok = True)
+		
+		self.connection = sqlite3.connect(self.filepath, timeout = self.TIMEOUT)
+		self.connection.execute('PRAGMA journal_mode = WAL')
+		self.connection.executescript(self.SCHEMA)
+	
+	def update(self, tap_parameters, failed_dates = ()):
+		'''Update the aggregates with the epn_core TAP parameters records of maps, given as a dict date: records, and with the dates of the maps whose TAP parameters could not be extracted'''
+		aggregates = [get_map_aggregate(date, records) for date, records in tap_parameters.items()]
+		failed_aggregates = [get_map_aggregate(date, [], failed = True) for date in failed_dates if date not in tap_parameters]
+		if not aggregates and not failed_aggregates:
+			return 0
+		
+		columns = ['date', 'day', 'carrington_rotation', 'failed', *SUM_COLUMNS]
+		insert = 'INTO map_aggregate (%s) VALUES (%s)' % (', '.join(columns), ', '.join('?' * len(columns)))
+		with self.connection:
+			self.connection.executemany('INSERT OR REPLACE ' + insert, [[aggregate[column] for column in columns] for aggregate in aggregates])
+			# A failed map keeps the aggregate of a previous extraction if there is one
+			self.connection.executemany('INSERT OR IGNORE ' + insert, [[aggregate[column] for column in columns] for aggregate in failed_aggregates])
+			
+			# The days and rotations of the updated maps are computed again from all their maps, the sums of the failed maps are 0
+			sums = ', '.join('SUM(%s)' % column for column in SUM_COLUMNS)
+			for table, key in [('day_aggregate', 'day'), ('rotation_aggregate', 'carrington_rotation')]:
+				keys = sorted({aggregate[key] for aggregate in aggregates + failed_aggregates})
+				for batch in range(0, len(keys), self.BATCH_SIZE):
+					batch_keys = keys[batch:batch + self.BATCH_SIZE]
+					self.connection.execute('INSERT OR REPLACE INTO %s (%s, map_count, failed_count, %s) SELECT %s, COUNT(*) - SUM(failed), SUM(failed), %s FROM map_aggregate WHERE %s IN (%s) GROUP BY %s' % (table, key, ', '.join(SUM_COLUMNS), key, sums, key, ','.join('?' * len(batch_keys)), key), batch_keys)
+		
+		return len(aggregates)
+	
+	def get_series(self, level = 'day', start = None, end = None):
+		'''Return the time series of the aggregates of a level, between the start key (inclusive) and the end key (exclusive)
+		The area and region counts are the totals of a map, averaged over the maps of the day or rotation, and the intensities are the means over the pixels of the regions
+		The aggregates with failed maps are flagged as incomplete, the means are only over the maps that did not fail'''
+		
+		if level not in LEVELS:
+			raise ValueError('Unknown level %s, must be one of %s' % (level, ', '.join(LEVELS)))
+		key = LEVELS[level]
+		table = level + '_aggregate'
+		map_count = '1 - failed' if level == 'map' else 'map_count'
+		failed_count = 'failed' if level == 'map' else 'failed_count'
+		
+		conditions = list()
+		parameters = list()
+		if start is not None:
+			conditions.append('%s >= ?' % key)
+			parameters.append(start)
+		if end is not None:
+			conditions.append('%s < ?' % key)
+			parameters.append(end)
+		
+		rows = self.connection.execute('SELECT %s, %s, %s, %s FROM %s %s ORDER BY %s' % (key, map_count, failed_count, ', '.join(SUM_COLUMNS), table, ('WHERE ' + ' AND '.join(conditions)) if conditions else '', key), parameters)
+		
+		series = list()
+		for row in rows:
+			row_key, map_count, failed_count, sums = row[0], row[1], row[2], dict(zip(SUM_COLUMNS, row[3:]))
+			series.append({
+				key: row_key,
+				'map_count': map_count,
+				'failed_count': failed_count,
+				'incomplete': failed_count > 0,
+				'region_count': sums['region_count'],
+				'mean_region_count': sums['region_count'] / map_count if map_count else None,
+				'mean_area_projected': sums['area_projected'] / map_count if map_count else None,
+				'mean_area_deprojected': sums['area_deprojected'] / map_count if map_count else None,
+				'mean_area_pixels': sums['area_pixels'] / map_count if map_count else None,
+				'aia_mean_intensity': sums['aia_intensity_sum'] / sums['aia_sample_size'] if sums['aia_sample_size'] else None,
+				'hmi_mean_intensity': sums['hmi_intensity_sum'] / sums['hmi_sample_size'] if sums['hmi_sample_size'] else None,
+			})
+		return series
+	
+	def close(self):
+		self.connection.close()
+
+
+def write_series_to_csv(series, filepath):
+	'''Write a time series of aggregates to a CSV file'''
+	Path(filepath).parent.mkdir(parents = True, exist_ok = True)
+	# Write to a temporary file and rename, so that a reader never sees a partial series
+	temporary_file = str(filepath) + '.tmp'
+	with open(temporary_file, 'wt', newline = '') as file:
+		writer = csv.DictWriter(file, fieldnames = list(series[0]) if series else [], restval = '', lineterminator = '\n')
+		writer.writeheader()
+		writer.writerows(series)
+	os.replace(temporary_file, filepath)
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Update the aggregates of the regions per map, day and Carrington rotation with epn_core TAP parameters CSV files (update command), or write the time series of the aggregates of a level (series command)')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	
+	subparsers = parser.add_subparsers(dest = 'command', required = True)
+	
+	update_parser = subparsers.add_parser('update', help = 'Update the aggregates with epn_core TAP parameters CSV files, the date of each map is taken from the file name')
+	update_parser.add_argument('csv_files', metavar = 'FILEPATH', nargs = '+', help = 'The paths to epn_core TAP parameters CSV files')
+	
+	series_parser = subparsers.add_parser('series', help = 'Write the time series of the aggregates of a level as CSV or JSON')
+	series_parser.add_argument('--level', '-l', choices = list(LEVELS), default = 'day', help = 'The level of the aggregates (default is day)')
+	series_parser.add_argument('--start', '-s', help = 'The first date, day (YYYY-MM-DD) or Carrington rotation number of the series')
+	series_parser.add_argument('--end', '-e', help = 'The date, day (YYYY-MM-DD) or Carrington rotation number after the end of the series')
+	series_parser.add_argument('--format', '-f', choices = ['csv', 'json'], default = 'csv', help = 'The format of the output (default is csv)')
+	series_parser.add_argument('--output', '-o', metavar = 'FILEPATH', help = 'The file path for the output (default is the standard output)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	with closing(RegionAggregates(config.get('REGION_AGGREGATES', 'database_file'))) as aggregates:
+		
+		if args.command == 'update':
+			tap_parameters = dict()
+			failed_dates = list()
+			for csv_file in args.csv_files:
+				date = date_from_filename(Path(csv_file).name)
+				try:
+					tap_parameters[date] = read_tap_parameters_from_csv(csv_file)
+				except Exception as why:
+					logging.exception('Could not read regions of file %s: %s', csv_file, why)
+					failed_dates.append(date)
+			
+			count = aggregates.update(tap_parameters, failed_dates)
+			logging.info('Updated the aggregates of %s maps, %s maps failed', count, len(failed_dates))
+		
+		elif args.command == 'series':
+			# The keys of the rotation level are numbers
+			start, end = args.start, args.end
+			if args.level == 'rotation':
+				start, end = int(start) if start else None, int(end) if end else None
+			
+			series = aggregates.get_series(args.level, start, end)
+			
+			if args.format == 'json':
+				output = json.dumps(series, indent = 1)
+				if args.output:
+					with open(args.output, 'wt') as file:
+						file.write(output + '\n')
+				else:
+					print(output)
+			elif args.output:
+				write_series_to_csv(series, args.output)
+			else:
+				writer = csv.DictWriter(sys.stdout, fieldnames = list(series[0]) if series else [], restval = '', lineterminator = '\n')
+				writer.writeheader()
+				writer.writerows(series)
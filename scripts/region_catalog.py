@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+import csv
+import math
+import time
+import sqlite3
+import logging
+import argparse
+from contextlib import closing
+from pathlib import Path
+from datetime import datetime
+import numpy
+
+from utils import get_config
+
+__all__ = ['get_healpix_cells', 'get_moc', 'format_moc', 'parse_moc', 'get_moc_ranges', 'get_region_coverages', 'get_box_cells', 'RegionCatalog']
+
+
+# The Julian date of the J2000 epoch
+J2000_DATETIME = datetime(2000, 1, 1, 12)
+J2000_JD = 2451545.0
+
+
+def spread_bits(values):
+	'''Return the values with a 0 bit inserted before each of their 32 lower bits'''
+	values = values.astype(numpy.uint64)
+	for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+		values = (values | (values << numpy.uint64(shift))) & numpy.uint64(mask)
+	return values
+
+
+def get_healpix_cells(longitudes, latitudes, order):
+	'''Return the HEALPix cells in the nested scheme at order of the points with longitude and latitude in degrees'''
+	nside = 1 << order
+	z = numpy.sin(numpy.radians(latitudes))
+	z_abs = numpy.abs(z)
+	tt = numpy.mod(numpy.radians(longitudes) / (math.pi / 2), 4.)
+	
+	face = numpy.empty(len(z), dtype = numpy.int64)
+	x = numpy.empty(len(z), dtype = numpy.int64)
+	y = numpy.empty(len(z), dtype = numpy.int64)
+	
+	# Equatorial region
+	equatorial = z_abs <= 2 / 3
+	temp1 = nside * (0.5 + tt[equatorial])
+	temp2 = nside * z[equatorial] * 0.75
+	ascending = (temp1 - temp2).astype(numpy.int64)
+	descending = (temp1 + temp2).astype(numpy.int64)
+	ascending_face = ascending >> order
+	descending_face = descending >> order
+	face[equatorial] = numpy.where(ascending_face == descending_face, ascending_face | 4, numpy.where(ascending_face < descending_face, ascending_face, descending_face + 8))
+	x[equatorial] = descending & (nside - 1)
+	y[equatorial] = nside - (ascending & (nside - 1)) - 1
+	
+	# Polar regions
+	polar = ~equatorial
+	ntt = numpy.minimum(3, tt[polar].astype(numpy.int64))
+	tp = tt[polar] - ntt
+	tmp = nside * numpy.sqrt(3 * (1 - z_abs[polar]))
+	ascending = numpy.minimum((tp * tmp).astype(numpy.int64), nside - 1)
+	descending = numpy.minimum(((1 - tp) * tmp).astype(numpy.int64), nside - 1)
+	north = z[polar] >= 0
+	face[polar] = numpy.where(north, ntt, ntt + 8)
+	x[polar] = numpy.where(north, nside - descending - 1, ascending)
+	y[polar] = numpy.where(north, nside - ascending - 1, descending)
+	
+	return (face.astype(numpy.uint64) << numpy.uint64(2 * order)) + spread_bits(x) + (spread_bits(y) << numpy.uint64(1))
+
+
+def get_moc(cells, order):
+	'''Return the multi-order coverage of HEALPix cells at order, as a dict of order to sorted cells, where each complete group of 4 sibling cells is replaced by their parent'''
+	cells = numpy.unique(cells)
+	moc = dict()
+	for cell_order in range(order, 0, -1):
+		parents, counts = numpy.unique(cells >> numpy.uint64(2), return_counts = True)
+		complete_parents = parents[counts == 4]
+		moc[cell_order] = cells[~numpy.isin(cells >> numpy.uint64(2), complete_parents)]
+		cells = complete_parents
+	moc[0] = cells
+	return {cell_order: cells for cell_order, cells in sorted(moc.items()) if len(cells)}
+
+
+def format_moc(moc):
+	'''Return the IVOA MOC ASCII serialization of a multi-order coverage, e.g. 3/1-3,8 4/65'''
+	orders = list()
+	for order, cells in moc.items():
+		# Consecutive cells are written as a range
+		breaks = numpy.flatnonzero(numpy.diff(cells.astype(numpy.int64)) != 1) + 1
+		ranges = [(int(run[0]), int(run[-1])) for run in numpy.split(cells, breaks)]
+		orders.append('%s/%s' % (order, ','.join(str(first) if first == last else '%s-%s' % (first, last) for first, last in ranges)))
+	return ' '.join(orders)
+
+
+def parse_moc(moc_string):
+	'''Return the multi-order coverage of an IVOA MOC ASCII serialization'''
+	moc = dict()
+	order = None
+	for token in moc_string.replace(',', ' ').split():
+		if '/' in token:
+			order, token = token.split('/')
+			order = int(order)
+			if not token:
+				continue
+		first, _, last = token.partition('-')
+		moc.setdefault(order, list()).extend(range(int(first), int(last or first) + 1))
+	return {order: numpy.array(sorted(cells), dtype = numpy.uint64) for order, cells in moc.items()}
+
+
+def get_moc_ranges(moc, order):
+	'''Return the ranges of cells at order covered by a multi-order coverage, as arrays of first (inclusive) and last (exclusive) cells
+	The cells of a higher order than order are replaced by their parent, so the ranges cover at least the coverage'''
+	firsts = list()
+	lasts = list()
+	for cell_order, cells in moc.items():
+		if cell_order <= order:
+			shift = numpy.uint64(2 * (order - cell_order))
+			firsts.append(cells << shift)
+			lasts.append((cells + numpy.uint64(1)) << shift)
+		else:
+			parents = numpy.unique(cells >> numpy.uint64(2 * (cell_order - order)))
+			firsts.append(parents)
+			lasts.append(parents + numpy.uint64(1))
+	return numpy.concatenate(firsts), numpy.concatenate(lasts)
+
+
+def get_region_coverages(map, region_index, colors, order = 8, frame = 'carrington', stride = 2):
+	'''Return the coverage of each region of a sparse region index in heliographic coordinates, as IVOA MOC ASCII strings of HEALPix cells in the nested scheme
+	Only one in stride pixels in each direction is used, and the pixels of all the regions are converted to heliographic coordinates with a single transform'''
+	
+	# Imported here because sunpy is slow to import and not needed by the catalog queries
+	from astropy import units
+	from sunpy.coordinates import frames
+	
+	pixels = dict()
+	for color in colors:
+		if color not in region_index:
+			continue
+		y, x = region_index.get_pixels(color)
+		selected = (x % stride == 0) & (y % stride == 0)
+		# A region smaller than the stride keeps all its pixels
+		if selected.any():
+			y, x = y[selected], x[selected]
+		pixels[color] = (x, y)
+	
+	if not pixels:
+		return dict()
+	
+	colors = list(pixels)
+	x = numpy.concatenate([pixels[color][0] for color in colors])
+	y = numpy.concatenate([pixels[color][1] for color in colors])
+	
+	if frame == 'carrington':
+		heliographic_frame = frames.HeliographicCarrington(observer = map.observer_coordinate, obstime = map.date)
+	elif frame == 'stonyhurst':
+		heliographic_frame = frames.HeliographicStonyhurst(obstime = map.date)
+	else:
+		raise ValueError('Unknown heliographic frame %s, must be carrington or stonyhurst' % frame)
+	
+	heliographic = map.pixel_to_world(x * units.pixel, y * units.pixel).transform_to(heliographic_frame)
+	lon = heliographic.lon.to(units.degree).value
+	lat = heliographic.lat.to(units.degree).value
+	
+	# The pixels off the disk have no heliographic coordinates, only the pixels on the disk are converted to cells so that NaN are not cast to integers
+	on_disk = numpy.isfinite(lon) & numpy.isfinite(lat)
+	cells = numpy.zeros(len(lon), dtype = numpy.uint64)
+	cells[on_disk] = get_healpix_cells(lon[on_disk], lat[on_disk], order)
+	
+	coverages = dict()
+	for color, region_cells, region_on_disk in zip(colors, *[numpy.split(values, numpy.cumsum([len(pixels[color][0]) for color in colors])[:-1]) for values in (cells, on_disk)]):
+		if region_on_disk.any():
+			coverages[color] = format_moc(get_moc(region_cells[region_on_disk], order))
+	
+	return coverages
+
+
+def get_cell_size(order):
+	'''Return the approximate size in degrees of a HEALPix cell at order'''
+	return math.degrees(math.sqrt(4 * math.pi / (12 * 4 ** order)))
+
+
+def get_box_cells(lon_min, lon_max, lat_min, lat_max, order):
+	'''Return the sorted HEALPix cells at order that intersect a box in heliographic coordinates in degrees, by sampling the box finer than the cells
+	If lon_min is larger than lon_max, the box wraps around longitude 360'''
+	if lon_max < lon_min:
+		lon_max += 360
+	step = get_cell_size(order) / 2
+	longitudes = numpy.linspace(lon_min, lon_max, max(2, math.ceil((lon_max - lon_min) / step) + 1))
+	latitudes = numpy.linspace(lat_min, lat_max, max(2, math.ceil((lat_max - lat_min) / step) + 1))
+	longitudes, latitudes = numpy.meshgrid(longitudes, latitudes)
+	return numpy.unique(get_healpix_cells(longitudes.ravel(), latitudes.ravel(), order))
+
+
+def datetime_to_jd(date):
+	'''Return the Julian date of a datetime'''
+	return J2000_JD + (date - J2000_DATETIME).total_seconds() / 86400
+
+
+class RegionCatalog:
+	'''SQLite catalog of the regions with their heliographic coverage, for spatial and temporal searches
+	The coverage of each region is indexed by its HEALPix cells at index_order, a low order so that a region has few index cells, and the exact coverage is checked on the candidates'''
+	
+	SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS region (
+			granule_uid TEXT PRIMARY KEY,
+			granule_gid TEXT NOT NULL,
+			time_min REAL NOT NULL,
+			time_max REAL NOT NULL,
+			coverage_moc TEXT NOT NULL
+		);
+		CREATE INDEX IF NOT EXISTS region_time_min ON region (time_min);
+		CREATE TABLE IF NOT EXISTS region_cell (
+			cell INTEGER NOT NULL,
+			time_min REAL NOT NULL,
+			granule_uid TEXT NOT NULL,
+			PRIMARY KEY (cell, time_min, granule_uid)
+		) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS region_cell_granule_uid ON region_cell (granule_uid);
+	'''
+	
+	# Maximum number of parameters of a query
+	BATCH_SIZE = 500
+	
+	# Time in seconds to wait for the database to be unlocked by another process
+	TIMEOUT = 60
+	
+	def __init__(self, filepath, index_order = 5):
+		self.filepath = Path(filepath)
+		self.filepath.parent.mkdir(parents = True, exist_ok = True)
+		self.index_order = index_order
+		
+		self.connection = sqlite3.connect(self.filepath, timeout = self.TIMEOUT)
+		self.connection.execute('PRAGMA journal_mode = WAL')
+		self.connection.executescript(self.SCHEMA)
+	
+	def add(self, tap_parameters):
+		'''Add the regions of epn_core TAP parameters records with a coverage, a region already in the catalog is replaced'''
+		count = 0
+		with self.connection:
+			for record in tap_parameters:
+				if not record.get('ch_coverage_moc'):
+					continue
+				
+				granule_uid = record['granule_uid']
+				time_min = float(record['time_min'])
+				ranges = get_moc_ranges(parse_moc(record['ch_coverage_moc']), self.index_order)
+				cells = numpy.unique(numpy.concatenate([numpy.arange(first, last, dtype = numpy.uint64) for first, last in zip(*ranges)]))
+				
+				self.connection.execute('INSERT OR REPLACE INTO region (granule_uid, granule_gid, time_min, time_max, coverage_moc) VALUES (?, ?, ?, ?, ?)', (granule_uid, record['granule_gid'], time_min, float(record['time_max']), record['ch_coverage_moc']))
+				self.connection.execute('DELETE FROM region_cell WHERE granule_uid = ?', (granule_uid, ))
+				self.connection.executemany('INSERT INTO region_cell (cell, time_min, granule_uid) VALUES (?, ?, ?)', [(int(cell), time_min, granule_uid) for cell in cells])
+				count += 1
+		return count
+	
+	def query(self, lon_min, lon_max, lat_min, lat_max, start_date = None, end_date = None, order = 8, max_samples = 1000000):
+		'''Return the regions whose coverage intersects a box in heliographic coordinates in degrees, with a date between start date (inclusive) and end date (exclusive)
+		The exact coverage is checked at order, or at a lower order if the box is too large to be sampled with less than max_samples points'''
+		
+		box_size = ((lon_max - lon_min) % 360 or 360) * (lat_max - lat_min)
+		while order > self.index_order and box_size / (get_cell_size(order) / 2) ** 2 > max_samples:
+			order -= 1
+		
+		index_cells = get_box_cells(lon_min, lon_max, lat_min, lat_max, self.index_order)
+		box_cells = get_box_cells(lon_min, lon_max, lat_min, lat_max, order)
+		
+		time_min = datetime_to_jd(start_date) if start_date else -math.inf
+		time_max = datetime_to_jd(end_date) if end_date else math.inf
+		
+		candidates = set()
+		for batch in range(0, len(index_cells), self.BATCH_SIZE):
+			cells = [int(cell) for cell in index_cells[batch:batch + self.BATCH_SIZE]]
+			rows = self.connection.execute('SELECT granule_uid FROM region_cell WHERE cell IN (%s) AND time_min >= ? AND time_min < ?' % ','.join('?' * len(cells)), (*cells, time_min, time_max))
+			candidates.update(granule_uid for granule_uid, in rows)
+		
+		regions = list()
+		candidates = sorted(candidates)
+		for batch in range(0, len(candidates), self.BATCH_SIZE):
+			granule_uids = candidates[batch:batch + self.BATCH_SIZE]
+			rows = self.connection.execute('SELECT granule_uid, granule_gid, time_min, time_max, coverage_moc FROM region WHERE granule_uid IN (%s)' % ','.join('?' * len(granule_uids)), granule_uids)
+			for granule_uid, granule_gid, region_time_min, region_time_max, coverage_moc in rows:
+				# A cell of the box is in a range of the coverage if it is before the end of the range
+				firsts, lasts = get_moc_ranges(parse_moc(coverage_moc), order)
+				positions = numpy.searchsorted(box_cells, firsts)
+				inside = positions < len(box_cells)
+				if numpy.any(box_cells[positions[inside]] < lasts[inside]):
+					regions.append({'granule_uid': granule_uid, 'granule_gid': granule_gid, 'time_min': region_time_min, 'time_max': region_time_max})
+		
+		return sorted(regions, key = lambda region: (region['time_min'], region['granule_uid']))
+	
+	def close(self):
+		self.connection.close()
+
+
+def read_tap_parameters_from_csv(filepath):
+	'''Read the records of a TAP parameters CSV file'''
+	with open(filepath, 'rt', newline = '') as file:
+		return list(csv.DictReader(file))
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Add the regions of epn_core TAP parameters CSV files to the region catalog (index command), or search the regions whose heliographic coverage intersects a box in a time range (query command)')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	
+	subparsers = parser.add_subparsers(dest = 'command', required = True)
+	
+	index_parser = subparsers.add_parser('index', help = 'Add the regions of epn_core TAP parameters CSV files to the region catalog')
+	index_parser.add_argument('csv_files', metavar = 'FILEPATH', nargs = '+', help = 'The paths to epn_core TAP parameters CSV files')
+	
+	query_parser = subparsers.add_parser('query', help = 'Search the regions whose coverage intersects a box in heliographic coordinates')
+	query_parser.add_argument('--longitude', nargs = 2, type = float, metavar = ('MIN', 'MAX'), default = [0, 360], help = 'The longitude range of the box in degrees, MIN larger than MAX wraps around 360 (default is 0 360)')
+	query_parser.add_argument('--latitude', nargs = 2, type = float, metavar = ('MIN', 'MAX'), default = [-90, 90], help = 'The latitude range of the box in degrees (default is -90 90)')
+	query_parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of the regions (inclusive)')
+	query_parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of the regions (exclusive)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	with closing(RegionCatalog(config.get('REGION_CATALOG', 'database_file'), config.getint('REGION_CATALOG', 'index_order'))) as catalog:
+		
+		if args.command == 'index':
+			for csv_file in args.csv_files:
+				try:
+					count = catalog.add(read_tap_parameters_from_csv(csv_file))
+				except Exception as why:
+					logging.exception('Could not add regions of file %s to the region catalog: %s', csv_file, why)
+				else:
+					logging.info('Added %s regions of file %s to the region catalog', count, csv_file)
+		
+		elif args.command == 'query':
+			start = time.perf_counter()
+			regions = catalog.query(*args.longitude, *args.latitude, args.start_date, args.end_date, config.getint('TAP_PARAMETERS', 'coverage_order'))
+			logging.info('Found %s regions in %.1f ms', len(regions), (time.perf_counter() - start) * 1000)
+			
+			for region in regions:
+				print(region['granule_uid'])
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import os
+import sys
+import logging
+import argparse
+from pathlib import Path
+import numpy
+from astropy.io import fits
+
+from utils import get_config, date_to_filename, date_from_filename
+
+__all__ = ['get_index_file', 'get_region_index', 'write_region_index', 'RegionIndex']
+
+
+def get_index_file(date, config):
+	'''Return the path of the sparse region index of the cleaned map of a date, or None if no index must be written'''
+	if not config.get('index_file', ''):
+		return None
+	return Path(config.get('index_file').format(date = date_to_filename(date)))
+
+
+def get_region_index(image):
+	'''Return the sparse index of the regions of a region map, as a dict of arrays
+	The flat indices of the pixels of all the regions are sorted by color, the pixels of the color at position i of colors are pixels[offsets[i]:offsets[i+1]]
+	The bounding box of each region is given as x_min, y_min, x_max, y_max in pixels (inclusive)'''
+	
+	# The pixels outside the disk can be NaN in a float map
+	if image.dtype.kind == 'f':
+		image = numpy.nan_to_num(image, nan = 0)
+	
+	flat_image = image.ravel()
+	pixels = numpy.flatnonzero(flat_image)
+	
+	# A stable sort keeps the pixels of each region in row order, so they compress well
+	order = numpy.argsort(flat_image[pixels], kind = 'stable')
+	pixels = pixels[order]
+	pixel_colors = flat_image[pixels].astype(numpy.int64)
+	
+	colors, starts = numpy.unique(pixel_colors, return_index = True)
+	
+	if len(pixels):
+		y, x = numpy.divmod(pixels, image.shape[1])
+		bounding_boxes = numpy.stack([numpy.minimum.reduceat(x, starts), numpy.minimum.reduceat(y, starts), numpy.maximum.reduceat(x, starts), numpy.maximum.reduceat(y, starts)], axis = 1)
+	else:
+		bounding_boxes = numpy.zeros((0, 4), dtype = numpy.int64)
+	
+	return {
+		'shape': numpy.array(image.shape, dtype = numpy.int64),
+		'colors': colors,
+		'offsets': numpy.append(starts, len(pixels)).astype(numpy.int64),
+		'pixels': pixels.astype(numpy.uint32),
+		'bounding_boxes': bounding_boxes.astype(numpy.int32),
+	}
+
+
+def write_region_index(filepath, image):
+	'''Write the sparse index of the regions of a region map to a npz file'''
+	filepath = Path(filepath)
+	filepath.parent.mkdir(parents = True, exist_ok = True)
+	
+	# Write to a temporary file and rename, so that a reader never sees a partial index
+	temporary_filepath = filepath.with_name(filepath.name + '.tmp')
+	with open(temporary_filepath, 'wb') as file:
+		numpy.savez_compressed(file, **get_region_index(image))
+	os.replace(temporary_filepath, filepath)
+	
+	return filepath
+
+
+class RegionIndex:
+	'''Sparse index of the regions of a region map, to get the pixels, area and bounding box of a region without reading the map'''
+	
+	def __init__(self, filepath):
+		with numpy.load(filepath) as index:
+			self.set_index(index)
+	
+	@classmethod
+	def from_image(cls, image):
+		'''Return the sparse index of the regions of a region map already in memory'''
+		region_index = cls.__new__(cls)
+		region_index.set_index(get_region_index(image))
+		return region_index
+	
+	def set_index(self, index):
+		self.shape = tuple(int(size) for size in index['shape'])
+		self.colors = index['colors']
+		self.offsets = index['offsets']
+		self.pixels = index['pixels']
+		self.bounding_boxes = index['bounding_boxes']
+		self.positions = {int(color): position for position, color in enumerate(self.colors)}
+	
+	def __contains__(self, color):
+		return color in self.positions
+	
+	def get_flat_pixels(self, color):
+		'''Return the flat indices of the pixels of a region'''
+		position = self.positions[color]
+		return self.pixels[self.offsets[position]:self.offsets[position + 1]]
+	
+	def get_pixels(self, color):
+		'''Return the y and x coordinates of the pixels of a region'''
+		return numpy.divmod(self.get_flat_pixels(color).astype(numpy.int64), self.shape[1])
+	
+	def get_area(self, color):
+		'''Return the number of pixels of a region'''
+		position = self.positions[color]
+		return int(self.offsets[position + 1] - self.offsets[position])
+	
+	def get_bounding_box(self, color):
+		'''Return the x_min, y_min, x_max, y_max of the bounding box of a region in pixels (inclusive)'''
+		return tuple(int(value) for value in self.bounding_boxes[self.positions[color]])
+	
+	def get_mask(self, color):
+		'''Return the mask of a region cropped to its bounding box, and the x, y position of the mask in the map'''
+		x_min, y_min, x_max, y_max = self.get_bounding_box(color)
+		mask = numpy.zeros((y_max - y_min + 1, x_max - x_min + 1), dtype = bool)
+		y, x = self.get_pixels(color)
+		mask[y - y_min, x - x_min] = True
+		return mask, (x_min, y_min)
+	
+	def get_image(self, dtype = numpy.int32):
+		'''Return the full region map'''
+		image = numpy.zeros(self.shape, dtype = dtype)
+		image.ravel()[self.pixels] = numpy.repeat(self.colors, numpy.diff(self.offsets))
+		return image
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Write the sparse index of the regions of cleaned maps to the index_file of the LIFESPAN_CLEANING section, e.g. for the maps cleaned before the index was written by the pipeline')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--config-file', '-c', required = True, help = 'Path to the config file of the script')
+	parser.add_argument('cleaned_maps', metavar = 'FILEPATH', nargs = '+', help = 'The paths to cleaned maps')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	# Parse the script config file
+	config = get_config(args.config_file)
+	
+	if not config.get('LIFESPAN_CLEANING', 'index_file', fallback = ''):
+		logging.error('No index file, set the index_file of the LIFESPAN_CLEANING section')
+		sys.exit(1)
+	
+	for cleaned_map in args.cleaned_maps:
+		index_file = get_index_file(date_from_filename(Path(cleaned_map).name), config['LIFESPAN_CLEANING'])
+		try:
+			write_region_index(index_file, fits.getdata(cleaned_map, config.get('LIFESPAN_CLEANING', 'image_hdu_name')))
+		except Exception as why:
+			logging.exception('Could not write region index for map %s: %s', cleaned_map, why)
+		else:
+			logging.info('Wrote region index "%s"', index_file)
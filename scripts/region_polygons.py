@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import numpy
+from astropy import units
+from sunpy.coordinates import frames
+
+__all__ = ['get_boundary_loops', 'simplify_polygon', 'get_region_polygons', 'get_s_regions']
+
+
+# The middle of the edges of a marching squares cell, in doubled pixel coordinates x, y relative to the top left corner of the cell
+EDGES = {'top': (1, 0), 'right': (2, 1), 'bottom': (1, 2), 'left': (0, 1)}
+
+# The corners of a cell, in doubled pixel coordinates, with their bit in the case of the cell
+CORNERS = {'top_left': ((0, 0), 8), 'top_right': ((2, 0), 4), 'bottom_right': ((2, 2), 2), 'bottom_left': ((0, 2), 1)}
+
+# The corners at the ends of each edge
+EDGE_CORNERS = {'top': ('top_left', 'top_right'), 'right': ('top_right', 'bottom_right'), 'bottom': ('bottom_right', 'bottom_left'), 'left': ('bottom_left', 'top_left')}
+
+
+def get_segments_table():
+	'''Return the boundary segments of each of the 16 marching squares cases, as start and end edges
+	The segments are oriented so that the inside is always on the same side, so that each boundary point is the end of exactly one segment and the start of exactly one other'''
+	segments_table = dict()
+	for case in range(16):
+		inside = {corner for corner, (position, bit) in CORNERS.items() if case & bit}
+		crossed = [edge for edge, corners in EDGE_CORNERS.items() if (corners[0] in inside) != (corners[1] in inside)]
+		
+		# In the saddle cases the inside corners are not connected, each one is cut off by its two edges
+		if len(crossed) == 4:
+			pairs = [[edge for edge in crossed if corner in EDGE_CORNERS[edge]] for corner in inside]
+		elif crossed:
+			pairs = [crossed]
+		else:
+			pairs = []
+		
+		segments = list()
+		for first, second in pairs:
+			corner = [corner for corner in EDGE_CORNERS[first] if corner in inside][0]
+			start, end = numpy.array(EDGES[first]), numpy.array(EDGES[second])
+			direction = end - start
+			offset = numpy.array(CORNERS[corner][0]) - start
+			if direction[0] * offset[1] - direction[1] * offset[0] < 0:
+				start, end = end, start
+			segments.append((start, end))
+		
+		segments_table[case] = segments
+	
+	return segments_table
+
+SEGMENTS_TABLE = get_segments_table()
+
+
+def get_signed_area(points):
+	'''Return the signed area of a closed polygon with the shoelace formula'''
+	x, y = points[:, 0], points[:, 1]
+	return 0.5 * numpy.sum(x * numpy.roll(y, -1) - numpy.roll(x, -1) * y)
+
+
+def get_boundary_loops(mask):
+	'''Return the closed boundaries of a mask with marching squares, as arrays of x, y coordinates in pixels
+	The cases of all the cells, and the segments of all the cells with the same case, are computed at once'''
+	
+	# The mask is padded so that the boundaries of the regions touching the border are closed
+	padded = numpy.pad(mask.astype(numpy.uint8), 1)
+	cases = padded[:-1, :-1] * 8 + padded[:-1, 1:] * 4 + padded[1:, 1:] * 2 + padded[1:, :-1]
+	
+	# Only the cells with both inside and outside corners have segments
+	y, x = numpy.nonzero((cases != 0) & (cases != 15))
+	cell_cases = cases[y, x]
+	corners = numpy.stack([2 * x, 2 * y], axis = 1)
+	
+	starts = list()
+	ends = list()
+	for case in numpy.unique(cell_cases):
+		case_corners = corners[cell_cases == case]
+		for start, end in SEGMENTS_TABLE[case]:
+			starts.append(case_corners + start)
+			ends.append(case_corners + end)
+	
+	if not starts:
+		return list()
+	
+	starts = numpy.concatenate(starts)
+	ends = numpy.concatenate(ends)
+	
+	# Each segment is followed by the segment that starts where it ends
+	width = 2 * padded.shape[1] + 1
+	start_keys = starts[:, 1] * width + starts[:, 0]
+	end_keys = ends[:, 1] * width + ends[:, 0]
+	order = numpy.argsort(start_keys)
+	next_segments = order[numpy.searchsorted(start_keys, end_keys, sorter = order)].tolist()
+	
+	loops = list()
+	visited = bytearray(len(next_segments))
+	for first in range(len(next_segments)):
+		if visited[first]:
+			continue
+		loop = list()
+		segment = first
+		while not visited[segment]:
+			visited[segment] = 1
+			loop.append(segment)
+			segment = next_segments[segment]
+		# The doubled coordinates are relative to the padded mask
+		loops.append(starts[loop] / 2 - 1)
+	
+	return loops
+
+
+def simplify_polygon(points, tolerance):
+	'''Simplify a closed polygon with the Douglas-Peucker algorithm, so that no removed point is farther than tolerance from the simplified polygon'''
+	
+	if len(points) <= 4:
+		return points
+	
+	# The ring is split at its first point and the point farthest from it, and each half is simplified as a line
+	farthest = int(numpy.argmax(numpy.hypot(*(points - points[0]).T)))
+	ring = numpy.concatenate([points, points[:1]])
+	keep = numpy.zeros(len(ring), dtype = bool)
+	keep[[0, farthest, len(points)]] = True
+	
+	stack = [(0, farthest), (farthest, len(points))]
+	while stack:
+		first, last = stack.pop()
+		if last - first < 2:
+			continue
+		
+		start = ring[first]
+		dx, dy = ring[last] - start
+		between = ring[first + 1:last] - start
+		length = numpy.hypot(dx, dy)
+		if length:
+			distances = numpy.abs(dx * between[:, 1] - dy * between[:, 0]) / length
+		else:
+			distances = numpy.hypot(between[:, 0], between[:, 1])
+		
+		farthest = int(numpy.argmax(distances))
+		if distances[farthest] > tolerance:
+			middle = first + 1 + farthest
+			keep[middle] = True
+			stack.append((first, middle))
+			stack.append((middle, last))
+	
+	simplified = ring[keep][:-1]
+	
+	# A polygon needs at least 3 vertices, a region smaller than the tolerance is kept as is
+	return simplified if len(simplified) >= 3 else points
+
+
+def get_region_polygons(region_index, colors, tolerance = 1.):
+	'''Return the simplified outer boundary of each region of a sparse region index, as an array of x, y coordinates in pixels
+	If a region has several parts, the boundary of the largest one is returned'''
+	polygons = dict()
+	for color in colors:
+		if color not in region_index:
+			continue
+		
+		# The boundary is traced on the mask of the region cropped to its bounding box
+		mask, (x_min, y_min) = region_index.get_mask(color)
+		loops = get_boundary_loops(mask)
+		if not loops:
+			continue
+		
+		# The holes of the region are inside its outer boundary, so the outer boundary has the largest area
+		outer_loop = max(loops, key = lambda loop: abs(get_signed_area(loop)))
+		polygons[color] = simplify_polygon(outer_loop, tolerance) + (x_min, y_min)
+	
+	return polygons
+
+
+def get_s_regions(map, polygons, precision = 4):
+	'''Return the STC-S polygon of each region in helioprojective coordinates in degrees, for the s_region TAP parameter
+	The vertices of all the regions are converted to world coordinates with a single transform'''
+	
+	if not polygons:
+		return dict()
+	
+	colors = list(polygons)
+	vertices = numpy.concatenate([polygons[color] for color in colors])
+	
+	hpc = map.pixel_to_world(vertices[:, 0] * units.pixel, vertices[:, 1] * units.pixel).transform_to(frames.Helioprojective)
+	world_vertices = numpy.stack([hpc.Tx.to(units.degree).value, hpc.Ty.to(units.degree).value], axis = 1)
+	
+	s_regions = dict()
+	for color, polygon in zip(colors, numpy.split(world_vertices, numpy.cumsum([len(polygons[color]) for color in colors])[:-1])):
+		# The vertices are given counterclockwise
+		if get_signed_area(polygon) < 0:
+			polygon = polygon[::-1]
+		s_regions[color] = 'Polygon UNKNOWNFrame ' + ' '.join('%.*f' % (precision, value) for value in polygon.ravel())
+	
+	return s_regions
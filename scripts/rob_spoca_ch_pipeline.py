@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
+import os
 import logging
 import argparse
-import multiprocessing
 from datetime import datetime, timedelta
 from pathlib import Path
 
@@ -15,55 +15,78 @@ from get_overlay_image import get_overlay_image
 from get_epn_core_tap_parameters import get_epn_core_tap_parameters_from_file
 from get_tracking_tap_parameters import get_tracking_tap_parameters_from_file
 from get_datalink_tap_parameters import get_datalink_tap_parameters
-from utils import date_range, get_config, date_to_filename, date_from_filename, write_tap_parameters_to_csv, save_activity_log
+from tap_parameters_changes import PublishedState, write_tap_parameters_changes
+from region_catalog import RegionCatalog
+from region_index import get_index_file
+from region_aggregates import RegionAggregates, write_series_to_csv
+from executor import Executor, SharedArray, set_worker_data
+from staging_cache import StagingCache
+from job import Job
+from run_metrics import RunMetrics, get_previous_run_report
+from activity_store import get_activity_store
+from utils import date_range, get_config, date_to_filename, date_from_filename, write_tap_parameters_to_csv, get_thumbnail_files, save_activity_log, get_commit_info
 
+# The stages that run in the worker pools, for which a concurrency limit can be set in the config
+STAGES = ['get_segmentation_map', 'get_region_map', 'get_cleaned_map', 'get_overlay_image', 'get_epn_core_tap_parameters', 'get_tracking_tap_parameters', 'get_datalink_tap_parameters']
 
-def create_segmentation_maps(aia_images, config):
+# All the stages of a run in order, for the status of the run
+RUN_STAGES = ['get_segmentation_map', 'get_region_map', 'get_tracked_map', 'get_longlived_regions_colors', 'get_cleaned_map', 'get_overlay_image', 'get_epn_core_tap_parameters', 'get_tracking_tap_parameters', 'get_datalink_tap_parameters']
+
+
+def init_worker(worker_data, logging_config, commit_infos, logging_level):
+	'''Initialize a worker process of the pipeline'''
+	
+	# The worker processes are started from the forkserver, so they do not inherit the setup of the main process
+	logging.basicConfig(level = logging_level, format = '%(asctime)s %(levelname)-8s: %(message)s')
+	save_activity_log.store = get_activity_store(logging_config)
+	get_commit_info.cache.update(commit_infos)
+	set_worker_data(worker_data)
+
+
+def create_segmentation_maps(aia_images, config, executor):
 	'''Create the segmentation maps in parralel'''
 	
 	segmentation_maps = dict()
 	
-	with multiprocessing.Pool() as pool:
-		jobs = dict()
-		
-		for date, images in aia_images.items():
-			if None in images:
-				logging.info('Image missing for date %s, cannot create segmentation map', date.isoformat())
-				continue
-			
-			try:
-				jobs[date] = pool.apply_async(get_segmentation_map, (date, images, config))
-			except Exception as why:
-				logging.exception('Could not start job get_segmentation_map : %s', why)
+	jobs = dict()
+	
+	for date, images in aia_images.items():
+		if None in images:
+			logging.info('Image missing for date %s, cannot create segmentation map', date.isoformat())
+			continue
 		
-		for date, job in jobs.items():
-			try:
-				segmentation_maps[date] = job.get()
-			except Exception as why:
-				logging.exception('Could not create segmentation map for date %s: %s', date.isoformat(), why)
+		try:
+			jobs[date] = executor.submit_thread('get_segmentation_map', get_segmentation_map, date, images, config)
+		except Exception as why:
+			logging.exception('Could not start job get_segmentation_map : %s', why)
+	
+	for date, job in jobs.items():
+		try:
+			segmentation_maps[date] = job.result()
+		except Exception as why:
+			logging.exception('Could not create segmentation map for date %s: %s', date.isoformat(), why)
 	
 	return segmentation_maps
 
 
-def create_ch_maps(segmentation_maps, stat_images, config):
+def create_ch_maps(segmentation_maps, stat_images, config, executor):
 	'''Create the ch maps in parralel'''
 	
 	ch_maps = dict()
 	
-	with multiprocessing.Pool() as pool:
-		jobs = dict()
-		
-		for date, segmentation_map in segmentation_maps.items():
-			try:
-				jobs[(date, segmentation_map)] = pool.apply_async(get_region_map, (date, segmentation_map, stat_images[date], config))
-			except Exception as why:
-				logging.exception('Could not start job get_region_map : %s', why)
-		
-		for (date, segmentation_map), job in jobs.items():
-			try:
-				ch_maps[date] = job.get()
-			except Exception as why:
-				logging.exception('Could not create ch map for segmentation map %s: %s', segmentation_map, why)
+	jobs = dict()
+	
+	for date, segmentation_map in segmentation_maps.items():
+		try:
+			jobs[(date, segmentation_map)] = executor.submit_thread('get_region_map', get_region_map, date, segmentation_map, stat_images[date], config)
+		except Exception as why:
+			logging.exception('Could not start job get_region_map : %s', why)
+	
+	for (date, segmentation_map), job in jobs.items():
+		try:
+			ch_maps[date] = job.result()
+		except Exception as why:
+			logging.exception('Could not create ch map for segmentation map %s: %s', segmentation_map, why)
 	
 	return ch_maps
 
@@ -90,7 +113,7 @@ def run_tracking(tracked_maps, untracked_maps, config):
 	return dict(tracked_maps)
 
 
-def create_cleaned_maps(maps, longlived_regions_colors, end_date, config):
+def create_cleaned_maps(maps, end_date, config, executor):
 	'''Create the cleaned maps in parralel'''
 	
 	cleaned_maps = dict()
@@ -99,135 +122,137 @@ def create_cleaned_maps(maps, longlived_regions_colors, end_date, config):
 	# Don't process the last maps because we don't know the real lifespan of the regions yet
 	max_date = end_date - config.gettimedelta('min_lifespan')
 	
-	with multiprocessing.Pool() as pool:
-		jobs = dict()
-		
-		for date, map in maps.items():
-			if date < max_date:
-				jobs[(date, map)] = pool.apply_async(get_cleaned_map, (date, map, longlived_regions_colors, config))
-			else:
-				logging.warning('Not writting cleaned map for map %s: the date is too close to the end "%s" to know the definitive lifespan', map, end_date.isoformat())
-				uncleaned_ch_maps[date] = map
-		
-		for (date, map), job in jobs.items():
-			try:
-				cleaned_maps[date] = job.get()
-			except Exception as why:
-				logging.exception('Could not write cleaned map for map %s: %s', map, why)
+	# The regions colors and the config are part of the worker data, so they are sent only once to each worker
+	jobs = dict()
+	
+	for date, map in maps.items():
+		if date < max_date:
+			jobs[(date, map)] = executor.submit_process('get_cleaned_map', get_cleaned_map, date, map)
+		else:
+			logging.warning('Not writting cleaned map for map %s: the date is too close to the end "%s" to know the definitive lifespan', map, end_date.isoformat())
+			uncleaned_ch_maps[date] = map
+	
+	for (date, map), job in jobs.items():
+		try:
+			cleaned_maps[date] = job.result()
+		except Exception as why:
+			logging.exception('Could not write cleaned map for map %s: %s', map, why)
 	
 	return cleaned_maps, uncleaned_ch_maps
 
 
-def create_overlay_images(maps, background_images, config):
+def create_overlay_images(maps, background_images, config, executor):
 	'''Create the overlay images in parralel'''
 	
 	overlay_images = dict()
 	
-	with multiprocessing.Pool() as pool:
-		jobs = dict()
-		
-		for date, map in maps.items():
-			try:
-				jobs[(date, map)] = pool.apply_async(get_overlay_image, (date, map, background_images[date], config))
-			except Exception as why:
-				logging.exception('Could not start job get_overlay_image : %s', why)
-		
-		for (date, map), job in jobs.items():
-			try:
-				overlay_images[date] = job.get()
-			except Exception as why:
-				logging.exception('Could not create overlay for map %s: %s', map, why)
+	jobs = dict()
+	
+	for date, map in maps.items():
+		try:
+			# The python engine is CPU bound, so it runs in the worker processes, while the threads only wait on the SPoCA overlay program
+			if config.get('engine', 'spoca') == 'python':
+				jobs[(date, map)] = executor.submit_process('get_overlay_image', get_overlay_image, date, map, background_images[date])
+			else:
+				jobs[(date, map)] = executor.submit_thread('get_overlay_image', get_overlay_image, date, map, background_images[date], config)
+		except Exception as why:
+			logging.exception('Could not start job get_overlay_image : %s', why)
+	
+	for (date, map), job in jobs.items():
+		try:
+			overlay_images[date] = job.result()
+		except Exception as why:
+			logging.exception('Could not create overlay for map %s: %s', map, why)
 	
 	return overlay_images
 
 
-def extract_epn_core_tap_parameters(cleaned_ch_maps, tracked_ch_maps, overlay_images, longlived_regions_colors, config):
+def extract_epn_core_tap_parameters(cleaned_ch_maps, tracked_ch_maps, overlay_images, index_files, executor):
 	'''Extract the epn_core TAP parameters'''
 	
 	tap_parameters = dict()
 	
-	with multiprocessing.Pool() as pool:
-		jobs = dict()
-		# While creating cleaned maps from tracked maps, the last few ones are not created because we are not sure of the lifetime yet
-		# As a result there are less cleaned maps than tracked maps, and we must only submit TAP parameters for wich there is a cleaned map
-		for date, cleaned_ch_map in cleaned_ch_maps.items():
-			try:
-				tracked_ch_map = tracked_ch_maps[date]
-			except KeyError:
-				logging.info('No tracked map found for map %s', cleaned_ch_map)
-			else:
-				try:
-					jobs[(date, tracked_ch_map)] = pool.apply_async(get_epn_core_tap_parameters_from_file, (tracked_ch_map, cleaned_ch_map, overlay_images.get(date), longlived_regions_colors, config))
-				except Exception as why:
-					logging.exception('Could not start job get_epn_core_tap_parameters_from_file : %s', why)
-				
-		
-		for (date, tracked_ch_map), job in jobs.items():
+	# The regions colors and the config are part of the worker data, so they are sent only once to each worker
+	jobs = dict()
+	# While creating cleaned maps from tracked maps, the last few ones are not created because we are not sure of the lifetime yet
+	# As a result there are less cleaned maps than tracked maps, and we must only submit TAP parameters for wich there is a cleaned map
+	for date, cleaned_ch_map in cleaned_ch_maps.items():
+		try:
+			tracked_ch_map = tracked_ch_maps[date]
+		except KeyError:
+			logging.info('No tracked map found for map %s', cleaned_ch_map)
+		else:
 			try:
-				tap_parameters[date] = job.get()
+				jobs[(date, tracked_ch_map)] = executor.submit_process('get_epn_core_tap_parameters', get_epn_core_tap_parameters_from_file, tracked_ch_map, cleaned_ch_map, overlay_images.get(date), index_files.get(date))
 			except Exception as why:
-				logging.exception('Could not get epn_core TAP parameters for map %s : %s', tracked_ch_map, why)
+				logging.exception('Could not start job get_epn_core_tap_parameters_from_file : %s', why)
+			
+	
+	for (date, tracked_ch_map), job in jobs.items():
+		try:
+			tap_parameters[date] = job.result()
+		except Exception as why:
+			logging.exception('Could not get epn_core TAP parameters for map %s : %s', tracked_ch_map, why)
 	
 	return tap_parameters
 
 
-def extract_tracking_tap_parameters(cleaned_ch_maps, tracked_ch_maps, longlived_regions_colors, config):
+def extract_tracking_tap_parameters(cleaned_ch_maps, tracked_ch_maps, executor):
 	'''Extract the tracking TAP parameters'''
 	
 	tap_parameters = dict()
 	
-	with multiprocessing.Pool() as pool:
-		jobs = dict()
-		
-		# While creating cleaned maps from tracked maps, the last few ones are not created because we are not sure of the lifetime yet
-		# As a result there are less cleaned maps than tracked maps, and we must only submit TAP parameters for wich there is a cleaned map
-		for date, cleaned_ch_map in cleaned_ch_maps.items():
-			try:
-				tracked_ch_map = tracked_ch_maps[date]
-			except KeyError:
-				logging.info('No tracked map found for map %s', cleaned_ch_map)
-			else:
-				try:
-					jobs[(date, tracked_ch_map)] = pool.apply_async(get_tracking_tap_parameters_from_file, (tracked_ch_map, longlived_regions_colors))
-				except Exception as why:
-					logging.exception('Could not start job get_tracking_tap_parameters_from_file : %s', why)
-		
-		for (date, tracked_ch_map), job in jobs.items():
+	# The regions colors are part of the worker data, so they are sent only once to each worker
+	jobs = dict()
+	
+	# While creating cleaned maps from tracked maps, the last few ones are not created because we are not sure of the lifetime yet
+	# As a result there are less cleaned maps than tracked maps, and we must only submit TAP parameters for wich there is a cleaned map
+	for date, cleaned_ch_map in cleaned_ch_maps.items():
+		try:
+			tracked_ch_map = tracked_ch_maps[date]
+		except KeyError:
+			logging.info('No tracked map found for map %s', cleaned_ch_map)
+		else:
 			try:
-				tap_parameters[date] = job.get()
+				jobs[(date, tracked_ch_map)] = executor.submit_process('get_tracking_tap_parameters', get_tracking_tap_parameters_from_file, tracked_ch_map)
 			except Exception as why:
-				logging.exception('Could not get tracking TAP parameters for map %s : %s', tracked_ch_map, why)
+				logging.exception('Could not start job get_tracking_tap_parameters_from_file : %s', why)
+	
+	for (date, tracked_ch_map), job in jobs.items():
+		try:
+			tap_parameters[date] = job.result()
+		except Exception as why:
+			logging.exception('Could not get tracking TAP parameters for map %s : %s', tracked_ch_map, why)
 	
 	return tap_parameters
 
 
-def extract_datalink_tap_parameters(epn_core_tap_parameters, overlay_images, stat_images, config):
+def extract_datalink_tap_parameters(epn_core_tap_parameters, overlay_images, thumbnail_files, stat_images, provenance_file_pattern, config, executor):
 	'''Extract the datalink TAP parameters'''
 	
 	tap_parameters = dict()
 	
-	with multiprocessing.Pool() as pool:
-		jobs = dict()
+	jobs = dict()
+	
+	for date, epn_core_tap_parameter_list in epn_core_tap_parameters.items():
+		granule_uids = [epn_core_tap_parameter['granule_uid'] for epn_core_tap_parameter in epn_core_tap_parameter_list]
+		overlay_image = overlay_images.get(date)
+		aia_image = stat_images.get(date, {}).get('aia_image')
+		hmi_image = stat_images.get(date, {}).get('hmi_image')
+		# The provenance document of the cleaned map, created by the rob_spoca_ch_provenance script from the lineage of the map
+		provenance = provenance_file_pattern.format(date = date_to_filename(date))
 		
-		for date, epn_core_tap_parameter_list in epn_core_tap_parameters.items():
-			granule_uids = [epn_core_tap_parameter['granule_uid'] for epn_core_tap_parameter in epn_core_tap_parameter_list]
-			overlay_image = overlay_images.get(date)
-			aia_image = stat_images.get(date, {}).get('aia_image')
-			hmi_image = stat_images.get(date, {}).get('hmi_image')
-			# TODO use the actual provenance file
-			provenance = '{date}.provenance.json'.format(date = date_to_filename(date))
+		try:
+			jobs[date] = executor.submit_thread('get_datalink_tap_parameters', get_datalink_tap_parameters, granule_uids, overlay_image, aia_image, hmi_image, provenance, config, thumbnail_files.get(date))
+		except Exception as why:
+			logging.exception('Could not start job get_datalink_tap_parameters : %s', why)
 			
-			try:
-				jobs[date] = pool.apply_async(get_datalink_tap_parameters, (granule_uids, overlay_image, aia_image, hmi_image, provenance, config))
-			except Exception as why:
-				logging.exception('Could not start job get_datalink_tap_parameters : %s', why)
-				
-		
-		for date, job in jobs.items():
-			try:
-				tap_parameters[date] = job.get()
-			except Exception as why:
-				logging.exception('Could not get datalink TAP parameters for date %s : %s', date, why)
+	
+	for date, job in jobs.items():
+		try:
+			tap_parameters[date] = job.result()
+		except Exception as why:
+			logging.exception('Could not get datalink TAP parameters for date %s : %s', date, why)
 	
 	return tap_parameters
 
@@ -246,6 +271,68 @@ def write_tap_parameters(tap_parameters, output_file_pattern):
 			logging.info('wrote TAP parameters CSV file %s', output_file)
 
 
+def write_region_catalog(tap_parameters, database_file, index_order):
+	'''Add the regions of the epn_core TAP parameters with their coverage to the region catalog'''
+	
+	try:
+		catalog = RegionCatalog(database_file, index_order)
+	except Exception as why:
+		logging.exception('Could not open region catalog %s : %s', database_file, why)
+		return
+	
+	for date, parameters in tap_parameters.items():
+		try:
+			catalog.add(parameters)
+		except Exception as why:
+			logging.exception('Error while adding the regions of map %s to the region catalog : %s', date_to_filename(date), why)
+	
+	catalog.close()
+	logging.info('Added the regions of %s maps to the region catalog %s', len(tap_parameters), database_file)
+
+
+def write_region_aggregates(tap_parameters, map_dates, database_file, series_output_file_pattern = None):
+	'''Update the aggregates of the regions per map, day and Carrington rotation with the epn_core TAP parameters, and write the time series of each level
+	The maps of map_dates without TAP parameters failed, and their days and rotations are flagged as incomplete'''
+	
+	failed_dates = [date for date in map_dates if date not in tap_parameters]
+	if failed_dates:
+		logging.warning('%s maps have no epn_core TAP parameters, their days and rotations are incomplete in the region aggregates', len(failed_dates))
+	
+	try:
+		aggregates = RegionAggregates(database_file)
+	except Exception as why:
+		logging.exception('Could not open region aggregates %s : %s', database_file, why)
+		return
+	
+	try:
+		count = aggregates.update(tap_parameters, failed_dates)
+	except Exception as why:
+		logging.exception('Error while updating the region aggregates %s : %s', database_file, why)
+	else:
+		logging.info('Updated the region aggregates %s with %s maps', database_file, count)
+	
+	if series_output_file_pattern:
+		for level in ['map', 'day', 'rotation']:
+			output_file = series_output_file_pattern.format(level = level)
+			try:
+				write_series_to_csv(aggregates.get_series(level), output_file)
+			except Exception as why:
+				logging.exception('Error while writing series CSV file %s : %s', output_file, why)
+			else:
+				logging.info('wrote series CSV file %s', output_file)
+	
+	aggregates.close()
+
+
+def write_tap_changes(tap_parameters, table, state, output_file_pattern, run):
+	'''Write the changes of the TAP parameters compared to the published ones'''
+	
+	try:
+		write_tap_parameters_changes(tap_parameters, table, state, output_file_pattern, run)
+	except Exception as why:
+		logging.exception('Error while writing TAP parameters changes for table %s : %s', table, why)
+
+
 # Start point of the script
 if __name__ == '__main__':
 	
@@ -258,6 +345,7 @@ if __name__ == '__main__':
 	parser.add_argument('--interval', '-i', default = 6, type = int, help = 'Number of hours between two results')
 	parser.add_argument('--tracked-ch-maps', '-m', metavar = 'FILEPATH', nargs = '*', default = [], type = Path, help = 'The path to a previously tracked ch map to establish tracking relations with the past')
 	parser.add_argument('--regions-colors', '-r', metavar = 'FILEPATH', default = 'longlived_regions_colors.txt', help = 'The path to a file with the list of regions color numbers for which to extract TAP parameters (default is longlived_regions_colors.txt)')
+	parser.add_argument('--metrics-file', metavar = 'FILEPATH', help = 'The path to the JSON run report, with the metrics of each stage (default is the json_file of the RUN_REPORT section)')
 	
 	
 	args = parser.parse_args()
@@ -268,67 +356,190 @@ if __name__ == '__main__':
 	# Parse the script config file
 	config = get_config(args.config_file)
 	
-	save_activity_log.output_directory = config.get('LOGGING', 'output_directory')
-	
-	# Setup the SDO data file lookup
-	aia_data = SdoData(
-		file_pattern = config.get('AIA_DATA', 'file_pattern'),
-		hdu_name_or_index = config.getint('AIA_DATA', 'hdu_index'),
-		ignore_quality_bits = config.getintlist('AIA_DATA', 'ignore_quality_bits'),
+	# The name of the run for the TAP parameters change sets
+	run = date_to_filename(datetime.utcnow())
+	
+	save_activity_log.store = get_activity_store(config['LOGGING'])
+	
+	# The longlived regions colors are only known after the tracking, so they are shared with the worker processes through shared memory
+	shared_longlived_regions_colors = SharedArray('spoca4tap_longlived_regions_colors_%s' % os.getpid())
+	
+	# The data that is the same for all the tasks of a stage, sent only once to each worker process
+	worker_data = {
+		'get_cleaned_map': {'longlived_regions_colors': shared_longlived_regions_colors, 'config': config['LIFESPAN_CLEANING']},
+		'get_overlay_image': {'config': config['GET_OVERLAY_IMAGE']},
+		'get_epn_core_tap_parameters': {'regions_colors': shared_longlived_regions_colors, 'config': config['TAP_PARAMETERS']},
+		'get_tracking_tap_parameters': {'regions_colors': shared_longlived_regions_colors},
+	}
+	
+	# Resolve the commit of the scripts once, it is recorded in the activity logs of all the stages
+	commit_info = get_commit_info(__file__)
+	if commit_info['dirty']:
+		logging.warning('The repository of the scripts has uncommitted changes, the commit %s recorded in the activity logs does not fully describe the code', commit_info['commit'])
+	
+	# Setup the worker processes and threads shared by all the stages
+	executor = Executor(
+		process_count = config.getint('EXECUTOR', 'process_count', fallback = 0),
+		thread_count = config.getint('EXECUTOR', 'thread_count', fallback = 0),
+		stage_limits = {stage: config.getint('EXECUTOR', stage, fallback = 0) for stage in STAGES},
+		initializer = init_worker,
+		initargs = (worker_data, dict(config['LOGGING']), get_commit_info.cache, getattr(logging, args.verbose)),
 	)
 	
-	hmi_data = SdoData(
-		file_pattern = config.get('HMI_DATA', 'file_pattern'),
-		hdu_name_or_index = config.getint('HMI_DATA', 'hdu_index'),
-		ignore_quality_bits = config.getintlist('HMI_DATA', 'ignore_quality_bits'),
+	# The run report is updated at the end of each stage, and the status of the run every status interval
+	json_file_pattern = config.get('RUN_REPORT', 'json_file', fallback = '')
+	metrics = RunMetrics(
+		executor,
+		json_file = args.metrics_file or json_file_pattern.format(run = run),
+		prometheus_file = config.get('RUN_REPORT', 'prometheus_file', fallback = '').format(run = run),
+		run = run,
+		status_file = config.get('RUN_REPORT', 'status_file', fallback = ''),
+		status_interval = config.getfloat('RUN_REPORT', 'status_interval', fallback = 10),
+		previous_report = get_previous_run_report(json_file_pattern),
 	)
 	
-	aia_images = dict()
-	for date in date_range(args.start_date, args.end_date, timedelta(hours=args.interval)):
-		aia_images[date] = [aia_data.get_good_quality_file(date = date, wavelength = wavelength) for wavelength in config.getintlist('GET_SEGMENTATION_MAP', 'aia_wavelengths')]
-	
-	segmentation_maps = create_segmentation_maps(aia_images, config['GET_SEGMENTATION_MAP'])
-	
-	stat_images = dict()
-	for date in segmentation_maps.keys():
-		stat_images[date] = {
-			'aia_image': aia_data.get_good_quality_file(date = date, wavelength = config.getint('GET_REGION_MAP', 'aia_wavelength')),
-			'hmi_image': hmi_data.get_good_quality_file(date = date)
-		}
-	
-	ch_maps = create_ch_maps(segmentation_maps, stat_images, config['GET_REGION_MAP'])
-	
-	tracked_ch_maps = run_tracking(args.tracked_ch_maps, ch_maps, config['GET_TRACKED_MAP'])
-	
-	# Extract the colors of regions to keep
+	# The workers, the shared memory and the cache threads are released even if a stage fails
+	staging_cache = None
 	try:
-		longlived_regions_colors = get_longlived_regions_colors(sorted(tracked_ch_maps.values()), config['LIFESPAN_CLEANING'])
-	except Exception as why:
-		logging.exception('Error getting longlived regions colors from maps : %s', why)
+		# Setup the SDO data file lookup
+		aia_data = SdoData(
+			file_pattern = config.get('AIA_DATA', 'file_pattern'),
+			hdu_name_or_index = config.getint('AIA_DATA', 'hdu_index'),
+			ignore_quality_bits = config.getintlist('AIA_DATA', 'ignore_quality_bits'),
+		)
+		
+		hmi_data = SdoData(
+			file_pattern = config.get('HMI_DATA', 'file_pattern'),
+			hdu_name_or_index = config.getint('HMI_DATA', 'hdu_index'),
+			ignore_quality_bits = config.getintlist('HMI_DATA', 'ignore_quality_bits'),
+		)
+		
+		# The input files on network storage can be prefetched to a local cache, the SPoCA programs are then given the local copies
+		if config.get('STAGING_CACHE', 'cache_directory', fallback = ''):
+			staging_cache = StagingCache(
+				config.get('STAGING_CACHE', 'cache_directory'),
+				max_size = config.getfloat('STAGING_CACHE', 'max_size') * 2**30,
+				read_ahead = config.getint('STAGING_CACHE', 'read_ahead', fallback = 8),
+				thread_count = config.getint('STAGING_CACHE', 'thread_count', fallback = 2),
+			)
+			Job.staging_cache = staging_cache
+		
+		aia_images = dict()
+		for date in date_range(args.start_date, args.end_date, timedelta(hours=args.interval)):
+			aia_images[date] = [aia_data.get_good_quality_file(date = date, wavelength = wavelength) for wavelength in config.getintlist('GET_SEGMENTATION_MAP', 'aia_wavelengths')]
+		
+		if staging_cache is not None:
+			staging_cache.prefetch(image for date in sorted(aia_images) for image in aia_images[date])
+		
+		# The number of items of the stages is not known before they start, the number of dates is an upper bound
+		metrics.set_plan(RUN_STAGES, len(aia_images))
+		
+		with metrics.stage('get_segmentation_map', 'thread', len(aia_images)):
+			segmentation_maps = create_segmentation_maps(aia_images, config['GET_SEGMENTATION_MAP'], executor)
+		
+		stat_images = dict()
+		for date in segmentation_maps.keys():
+			stat_images[date] = {
+				'aia_image': aia_data.get_good_quality_file(date = date, wavelength = config.getint('GET_REGION_MAP', 'aia_wavelength')),
+				'hmi_image': hmi_data.get_good_quality_file(date = date)
+			}
+		
+		if staging_cache is not None:
+			staging_cache.prefetch(image for date in sorted(stat_images) for image in stat_images[date].values())
+		
+		with metrics.stage('get_region_map', 'thread', len(segmentation_maps)):
+			ch_maps = create_ch_maps(segmentation_maps, stat_images, config['GET_REGION_MAP'], executor)
+		
+		with metrics.stage('get_tracked_map', total = len(ch_maps)) as stage_metrics:
+			tracked_ch_maps = run_tracking(args.tracked_ch_maps, ch_maps, config['GET_TRACKED_MAP'])
+			stage_metrics['items'] = len(ch_maps)
+		
+		# Extract the colors of regions to keep
+		try:
+			with metrics.stage('get_longlived_regions_colors', total = len(tracked_ch_maps)) as stage_metrics:
+				longlived_regions_colors = get_longlived_regions_colors(sorted(tracked_ch_maps.values()), config['LIFESPAN_CLEANING'])
+				stage_metrics['items'] = len(tracked_ch_maps)
+		except Exception as why:
+			logging.exception('Error getting longlived regions colors from maps : %s', why)
+			raise
+		
+		try:
+			write_regions_colors(longlived_regions_colors, args.regions_colors)
+		except Exception as why:
+			logging.exception('Error while writing text file %s : %s', args.regions_colors, why)
+		else:
+			logging.info('Wrote longlived regions colors to file %s', args.regions_colors)
+		
+		shared_longlived_regions_colors.set(longlived_regions_colors)
+		
+		with metrics.stage('get_cleaned_map', 'process', len(tracked_ch_maps)):
+			cleaned_ch_maps, uncleaned_ch_maps = create_cleaned_maps(tracked_ch_maps, args.end_date, config['LIFESPAN_CLEANING'], executor)
+		
+		# The throughput of the run is the number of maps that went through all the stages
+		metrics.maps = len(cleaned_ch_maps)
+		
+		background_images = dict()
+		for date in cleaned_ch_maps.keys():
+			background_images[date] = aia_data.get_good_quality_file(date = date, wavelength = config.getint('GET_OVERLAY_IMAGE', 'aia_wavelength'))
+		
+		# The python overlay engine reads the background images itself
+		if staging_cache is not None and config.get('GET_OVERLAY_IMAGE', 'engine', fallback = 'spoca') != 'python':
+			staging_cache.prefetch(background_images[date] for date in sorted(background_images))
+		
+		# The python overlay engine runs in the worker processes, the SPoCA overlay program is executed from the threads
+		with metrics.stage('get_overlay_image', 'process' if config.get('GET_OVERLAY_IMAGE', 'engine', fallback = 'spoca') == 'python' else 'thread', len(cleaned_ch_maps)):
+			overlay_images = create_overlay_images(cleaned_ch_maps, background_images, config['GET_OVERLAY_IMAGE'], executor)
+		
+		# The sparse region indexes written by the cleaning, to get the pixels of the regions without decompressing the cleaned maps
+		index_files = {date: get_index_file(date, config['LIFESPAN_CLEANING']) for date in cleaned_ch_maps}
+		
+		with metrics.stage('get_epn_core_tap_parameters', 'process', len(cleaned_ch_maps)):
+			epn_core_tap_parameters = extract_epn_core_tap_parameters(cleaned_ch_maps, tracked_ch_maps, overlay_images, index_files, executor)
+		write_tap_parameters(epn_core_tap_parameters, config.get('TAP_PARAMETERS', 'epn_core_output_file'))
+		
+		if config.get('REGION_CATALOG', 'database_file', fallback = ''):
+			write_region_catalog(epn_core_tap_parameters, config.get('REGION_CATALOG', 'database_file'), config.getint('REGION_CATALOG', 'index_order'))
+		
+		if config.get('REGION_AGGREGATES', 'database_file', fallback = ''):
+			write_region_aggregates(epn_core_tap_parameters, cleaned_ch_maps, config.get('REGION_AGGREGATES', 'database_file'), config.get('REGION_AGGREGATES', 'series_output_file', fallback = ''))
+		
+		published_state = PublishedState(config.get('TAP_PARAMETERS', 'published_state_file'))
+		
+		write_tap_changes(epn_core_tap_parameters, 'epn_core', published_state, config.get('TAP_PARAMETERS', 'changes_output_file'), run)
+		
+		with metrics.stage('get_tracking_tap_parameters', 'process', len(cleaned_ch_maps)):
+			tracking_tap_parameters = extract_tracking_tap_parameters(cleaned_ch_maps, tracked_ch_maps, executor)
+		write_tap_parameters(tracking_tap_parameters, config.get('TAP_PARAMETERS', 'tracking_output_file'))
+		write_tap_changes(tracking_tap_parameters, 'tracking', published_state, config.get('TAP_PARAMETERS', 'changes_output_file'), run)
+		
+		# The thumbnails are created with the overlay images
+		thumbnail_files = {date: get_thumbnail_files(overlay_image, config['GET_OVERLAY_IMAGE']) for date, overlay_image in overlay_images.items()}
+		
+		with metrics.stage('get_datalink_tap_parameters', 'thread', len(epn_core_tap_parameters)):
+			datalink_tap_parameters = extract_datalink_tap_parameters(epn_core_tap_parameters, overlay_images, thumbnail_files, stat_images, config.get('PROVENANCE', 'output_file'), config['TAP_PARAMETERS'], executor)
+		write_tap_parameters(datalink_tap_parameters, config.get('TAP_PARAMETERS', 'datalink_output_file'))
+		write_tap_changes(datalink_tap_parameters, 'datalink', published_state, config.get('TAP_PARAMETERS', 'changes_output_file'), run)
+		
+		try:
+			published_state.save()
+		except Exception as why:
+			logging.exception('Error while writing published state file %s : %s', published_state.filepath, why)
+	except BaseException:
+		run_state = 'failed'
 		raise
-	
-	try:
-		write_regions_colors(longlived_regions_colors, args.regions_colors)
-	except Exception as why:
-		logging.exception('Error while writing text file %s : %s', args.regions_colors, why)
 	else:
-		logging.info('Wrote longlived regions colors to file %s', args.regions_colors)
-	
-	cleaned_ch_maps, uncleaned_ch_maps = create_cleaned_maps(tracked_ch_maps, longlived_regions_colors, args.end_date, config['LIFESPAN_CLEANING'])
-	
-	background_images = dict()
-	for date in cleaned_ch_maps.keys():
-		background_images[date] = aia_data.get_good_quality_file(date = date, wavelength = config.getint('GET_OVERLAY_IMAGE', 'aia_wavelength'))
-	
-	overlay_images = create_overlay_images(cleaned_ch_maps, background_images, config['GET_OVERLAY_IMAGE'])
-	
-	epn_core_tap_parameters = extract_epn_core_tap_parameters(cleaned_ch_maps, tracked_ch_maps, overlay_images, longlived_regions_colors, config['TAP_PARAMETERS'])
-	write_tap_parameters(epn_core_tap_parameters, config.get('TAP_PARAMETERS', 'epn_core_output_file'))
-	
-	tracking_tap_parameters = extract_tracking_tap_parameters(cleaned_ch_maps, tracked_ch_maps, longlived_regions_colors, config['TAP_PARAMETERS'])
-	write_tap_parameters(tracking_tap_parameters, config.get('TAP_PARAMETERS', 'tracking_output_file'))
+		run_state = 'done'
+	finally:
+		# The tasks not yet started are cancelled if a stage failed or the run was interrupted
+		executor.shutdown(cancel_futures = run_state != 'done')
+		shared_longlived_regions_colors.unlink()
+		
+		if staging_cache is not None:
+			staging_cache.close()
+		
+		metrics.close(run_state)
 	
-	datalink_tap_parameters = extract_datalink_tap_parameters(epn_core_tap_parameters, overlay_images, stat_images, config['TAP_PARAMETERS'])
-	write_tap_parameters(datalink_tap_parameters, config.get('TAP_PARAMETERS', 'datalink_output_file'))
+	for line in metrics.get_summary():
+		logging.info(line)
 	
 	logging.info('At next execution of the script, pass the parameter --tracked-ch-maps %s', ' '.join(str(map) for map in uncleaned_ch_maps.values()))
@@ -2,26 +2,21 @@
 import logging
 import argparse
 import json
+import multiprocessing
+from datetime import datetime
 from pathlib import Path
 from voprov.models.model import VOProvDocument, VOPROV
-from voprov.visualization.dot import prov_to_dot
 
 from provenance import GetCalibratedAiaProvenance, GetCalibratedHmiProvenance, GetClassCentersProvenance, GetMedianClassCentersProvenance, GetSegmentationMapProvenance, GetChMapProvenance, GetTrackedMapProvenance, GetLonglivedRegionsColorsProvenance, GetCleanedMapProvenance
+from provenance_preview import get_preview_dot, write_preview_images, write_provenance_preview
+from activity_store import get_activity_store, get_upstream_activity_logs
+from utils import get_config, date_to_filename, date_from_filename, get_commit_info
 
-# Start point of the script
-if __name__ == '__main__':
-	
-	# Get the arguments
-	parser = argparse.ArgumentParser(description='Writes a provenance document from an activity log file for the rob_spoca_ch TAP service')
-	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
-	parser.add_argument('--output', '-o', default = 'provenance.json', help = 'Path to the output file (default is provenance.json)')
-	parser.add_argument('--preview', '-p', help = 'Path to the preview image file')
-	parser.add_argument('activity_logs', metavar = 'FILEPATH', nargs = '+', help = 'The path to an activity log file')
-	
-	args = parser.parse_args()
-	
-	# Setup the logging
-	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+__all__ = ['get_provenance_document', 'write_provenance_document', 'get_cleaned_maps_activity_logs', 'write_provenance_documents']
+
+
+def get_provenance_document(activity_logs):
+	'''Create a provenance document from activity logs'''
 	
 	prov_doc = VOProvDocument()
 	
@@ -29,6 +24,7 @@ if __name__ == '__main__':
 	prov_doc.set_default_namespace(VOPROV.uri)
 	
 	# Set up the description of all activities
+	# The versions of the activities are resolved only once per process, so creating the descriptions for each document is cheap
 	get_calibrated_aia = GetCalibratedAiaProvenance(prov_doc, 193)
 	get_calibrated_hmi = GetCalibratedHmiProvenance(prov_doc)
 	get_class_centers = GetClassCentersProvenance(prov_doc, [get_calibrated_aia.aia_level2_description])
@@ -39,10 +35,7 @@ if __name__ == '__main__':
 	get_longlived_regions_colors = GetLonglivedRegionsColorsProvenance(prov_doc, get_tracked_map.tracked_map_description)
 	get_cleaned_map = GetCleanedMapProvenance(prov_doc, get_tracked_map.tracked_map_description, get_longlived_regions_colors.longlived_regions_colors_description)
 	
-	for activity_log in args.activity_logs:
-		with open(activity_log, 'rt') as file:
-			log = json.load(file)
-		
+	for log in activity_logs:
 		function_name = log['function_name']
 		
 		if function_name == 'get_segmentation_map':
@@ -56,18 +49,135 @@ if __name__ == '__main__':
 		else:
 			raise ValueError('Unknown function %s, cannot generate provenance doc' % function_name)
 	
-	try:
-		prov_doc.serialize(args.output, format= 'json')
-	except Exception as why:
-		logging.exception('Could not write provenance document %s: %s', args.output, why)
-	else:
-		logging.info('Wrote provenance file %s', args.output)
+	return prov_doc
+
+
+def write_provenance_document(activity_logs, output_file, preview = False):
+	'''Write a provenance document from activity logs, and return its path and optionaly the Graphviz source of its preview image'''
+	
+	prov_doc = get_provenance_document(activity_logs)
+	
+	Path(output_file).parent.mkdir(parents = True, exist_ok = True)
+	prov_doc.serialize(str(output_file), format = 'json')
+	logging.debug('Wrote provenance file %s', output_file)
 	
-	if args.preview:
+	return output_file, get_preview_dot(prov_doc) if preview else None
+
+
+def get_cleaned_maps_activity_logs(store, start_date, end_date):
+	'''Return the activity logs of the creation of each cleaned map between start date (inclusive) and end date (exclusive), and of the creation of the maps it was made from'''
+	
+	for cleaned_map_log in store.find('get_cleaned_map', start_date, end_date):
+		date = date_from_filename(cleaned_map_log['activity_id'])
+		yield date, get_upstream_activity_logs(store, cleaned_map_log['function_output'])
+
+
+def init_worker(commit_infos):
+	'''Initialize a worker process with the commit versions already resolved by the main process'''
+	get_commit_info.cache.update(commit_infos)
+
+
+def write_provenance_documents(store, start_date, end_date, output_file_pattern, preview_file_pattern = None, process_count = None):
+	'''Write the provenance document of each cleaned map between start date (inclusive) and end date (exclusive) using a pool of worker processes
+	The preview images of all the documents are drawn at the end, by batch'''
+	
+	# Resolve the commit versions once, instead of once per worker
+	get_commit_info(__file__)
+	
+	provenance_documents = dict()
+	previews = dict()
+	
+	with multiprocessing.Pool(process_count or None, initializer = init_worker, initargs = (get_commit_info.cache, )) as pool:
+		jobs = dict()
+		
+		# The activity logs are read only once by the main process, and each worker receives only the logs of one map
+		for date, activity_logs in get_cleaned_maps_activity_logs(store, start_date, end_date):
+			output_file = output_file_pattern.format(date = date_to_filename(date))
+			jobs[date] = pool.apply_async(write_provenance_document, (activity_logs, output_file, bool(preview_file_pattern)))
+		
+		for date, job in jobs.items():
+			try:
+				provenance_documents[date], preview = job.get()
+			except Exception as why:
+				logging.exception('Could not write provenance document for date %s: %s', date.isoformat(), why)
+			else:
+				if preview is not None:
+					previews[preview_file_pattern.format(date = date_to_filename(date))] = preview
+	
+	if previews:
+		try:
+			write_preview_images(previews, thread_count = process_count or None)
+		except Exception as why:
+			logging.exception('Could not write provenance preview images: %s', why)
+		else:
+			logging.debug('Wrote %s provenance preview images', len(previews))
+	
+	return provenance_documents
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description='Writes a provenance document from activity log files for the rob_spoca_ch TAP service, or in batch mode one provenance document per cleaned map from the activity store')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--output', '-o', default = 'provenance.json', help = 'Path to the output file (default is provenance.json)')
+	parser.add_argument('--preview', '-p', help = 'Path to the preview image file')
+	parser.add_argument('--config-file', '-c', help = 'Path to the config file of the script, for the batch mode or to specify a cleaned map')
+	parser.add_argument('--cleaned-map', metavar = 'FILEPATH', help = 'The path to a cleaned map, to create its provenance document from the lineage of the map instead of from activity log files')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, help = 'Start date of the cleaned maps, for the batch mode')
+	parser.add_argument('--end-date', '-e', type = datetime.fromisoformat, help = 'End date of the cleaned maps (exclusive), for the batch mode')
+	parser.add_argument('activity_logs', metavar = 'FILEPATH', nargs = '*', help = 'The path to an activity log file')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	if args.activity_logs or (args.config_file and args.cleaned_map):
+		activity_logs = list()
+		for activity_log in args.activity_logs:
+			with open(activity_log, 'rt') as file:
+				activity_logs.append(json.load(file))
+		
+		if args.cleaned_map:
+			# Parse the script config file
+			config = get_config(args.config_file)
+			activity_logs.extend(get_upstream_activity_logs(get_activity_store(config['LOGGING']), args.cleaned_map))
+			if not activity_logs:
+				parser.error('No activity log found for cleaned map %s' % args.cleaned_map)
+		
+		prov_doc = get_provenance_document(activity_logs)
+		
 		try:
-			dot = prov_to_dot(prov_doc, use_labels= True, direction= 'LR')
-			dot.write_png(args.preview)
+			prov_doc.serialize(args.output, format= 'json')
 		except Exception as why:
-			logging.exception('Could not write provenance preview image %s: %s', args.preview, why)
+			logging.exception('Could not write provenance document %s: %s', args.output, why)
 		else:
-			logging.info('Wrote provenance preview image %s', args.preview)
+			logging.info('Wrote provenance file %s', args.output)
+		
+		if args.preview:
+			try:
+				write_provenance_preview(prov_doc, args.preview)
+			except Exception as why:
+				logging.exception('Could not write provenance preview image %s: %s', args.preview, why)
+			else:
+				logging.info('Wrote provenance preview image %s', args.preview)
+	
+	elif args.config_file and args.start_date and args.end_date:
+		# Parse the script config file
+		config = get_config(args.config_file)
+		
+		provenance_documents = write_provenance_documents(
+			get_activity_store(config['LOGGING']),
+			args.start_date,
+			args.end_date,
+			config.get('PROVENANCE', 'output_file'),
+			config.get('PROVENANCE', 'preview_file', fallback = None),
+			config.getint('PROVENANCE', 'process_count', fallback = 0)
+		)
+		
+		logging.info('Wrote %s provenance files', len(provenance_documents))
+	
+	else:
+		parser.error('Either activity log files, the config file and a cleaned map, or the config file, start date and end date for the batch mode must be specified')
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from glob import glob
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from pathlib import Path
+
+__all__ = ['RunMetrics', 'get_memory_usage', 'get_critical_path_summary', 'get_status_summary', 'get_previous_run_report', 'write_text_atomically', 'write_json_atomically']
+
+# The metrics of each stage written to the Prometheus file, with their type and help text
+PROMETHEUS_METRICS = {
+	'start_timestamp_seconds': ('gauge', 'Start time of the stage since the epoch'),
+	'end_timestamp_seconds': ('gauge', 'End time of the stage since the epoch'),
+	'wall_seconds': ('gauge', 'Wall time of the stage'),
+	'items': ('gauge', 'Number of items processed by the stage'),
+	'failed': ('gauge', 'Number of items that failed in the stage'),
+	'queue_wait_seconds': ('gauge', 'Total time the tasks of the stage waited before running'),
+	'busy_seconds': ('gauge', 'Total time the workers spent running the tasks of the stage'),
+	'idle_seconds': ('gauge', 'Total time the workers were idle during the stage'),
+	'utilisation_ratio': ('gauge', 'Fraction of the time the workers were running the tasks of the stage'),
+	'throughput_per_hour': ('gauge', 'Number of items processed per hour by the stage'),
+	'parent_cpu_seconds': ('gauge', 'CPU time of the pipeline process during the stage'),
+	'parent_memory_bytes': ('gauge', 'Resident memory of the pipeline process at the end of the stage'),
+}
+
+
+def get_memory_usage():
+	'''Return the current and the peak resident memory of the process in bytes'''
+	try:
+		with open('/proc/self/statm', 'rt') as file:
+			current = int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		current = None
+	
+	# On Linux ru_maxrss is in kilobytes
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	return current, peak
+
+
+def write_text_atomically(text, filepath):
+	'''Write text to a file through a temporary file and a rename, so that a reader never sees a partial file
+	The temporary file has a unique name, so that concurrent writers do not write to the same temporary file'''
+	filepath = Path(filepath)
+	filepath.parent.mkdir(parents = True, exist_ok = True)
+	with tempfile.NamedTemporaryFile('wt', dir = filepath.parent, prefix = filepath.name + '.', suffix = '.tmp', delete = False) as file:
+		file.write(text)
+	try:
+		os.replace(file.name, filepath)
+	except BaseException:
+		os.unlink(file.name)
+		raise
+
+
+def write_json_atomically(data, filepath):
+	'''Write data to a JSON file through a temporary file and a rename, so that a reader never sees a partial file'''
+	write_text_atomically(json.dumps(data, indent = 3, default = lambda value: value.isoformat()), filepath)
+
+
+def format_duration(seconds):
+	'''Return a duration in seconds formatted as days, hours and minutes'''
+	if seconds is None:
+		return 'unknown'
+	minutes, seconds = divmod(int(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	days, hours = divmod(hours, 24)
+	return ('%dd %02dh %02dm' % (days, hours, minutes)) if days else ('%dh %02dm %02ds' % (hours, minutes, seconds))
+
+
+def get_status_summary(status):
+	'''Return the lines of a summary of a status of a pipeline run'''
+	lines = [
+		'Run %s %s since %s, elapsed %s, last update %s' % (status['run'], status['state'], status['start'], format_duration(status['elapsed']), status['updated']),
+		'%-30s %-8s %8s %8s %8s %8s %12s' % ('Stage', 'State', 'Done', 'Running', 'Failed', 'Pending', 'Items/hour'),
+	]
+	for name, stage in status['stages'].items():
+		lines.append('%-30s %-8s %8s %8s %8s %8s %12.1f' % (name, stage['state'], stage['done'], stage['running'], stage['failed'], stage['pending'], stage['throughput_per_hour']))
+	
+	if status['state'] == 'running':
+		lines.append('Estimated time to completion %s%s' % (format_duration(status['eta_seconds']), '' if status['eta_complete'] else ' (without the stages never run before)'))
+		
+		# The status file is updated every status interval while the pipeline runs
+		age = (datetime.utcnow() - datetime.fromisoformat(status['updated'])).total_seconds()
+		if age > 3 * status['interval']:
+			lines.append('WARNING: the status was not updated for %s, the pipeline may have stopped' % format_duration(age))
+	
+	return lines
+
+
+def get_previous_run_report(json_file_pattern):
+	'''Return the most recent run report matching the pattern of the run report files (with a {run} placeholder), or None if there is none'''
+	if not json_file_pattern:
+		return None
+	
+	# The run names are dates, so the last file in order is the most recent
+	for filepath in reversed(sorted(glob(json_file_pattern.format(run = '*')))):
+		try:
+			with open(filepath, 'rt') as file:
+				return json.load(file)
+		except Exception as why:
+			logging.warning('Could not read run report %s: %s', filepath, why)
+
+
+def get_critical_path_summary(report):
+	'''Return the lines of a summary of the critical path of a run report, the stages run one after the other so the critical path is the sequence of stages'''
+	
+	stages = report['stages']
+	total = sum(stage['wall_time'] for stage in stages.values()) or 1.
+	
+	lines = ['Critical path of %.1f s for %s maps (%.1f maps/hour)' % (report['wall_time'], report.get('maps', 0), report.get('throughput_per_hour', 0))]
+	for name, stage in sorted(stages.items(), key = lambda item: item[1]['wall_time'], reverse = True):
+		lines.append('%-30s %10.1f s %5.1f%%  %6s items %4s failed  %8.1f items/hour  utilisation %5.1f%%  queue wait %8.1f s' % (name, stage['wall_time'], stage['wall_time'] / total * 100, stage['items'], stage['failed'], stage['throughput_per_hour'], stage['utilisation'] * 100, stage['queue_wait']))
+	
+	if stages:
+		name, stage = max(stages.items(), key = lambda item: item[1]['wall_time'])
+		if stage['pool'] is None:
+			lines.append('The run is dominated by %s, that runs in the pipeline process' % name)
+		elif stage['utilisation'] > 0.8:
+			lines.append('The run is dominated by %s, its %s workers are busy, more workers would reduce it' % (name, stage['workers']))
+		else:
+			lines.append('The run is dominated by %s, its %s workers are mostly idle, more workers would not reduce it' % (name, stage['workers']))
+	
+	return lines
+
+
+class RunMetrics:
+	'''Record the start and end, the number of items, the failures, the queue wait, the utilisation of the workers and the memory of the pipeline process for each stage of a pipeline run
+	The run report is written to a JSON file and a Prometheus text format file at the end of each stage, so that a long run can be monitored
+	The status of the run is written to a status file every status interval seconds by a background thread, with an estimated time to completion from the durations of the completed items, and for the stages not yet started from the previous run report'''
+	
+	def __init__(self, executor = None, json_file = None, prometheus_file = None, run = None, status_file = None, status_interval = 10, previous_report = None):
+		self.executor = executor
+		self.json_file = json_file
+		self.prometheus_file = prometheus_file
+		self.run = run
+		self.start = datetime.utcnow()
+		self.start_time = time.perf_counter()
+		self.maps = 0
+		self.stages = dict()
+		
+		self.status_file = status_file
+		self.status_interval = status_interval
+		self.previous_report = previous_report or {'stages': {}}
+		self.state = 'running'
+		self.plan = dict()
+		self.current_stage = None
+		self.lock = threading.Lock()
+		# The status is written by the pipeline thread and the status thread, one at a time so that an older status never replaces a newer one
+		self.status_lock = threading.Lock()
+		self.stop_event = threading.Event()
+		self.status_thread = None
+		
+		if self.status_file:
+			self.status_thread = threading.Thread(target = self.update_status, name = 'RunStatus', daemon = True)
+			self.status_thread.start()
+	
+	def set_plan(self, stages, items):
+		'''Set the stages of the run in order, and the number of items expected for each stage, to estimate the time to completion'''
+		with self.lock:
+			self.plan = {stage: items for stage in stages}
+	
+	def get_slot_count(self, pool):
+		'''Return the number of workers of a pool of the executor'''
+		if self.executor is None or pool is None:
+			return 1
+		elif pool == 'process':
+			return self.executor.process_count
+		else:
+			return self.executor.thread_count
+	
+	@contextmanager
+	def stage(self, name, pool = None, total = None):
+		'''Context manager to measure a stage, pool is "process" or "thread" if the tasks of the stage are submitted to the executor under that name, or None if the stage runs in the pipeline process
+		total is the number of items of the stage, for the status of the run
+		The metrics of the stage are yielded, so that the number of items of a stage that runs in the pipeline process can be set'''
+		
+		stage_stats = self.executor.get_stage_stats(name) if self.executor is not None and pool is not None else None
+		start = datetime.utcnow()
+		start_time = time.perf_counter()
+		start_cpu_time = time.process_time()
+		
+		metrics = {'pool': pool, 'items': 0, 'failed': 0}
+		
+		with self.lock:
+			self.current_stage = {'name': name, 'pool': pool, 'total': total if total is not None else self.plan.get(name, 0), 'start_time': start_time, 'stats': stage_stats}
+		self.write_status()
+		
+		try:
+			yield metrics
+		except BaseException:
+			self.state = 'failed'
+			raise
+		finally:
+			wall_time = time.perf_counter() - start_time
+			memory, peak_memory = get_memory_usage()
+			slot_count = self.get_slot_count(pool)
+			
+			metrics.update({
+				'start': start,
+				'end': datetime.utcnow(),
+				'wall_time': wall_time,
+				'workers': slot_count,
+				'parent_cpu_time': time.process_time() - start_cpu_time,
+				'parent_memory': memory,
+				'parent_peak_memory': peak_memory,
+			})
+			
+			if stage_stats is None:
+				# The stage ran in the pipeline process, that is busy all the time of the stage
+				metrics.update({'busy_time': wall_time, 'idle_time': 0., 'queue_wait': 0., 'max_task_time': wall_time})
+			else:
+				# The workers are idle when they are not running a task of the stage, e.g. while waiting for the pipeline process to submit tasks
+				end_stats = self.executor.get_stage_stats(name)
+				busy_time = end_stats['busy_time'] - stage_stats['busy_time']
+				metrics.update({
+					'items': end_stats['done'] - stage_stats['done'] + end_stats['failed'] - stage_stats['failed'],
+					'failed': end_stats['failed'] - stage_stats['failed'],
+					'busy_time': busy_time,
+					'idle_time': max(slot_count * wall_time - busy_time, 0.),
+					'queue_wait': end_stats['queue_wait'] - stage_stats['queue_wait'],
+					'max_task_time': end_stats['max_task_time'],
+				})
+			
+			metrics['utilisation'] = min(metrics['busy_time'] / (slot_count * wall_time), 1.) if wall_time else 0.
+			metrics['throughput_per_hour'] = metrics['items'] / wall_time * 3600 if wall_time else 0.
+			
+			with self.lock:
+				self.stages[name] = metrics
+				self.current_stage = None
+			self.write()
+			self.write_status()
+	
+	def to_dict(self):
+		'''Return the run report as a dict'''
+		memory, peak_memory = get_memory_usage()
+		wall_time = time.perf_counter() - self.start_time
+		return {
+			'run': self.run,
+			'start': self.start,
+			'end': datetime.utcnow(),
+			'wall_time': wall_time,
+			'maps': self.maps,
+			'throughput_per_hour': self.maps / wall_time * 3600 if wall_time else 0.,
+			'parent_peak_memory': peak_memory,
+			'stages': self.stages,
+		}
+	
+	def write_json(self, filepath):
+		'''Write the run report to a JSON file, so that the estimated time of arrival of the next run or a monitor never reads a partial report'''
+		write_json_atomically(self.to_dict(), filepath)
+	
+	def write_prometheus(self, filepath):
+		'''Write the run report to a file in the Prometheus text format, e.g. for the textfile collector of the node exporter'''
+		report = self.to_dict()
+		
+		lines = list()
+		for metric, (metric_type, description) in PROMETHEUS_METRICS.items():
+			lines.append('# HELP spoca4tap_stage_%s %s' % (metric, description))
+			lines.append('# TYPE spoca4tap_stage_%s %s' % (metric, metric_type))
+			for name, stage in report['stages'].items():
+				values = {
+					# The dates are in UTC
+					'start_timestamp_seconds': stage['start'].replace(tzinfo = timezone.utc).timestamp(),
+					'end_timestamp_seconds': stage['end'].replace(tzinfo = timezone.utc).timestamp(),
+					'wall_seconds': stage['wall_time'],
+					'items': stage['items'],
+					'failed': stage['failed'],
+					'queue_wait_seconds': stage['queue_wait'],
+					'busy_seconds': stage['busy_time'],
+					'idle_seconds': stage['idle_time'],
+					'utilisation_ratio': stage['utilisation'],
+					'throughput_per_hour': stage['throughput_per_hour'],
+					'parent_cpu_seconds': stage['parent_cpu_time'],
+					'parent_memory_bytes': stage['parent_memory'] or 0,
+				}
+				lines.append('spoca4tap_stage_%s{stage="%s",run="%s"} %s' % (metric, name, report['run'] or '', repr(float(values[metric]))))
+		
+		lines.append('# HELP spoca4tap_run_maps_per_hour Number of maps processed per hour by the run')
+		lines.append('# TYPE spoca4tap_run_maps_per_hour gauge')
+		lines.append('spoca4tap_run_maps_per_hour{run="%s"} %s' % (report['run'] or '', repr(float(report['throughput_per_hour']))))
+		lines.append('# HELP spoca4tap_run_parent_peak_memory_bytes Peak resident memory of the pipeline process')
+		lines.append('# TYPE spoca4tap_run_parent_peak_memory_bytes gauge')
+		lines.append('spoca4tap_run_parent_peak_memory_bytes{run="%s"} %s' % (report['run'] or '', repr(float(report['parent_peak_memory']))))
+		
+		# Write to a temporary file and rename, so that the collector never reads a partial file
+		write_text_atomically('\n'.join(lines) + '\n', filepath)
+	
+	def write(self):
+		'''Write the run report to the JSON and Prometheus files, if they are set'''
+		try:
+			if self.json_file:
+				self.write_json(self.json_file)
+			if self.prometheus_file:
+				self.write_prometheus(self.prometheus_file)
+		except Exception as why:
+			logging.exception('Error while writing run report: %s', why)
+	
+	def get_summary(self):
+		'''Return the lines of the summary of the critical path of the run'''
+		return get_critical_path_summary(self.to_dict())
+	
+	def get_previous_item_time(self, name):
+		'''Return the wall time per item of a stage in the previous run report, or None if unknown'''
+		stage = self.previous_report['stages'].get(name)
+		if stage and stage.get('items'):
+			return stage['wall_time'] / stage['items']
+	
+	def get_current_stage_status(self):
+		'''Return the status of the current stage, and the estimated time to complete it or None if unknown'''
+		current = self.current_stage
+		elapsed = time.perf_counter() - current['start_time']
+		total = current['total'] or 0
+		
+		if current['stats'] is None:
+			# The stage runs in the pipeline process, its items are only known when it ends
+			status = {'state': 'running', 'done': 0, 'running': total, 'failed': 0, 'pending': 0, 'throughput_per_hour': 0.}
+			item_time = self.get_previous_item_time(current['name'])
+			return status, max(item_time * total - elapsed, 0.) if item_time is not None else None
+		
+		stats = self.executor.get_stage_stats(current['name'])
+		done = stats['done'] - current['stats']['done']
+		failed = stats['failed'] - current['stats']['failed']
+		submitted = stats['submitted'] - current['stats']['submitted']
+		
+		# The tasks are submitted up front, so the pending tasks are the ones submitted or still to submit that have not started
+		started = done + failed + stats['running']
+		status = {
+			'state': 'running',
+			'done': done,
+			'running': stats['running'],
+			'failed': failed,
+			'pending': max(max(total, submitted) - started, 0),
+			'throughput_per_hour': (done + failed) / elapsed * 3600 if elapsed else 0.,
+		}
+		
+		# The mean duration of the completed items of the stage, divided among the workers
+		remaining = max(total - done - failed, 0)
+		if done:
+			item_time = (stats['busy_time'] - current['stats']['busy_time']) / done / min(self.get_slot_count(current['pool']), max(remaining, 1))
+		else:
+			item_time = self.get_previous_item_time(current['name'])
+		
+		return status, remaining * item_time if item_time is not None else None
+	
+	def get_status(self):
+		'''Return the status of the run, with the number of done, running, failed and pending items of each stage, and the estimated time to completion'''
+		with self.lock:
+			elapsed = time.perf_counter() - self.start_time
+			stages = dict()
+			eta_seconds, eta_complete = 0., True
+			
+			for name, metrics in self.stages.items():
+				stages[name] = {'state': 'done', 'done': metrics['items'] - metrics['failed'], 'running': 0, 'failed': metrics['failed'], 'pending': 0, 'throughput_per_hour': metrics['throughput_per_hour']}
+			
+			if self.current_stage is not None:
+				stages[self.current_stage['name']], eta = self.get_current_stage_status()
+				if eta is None:
+					eta_complete = False
+				else:
+					eta_seconds += eta
+			
+			for name, items in self.plan.items():
+				if name not in stages:
+					stages[name] = {'state': 'pending', 'done': 0, 'running': 0, 'failed': 0, 'pending': items, 'throughput_per_hour': 0.}
+					item_time = self.get_previous_item_time(name)
+					if item_time is None:
+						eta_complete = False
+					else:
+						eta_seconds += item_time * items
+		
+		return {
+			'run': self.run,
+			'state': self.state,
+			'start': self.start,
+			'updated': datetime.utcnow(),
+			'elapsed': elapsed,
+			'interval': self.status_interval,
+			'current_stage': next((name for name, stage in stages.items() if stage['state'] == 'running'), None),
+			'eta_seconds': eta_seconds if self.state == 'running' else 0.,
+			'eta': (datetime.utcnow() + timedelta(seconds = eta_seconds)) if self.state == 'running' else None,
+			'eta_complete': eta_complete,
+			'stages': stages,
+		}
+	
+	def write_status(self):
+		'''Write the status of the run to the status file, if it is set'''
+		if not self.status_file:
+			return
+		try:
+			with self.status_lock:
+				write_json_atomically(self.get_status(), self.status_file)
+		except Exception as why:
+			logging.exception('Error while writing status file %s: %s', self.status_file, why)
+	
+	def update_status(self):
+		'''Write the status of the run every status interval, until the run is closed'''
+		while not self.stop_event.wait(self.status_interval):
+			self.write_status()
+	
+	def close(self, state = 'done'):
+		'''Stop the updates of the status, and write the final status and run report'''
+		self.state = state
+		self.stop_event.set()
+		if self.status_thread is not None:
+			self.status_thread.join()
+		self.write()
+		self.write_status()
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Show the summary of the critical path of a pipeline run report, or the status of a running pipeline')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	subparsers = parser.add_subparsers(dest = 'command', required = True)
+	
+	summary_parser = subparsers.add_parser('summary', help = 'Show the summary of the critical path of a run report')
+	summary_parser.add_argument('report_file', metavar = 'FILEPATH', help = 'The path to the JSON run report')
+	
+	status_parser = subparsers.add_parser('status', help = 'Show the status of a run, with the progress of each stage and the estimated time to completion')
+	status_parser.add_argument('--config-file', '-c', help = 'Path to the config file of the pipeline, to get the status file from the RUN_REPORT section')
+	status_parser.add_argument('--watch', '-w', type = float, metavar = 'SECONDS', help = 'Show the status again every SECONDS, until the run ends')
+	status_parser.add_argument('status_file', metavar = 'FILEPATH', nargs = '?', help = 'The path to the status file (default is the status_file of the RUN_REPORT section of the config)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	if args.command == 'summary':
+		with open(args.report_file, 'rt') as file:
+			report = json.load(file)
+		
+		for line in get_critical_path_summary(report):
+			print(line)
+	
+	elif args.command == 'status':
+		if args.status_file:
+			status_file = args.status_file
+		elif args.config_file:
+			# Imported here because only the status command needs the config
+			from utils import get_config
+			status_file = get_config(args.config_file).get('RUN_REPORT', 'status_file')
+		else:
+			parser.error('The status file or the config file must be specified')
+		
+		while True:
+			try:
+				with open(status_file, 'rt') as file:
+					status = json.load(file)
+			except FileNotFoundError:
+				logging.error('Status file %s does not exist, the pipeline has not started yet', status_file)
+				sys.exit(1)
+			
+			print('\n'.join(get_status_summary(status)), flush = True)
+			
+			if not args.watch or status['state'] != 'running':
+				break
+			
+			time.sleep(args.watch)
+			print()
@@ -4,7 +4,6 @@ import argparse
 from datetime import datetime
 from glob import glob
 from functools import lru_cache
-from astropy.io import fits
 
 __all__ = ['SdoData']
 
@@ -98,6 +97,8 @@ class SdoData:
 	
 	def get_quality(self, file_path):
 		'''Return the value of the quality keyword in the header of a FITS file'''
+		# Imported here because astropy is slow to import, and the file lookup does not need it
+		from astropy.io import fits
 		with fits.open(file_path) as hdulist:
 			return hdulist[self.hdu_name_or_index].header[self.quality_keyword]
 	
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from pathlib import Path
+
+__all__ = ['StagingCache']
+
+
+class StagingCache:
+	'''Local copies of input files on network storage, prefetched in the background in the order they will be used
+	At most read_ahead files past the last file used are prefetched, and the least recently used files are evicted when the size of the copies is above max_size bytes
+	A file in use by a job is never evicted, so the size can go above max_size if all the files are in use'''
+	
+	def __init__(self, cache_directory, max_size, read_ahead = 8, thread_count = 2):
+		self.cache_directory = Path(cache_directory)
+		self.cache_directory.mkdir(parents = True, exist_ok = True)
+		self.max_size = max_size
+		self.read_ahead = read_ahead
+		
+		self.condition = threading.Condition()
+		
+		# The local copies in least recently used order, with their size
+		self.files = OrderedDict()
+		# The number of jobs using each file
+		self.pins = dict()
+		# The position of each file of the current stage in the order they will be used, and the position of the last file used
+		# The read ahead is counted from the last file used, so that a file never used does not stop the prefetch
+		self.positions = dict()
+		self.used_position = -1
+		# The files being copied, and the files waiting to be prefetched
+		self.copying = set()
+		self.queue = deque()
+		self.queued = set()
+		
+		self.stats = {'hits': 0, 'misses': 0, 'prefetched': 0, 'copied_bytes': 0, 'evictions': 0}
+		self.closed = False
+		
+		self.threads = [threading.Thread(target = self.prefetch_worker, name = 'StagingCache-%s' % i, daemon = True) for i in range(thread_count)]
+		for thread in self.threads:
+			thread.start()
+	
+	def get_local_path(self, filepath):
+		'''Return the path of the local copy of a file, in a directory named after a hash of the path so that files with the same name do not collide'''
+		digest = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()[:16]
+		return self.cache_directory / digest / Path(filepath).name
+	
+	def prefetch(self, filepaths):
+		'''Add files to prefetch, in the order they will be used by the next stage
+		The files of the previous stage not used will not be used anymore, so they are no longer prefetched and can be evicted'''
+		with self.condition:
+			self.queue.clear()
+			self.queued.clear()
+			self.positions.clear()
+			self.used_position = -1
+			for filepath in filepaths:
+				if filepath is None:
+					continue
+				filepath = os.path.abspath(filepath)
+				if filepath in self.positions:
+					continue
+				self.positions[filepath] = len(self.positions)
+				if filepath not in self.files and filepath not in self.copying:
+					self.queue.append(filepath)
+					self.queued.add(filepath)
+			self.condition.notify_all()
+	
+	def prefetch_worker(self):
+		'''Copy the queued files, while they are at most read_ahead files past the last file used'''
+		while True:
+			with self.condition:
+				while not self.closed and (not self.queue or self.positions[self.queue[0]] > self.used_position + self.read_ahead):
+					self.condition.wait()
+				if self.closed:
+					return
+				filepath = self.queue.popleft()
+				self.queued.discard(filepath)
+				self.copying.add(filepath)
+			
+			try:
+				self.copy(filepath)
+			except Exception as why:
+				logging.warning('Could not prefetch file %s: %s', filepath, why)
+				with self.condition:
+					self.copying.discard(filepath)
+					self.condition.notify_all()
+			else:
+				with self.condition:
+					self.stats['prefetched'] += 1
+					self.copying.discard(filepath)
+					self.condition.notify_all()
+	
+	def copy(self, filepath):
+		'''Copy a file to the cache, and evict the least recently used files to stay below the maximum size'''
+		local_path = self.get_local_path(filepath)
+		local_path.parent.mkdir(exist_ok = True)
+		
+		# Copy to a temporary file and rename, so that a job never reads a partial copy
+		temporary_path = local_path.with_name(local_path.name + '.tmp')
+		shutil.copyfile(filepath, temporary_path)
+		os.replace(temporary_path, local_path)
+		size = local_path.stat().st_size
+		
+		with self.condition:
+			self.files[filepath] = size
+			self.stats['copied_bytes'] += size
+			self.evict()
+	
+	def is_ahead(self, filepath):
+		'''Return True if a file will be used after the last file used by the current stage'''
+		return self.positions.get(filepath, -1) > self.used_position
+	
+	def evict(self):
+		'''Remove the least recently used files not in use, until the size of the copies is below the maximum size'''
+		total_size = sum(self.files.values())
+		for filepath in list(self.files):
+			if total_size <= self.max_size:
+				break
+			# The files in use, or prefetched and not yet used, are kept
+			if self.pins.get(filepath) or self.is_ahead(filepath):
+				continue
+			total_size -= self.files.pop(filepath)
+			self.stats['evictions'] += 1
+			try:
+				os.remove(self.get_local_path(filepath))
+				self.get_local_path(filepath).parent.rmdir()
+			except OSError as why:
+				logging.warning('Could not remove cached file %s: %s', self.get_local_path(filepath), why)
+	
+	def get(self, filepath):
+		'''Return the path of the local copy of a file and pin it until it is released, or None if the file was not prefetched'''
+		filepath = os.path.abspath(filepath)
+		
+		with self.condition:
+			if filepath not in self.files and filepath not in self.copying and filepath not in self.queued:
+				return None
+			
+			# A file not yet prefetched is copied now by the job that needs it
+			if filepath in self.queued:
+				self.queue.remove(filepath)
+				self.queued.discard(filepath)
+				self.copying.add(filepath)
+				copy_now = True
+			else:
+				copy_now = False
+			
+			while not copy_now and filepath in self.copying:
+				self.condition.wait()
+		
+		if copy_now:
+			try:
+				self.copy(filepath)
+			except Exception as why:
+				logging.warning('Could not copy file %s to the staging cache: %s', filepath, why)
+			finally:
+				with self.condition:
+					self.copying.discard(filepath)
+					self.condition.notify_all()
+		
+		with self.condition:
+			if filepath not in self.files:
+				# The prefetch failed, the job reads the original file
+				return None
+			
+			if copy_now:
+				self.stats['misses'] += 1
+			else:
+				self.stats['hits'] += 1
+			
+			self.files.move_to_end(filepath)
+			self.pins[filepath] = self.pins.get(filepath, 0) + 1
+			# The jobs run in parallel, so the files are not used exactly in the prefetch order
+			self.used_position = max(self.used_position, self.positions.get(filepath, -1))
+			self.condition.notify_all()
+			return str(self.get_local_path(filepath))
+	
+	def release(self, filepaths):
+		'''Unpin files after a job has used them'''
+		with self.condition:
+			for filepath in filepaths:
+				filepath = os.path.abspath(filepath)
+				self.pins[filepath] -= 1
+				if not self.pins[filepath]:
+					del self.pins[filepath]
+			self.evict()
+	
+	def stage_command(self, command):
+		'''Replace the prefetched files in a command by their local copies, and return the command and the files to release after the command has run'''
+		staged_command = list()
+		staged_files = list()
+		for parameter in command:
+			local_path = self.get(parameter)
+			if local_path is None:
+				staged_command.append(parameter)
+			else:
+				staged_command.append(local_path)
+				staged_files.append(parameter)
+		return staged_command, staged_files
+	
+	def close(self):
+		'''Stop the prefetch and remove the local copies'''
+		with self.condition:
+			self.closed = True
+			self.queue.clear()
+			self.queued.clear()
+			self.condition.notify_all()
+		
+		for thread in self.threads:
+			thread.join()
+		
+		for filepath in list(self.files):
+			local_path = self.get_local_path(filepath)
+			try:
+				os.remove(local_path)
+				local_path.parent.rmdir()
+			except OSError:
+				pass
+		self.files.clear()
+		
+		logging.info('Staging cache: %s hits, %s misses, %s files prefetched, %.1f MB copied, %s evictions', self.stats['hits'], self.stats['misses'], self.stats['prefetched'], self.stats['copied_bytes'] / 2**20, self.stats['evictions'])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import sys
+import time
+import logging
+import argparse
+from datetime import timedelta
+import numpy
+from astropy.io import fits
+
+from synthetic_data import SyntheticCoronalHoles, write_segmentation_map, write_region_map
+from utils import date_from_filename
+
+__all__ = ['PROGRAMS', 'simulate_load']
+
+# The SPoCA programs that can be replaced by the stub, with the file type they write
+PROGRAMS = {
+	'ch_classification': 'class centers file',
+	'ch_attribution': 'segmentation map',
+	'get_ch_map': 'region map',
+	'tracking': 'tracked region maps',
+	'overlay': 'overlay image',
+}
+
+
+def simulate_load(sleep = 0, cpu = 0):
+	'''Wait for sleep seconds, like a program waiting for I/O, and use the CPU for cpu seconds, like a program computing'''
+	if sleep:
+		time.sleep(sleep)
+	
+	start = time.process_time()
+	while time.process_time() - start < cpu:
+		sum(i * i for i in range(10000))
+
+
+def write_class_centers(filepath, images):
+	'''Write a class centers file with 4 classes for each image, in the format of the SPoCA classification program'''
+	channels = ','.join('193' for image in images)
+	centers = ','.join('(%s)' % ','.join('%g' % center for image in images) for center in (25.3, 74.1, 163.8, 402.5))
+	with open(filepath, 'wt') as file:
+		file.write('[%s]\t[%s]\n' % (channels, centers))
+
+
+def write_tracked_maps(maps):
+	'''Update the untracked maps in place like the SPoCA tracking program, the colors and tracking relations of the synthetic maps are already set'''
+	for map in maps:
+		with fits.open(map, mode = 'update') as hdulist:
+			hdulist[0].header['TRACKED'] = True
+
+
+def write_overlay_image(filepath, size):
+	'''Write a gray overlay image'''
+	# Imported here because only the overlay program writes PNG
+	from overlay_image import write_image
+	write_image(filepath, numpy.full((size, size, 3), 128, dtype = numpy.uint8))
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Stub of the SPoCA programs that simulates their load and writes small valid synthetic outputs, to benchmark the pipeline without the SPoCA programs')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'ERROR', help='Set the logging level (default is ERROR)')
+	parser.add_argument('--stub-sleep', type = float, default = 0, help = 'Number of seconds to wait (default is 0)')
+	parser.add_argument('--stub-cpu', type = float, default = 0, help = 'Number of seconds of CPU to use (default is 0)')
+	parser.add_argument('--stub-size', type = int, default = 256, help = 'Size in pixels of the maps and images written (default is 256)')
+	parser.add_argument('--stub-regions', type = int, default = 10, help = 'Mean number of regions on a map (default is 10)')
+	parser.add_argument('--stub-lifespan', type = float, default = 5, help = 'Mean lifespan of the regions in days (default is 5)')
+	parser.add_argument('--stub-interval', type = int, default = 6, help = 'Number of hours between two maps, for the tracking relations (default is 6)')
+	parser.add_argument('--stub-seed', type = int, default = 0, help = 'Seed of the synthetic regions (default is 0)')
+	parser.add_argument('--config', help = 'The config file of the SPoCA program (ignored)')
+	parser.add_argument('--centersFile', help = 'The class centers file')
+	parser.add_argument('--output', help = 'The output file')
+	parser.add_argument('program', choices = PROGRAMS.keys(), help = 'The SPoCA program to simulate')
+	parser.add_argument('files', metavar = 'FILEPATH', nargs = '*', help = 'The input files of the SPoCA program')
+	
+	# The options of the SPoCA programs can be after the program name and before the files
+	args = parser.parse_intermixed_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	simulate_load(args.stub_sleep, args.stub_cpu)
+	
+	coronal_holes = SyntheticCoronalHoles(seed = args.stub_seed, regions_per_map = args.stub_regions, mean_lifespan = timedelta(days = args.stub_lifespan))
+	cadence = timedelta(hours = args.stub_interval)
+	
+	try:
+		if args.program == 'ch_classification':
+			write_class_centers(args.centersFile, args.files)
+		
+		elif args.program == 'ch_attribution':
+			date = date_from_filename(args.output)
+			write_segmentation_map(args.output, date, coronal_holes.get_holes(date), args.stub_size)
+		
+		elif args.program == 'get_ch_map':
+			date = date_from_filename(args.output)
+			write_region_map(args.output, date, coronal_holes.get_holes(date), coronal_holes.get_holes(date - cadence), cadence, args.stub_size, args.stub_seed)
+		
+		elif args.program == 'tracking':
+			write_tracked_maps(args.files)
+		
+		elif args.program == 'overlay':
+			write_overlay_image(args.output, args.stub_size)
+	
+	except Exception as why:
+		logging.exception('Could not write %s: %s', PROGRAMS[args.program], why)
+		sys.exit(1)
+	
+	logging.info('Wrote %s %s', PROGRAMS[args.program], args.output or ' '.join(args.files))
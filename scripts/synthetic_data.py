@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+import math
+import logging
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+import numpy
+from astropy.io import fits
+
+from utils import date_to_filename
+
+__all__ = ['get_wcs_header', 'SyntheticCoronalHoles', 'write_sdo_image', 'write_segmentation_map', 'write_region_map', 'write_region_maps']
+
+# Solar radius in Mm, and the size of an arcsec on the sun seen from 1 AU in Mm
+SOLAR_RADIUS = 695.7
+ARCSEC = 0.7253
+
+# Mean solar differential rotation at low latitudes in degrees per day
+ROTATION_RATE = 13.2
+
+# Names of the HDUs of the region maps, as written by the SPoCA get_ch_map and tracking programs
+IMAGE_HDU_NAME = 'CoronalHoleMap'
+REGIONS_HDU_NAME = 'Regions'
+REGIONS_STATS_AIA_HDU_NAME = 'AIA_193_CoronalHoleStats'
+REGIONS_STATS_HMI_HDU_NAME = 'HMI_MAGNETOGRAM_CoronalHoleStats'
+TRACKING_HDU_NAME = 'TrackingRelations'
+
+
+def get_wcs_header(date, size = 256):
+	'''Return a FITS header with the WCS and observer keywords of an AIA image of the specified size in pixels taken at date'''
+	
+	# The full resolution AIA image is 4096 pixels of 0.6 arcsec
+	cdelt = 0.6 * 4096 / size
+	
+	header = fits.Header()
+	header['DATE-OBS'] = date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+	header['T_OBS'] = header['DATE-OBS'] + 'Z'
+	header['TELESCOP'] = 'SDO/AIA'
+	header['INSTRUME'] = 'AIA_4'
+	header['WAVELNTH'] = 193
+	header['WAVEUNIT'] = 'angstrom'
+	header['QUALITY'] = 0
+	header['CTYPE1'] = 'HPLN-TAN'
+	header['CTYPE2'] = 'HPLT-TAN'
+	header['CUNIT1'] = 'arcsec'
+	header['CUNIT2'] = 'arcsec'
+	header['CDELT1'] = cdelt
+	header['CDELT2'] = cdelt
+	header['CRPIX1'] = (size + 1) / 2
+	header['CRPIX2'] = (size + 1) / 2
+	header['CRVAL1'] = 0.
+	header['CRVAL2'] = 0.
+	header['CROTA2'] = 0.
+	header['RSUN_REF'] = SOLAR_RADIUS * 1e6
+	header['RSUN_OBS'] = 975.
+	header['DSUN_OBS'] = 1.496e11
+	header['HGLN_OBS'] = 0.
+	header['HGLT_OBS'] = 0.
+	return header
+
+
+class SyntheticCoronalHoles:
+	'''Coronal holes that appear and disappear at random through time, and rotate with the sun
+	The holes born on a given day only depend on the seed and the day, so the holes at any date can be computed without generating the previous dates'''
+	
+	def __init__(self, seed = 0, regions_per_map = 10, mean_lifespan = timedelta(days = 5), max_lifespan = timedelta(days = 27), max_radius = 10):
+		self.seed = seed
+		self.regions_per_map = regions_per_map
+		self.mean_lifespan = mean_lifespan
+		self.max_lifespan = max_lifespan
+		self.max_radius = max_radius
+	
+	def get_births(self, day):
+		'''Return the holes born on a day, as a list of dict'''
+		
+		rng = numpy.random.default_rng([self.seed, day.toordinal()])
+		
+		# On average regions_per_map holes are alive at any time
+		birth_rate = self.regions_per_map / (self.mean_lifespan / timedelta(days = 1))
+		
+		holes = list()
+		for index in range(rng.poisson(birth_rate)):
+			holes.append({
+				# The colors are unique through time, like the colors assigned by the tracking
+				'color': day.toordinal() % 1000000 * 1000 + index + 1,
+				'birth': datetime.combine(day, datetime.min.time()) + timedelta(seconds = rng.uniform(0, 86400)),
+				'lifespan': min(timedelta(days = rng.exponential(self.mean_lifespan / timedelta(days = 1))), self.max_lifespan),
+				'latitude': rng.uniform(-60, 60),
+				'longitude': rng.uniform(-90, 60),
+				'radius': rng.uniform(self.max_radius / 5, self.max_radius),
+			})
+		return holes
+	
+	def get_holes(self, date):
+		'''Return the holes alive at date and on the visible side of the sun, with their longitude at date'''
+		
+		holes = list()
+		day = date.date() - self.max_lifespan - timedelta(days = 1)
+		while day <= date.date():
+			for hole in self.get_births(day):
+				if hole['birth'] <= date < hole['birth'] + hole['lifespan']:
+					longitude = hole['longitude'] + ROTATION_RATE * (date - hole['birth']) / timedelta(days = 1)
+					if longitude < 90 - hole['radius']:
+						holes.append(dict(hole, longitude = longitude))
+			day += timedelta(days = 1)
+		return holes
+
+
+def get_hole_pixels(hole, size):
+	'''Return the pixel coordinates of the center of a hole and its radius in pixels, for an image of size pixels with the WCS of get_wcs_header'''
+	
+	solar_radius = 975. / (0.6 * 4096 / size)
+	latitude, longitude = math.radians(hole['latitude']), math.radians(hole['longitude'])
+	
+	# Orthographic projection of the sun seen from the earth
+	x = (size - 1) / 2 + solar_radius * math.sin(longitude) * math.cos(latitude)
+	y = (size - 1) / 2 + solar_radius * math.sin(latitude)
+	return x, y, max(solar_radius * math.radians(hole['radius']), 1.)
+
+
+def get_hole_box(hole, size):
+	'''Return the slices of the box of pixels that contains a hole, and the pixel coordinates of its center and its radius'''
+	x, y, radius = get_hole_pixels(hole, size)
+	box = (slice(max(math.floor(y - radius), 0), max(math.ceil(y + radius) + 1, 0)), slice(max(math.floor(x - radius), 0), max(math.ceil(x + radius) + 1, 0)))
+	return box, x, y, radius
+
+
+def draw_holes(holes, size):
+	'''Return an image of size pixels where the pixels of each hole have the color of the hole'''
+	
+	image = numpy.zeros((size, size), dtype = numpy.int32)
+	
+	# Only the pixels in the box of each hole are tested, so that many small holes are drawn quickly
+	for hole in holes:
+		box, hole_x, hole_y, radius = get_hole_box(hole, size)
+		y, x = numpy.ogrid[box]
+		image[box][(x - hole_x) ** 2 + (y - hole_y) ** 2 <= radius ** 2] = hole['color']
+	
+	return image
+
+
+def get_first_date(hole, date, cadence):
+	'''Return the first date of the hole among the dates every cadence before date'''
+	return date - (date - hole['birth']) // cadence * cadence
+
+
+def get_regions_table(holes, image, date, cadence, size):
+	'''Return the Regions table of the holes, as written by the SPoCA get_ch_map and tracking programs'''
+	
+	# Area of a pixel at the center of the disk in Mm²
+	pixel_area = (0.6 * 4096 / size * ARCSEC) ** 2
+	
+	rows = list()
+	for index, hole in enumerate(holes, start = 1):
+		box = get_hole_box(hole, size)[0]
+		y, x = numpy.nonzero(image[box] == hole['color'])
+		if len(x) == 0:
+			continue
+		y, x = y + box[0].start, x + box[1].start
+		area = len(x) * pixel_area
+		foreshortening = max(math.cos(math.radians(hole['longitude'])) * math.cos(math.radians(hole['latitude'])), 0.1)
+		rows.append((index, hole['color'], date.isoformat(), get_first_date(hole, date, cadence).isoformat(), x.min(), y.min(), x.max(), y.max(), x.mean(), y.mean(), area, area * 0.1, area / foreshortening, area / foreshortening * 0.1, len(x)))
+	
+	return fits.BinTableHDU(
+		numpy.array(rows, dtype = [
+			('ID', 'i4'), ('TRACKED_COLOR', 'i4'), ('DATE_OBS', 'S19'), ('FIRST_DATE_OBS', 'S19'),
+			('XBOXMIN', 'i4'), ('YBOXMIN', 'i4'), ('XBOXMAX', 'i4'), ('YBOXMAX', 'i4'), ('XCENTER', 'f8'), ('YCENTER', 'f8'),
+			('AREA_PROJECTED', 'f8'), ('AREA_PROJECTED_UNCERTAINITY', 'f8'), ('AREA_DEPROJECTED', 'f8'), ('AREA_DEPROJECTED_UNCERTAINITY', 'f8'), ('NUMBER_PIXELS', 'i4')
+		]),
+		name = REGIONS_HDU_NAME
+	)
+
+
+def get_regions_stats_table(regions, date, name, rng, scale):
+	'''Return a table of random intensity statistics for each region, as written by the SPoCA get_ch_map program'''
+	
+	count = len(regions.data)
+	mean = rng.uniform(0.2, 0.6, count) * scale
+	rows = numpy.rec.fromarrays(
+		[regions.data['ID'], regions.data['NUMBER_PIXELS'], mean * 0.2, mean * 3, mean, mean * 0.9, (mean * 0.3) ** 2, rng.normal(1, 0.3, count), rng.normal(4, 1, count), mean * 0.7, mean * 1.2],
+		names = ['ID', 'NUMBER_GOOD_PIXELS', 'MIN_INTENSITY', 'MAX_INTENSITY', 'MEAN_INTENSITY', 'MEDIAN_INTENSITY', 'VARIANCE', 'SKEWNESS', 'KURTOSIS', 'LOWERQUARTILE_INTENSITY', 'UPPERQUARTILE_INTENSITY']
+	)
+	hdu = fits.BinTableHDU(rows, name = name)
+	hdu.header['DATE-OBS'] = date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+	return hdu
+
+
+def get_tracking_relations_table(holes, past_holes, image, past_image, date, cadence):
+	'''Return the TrackingRelations table between the holes at date and the holes one cadence before, as written by the SPoCA tracking program'''
+	
+	past_colors = {hole['color'] for hole in past_holes}
+	past_date = date - cadence
+	
+	rows = list()
+	for hole in holes:
+		if hole['color'] in past_colors:
+			box = get_hole_box(hole, image.shape[0])[0]
+			overlap = int(numpy.count_nonzero((image[box] == hole['color']) & (past_image[box] == hole['color'])))
+			rows.append((hole['color'], hole['color'], past_date.isoformat(), date.isoformat(), float(overlap), overlap))
+	
+	return fits.BinTableHDU(
+		numpy.array(rows, dtype = [('PAST_COLOR', 'i4'), ('PRESENT_COLOR', 'i4'), ('PAST_DATE_OBS', 'S19'), ('PRESENT_DATE_OBS', 'S19'), ('OVERLAP_AREA_PROJECTED', 'f8'), ('OVERLAP_NUMBER_PIXELS', 'i4')]),
+		name = TRACKING_HDU_NAME
+	)
+
+
+def write_sdo_image(filepath, date, instrument = 'AIA', size = 256, seed = 0):
+	'''Write a small SDO FITS file with random data, tile compressed in the second HDU for AIA, or in the primary HDU for HMI'''
+	
+	rng = numpy.random.default_rng([seed, int(date.timestamp())])
+	header = get_wcs_header(date, size)
+	
+	if instrument == 'AIA':
+		data = rng.gamma(2, 50, (size, size)).astype(numpy.float32)
+		hdulist = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header)])
+	else:
+		header['TELESCOP'] = 'SDO/HMI'
+		header['INSTRUME'] = 'HMI_FRONT2'
+		del header['WAVELNTH']
+		data = rng.normal(0, 20, (size, size)).astype(numpy.float32)
+		hdulist = fits.HDUList([fits.PrimaryHDU(data, header)])
+	
+	hdulist.writeto(filepath, overwrite = True)
+	return filepath
+
+
+def write_segmentation_map(filepath, date, holes, size = 256):
+	'''Write a segmentation map where the pixels of the holes are in the class 1 and the other pixels of the disk in the class 2'''
+	
+	y, x = numpy.mgrid[0:size, 0:size]
+	solar_radius = 975. / (0.6 * 4096 / size)
+	on_disk = (x - (size - 1) / 2) ** 2 + (y - (size - 1) / 2) ** 2 <= solar_radius ** 2
+	
+	image = numpy.where(on_disk, 2, 0).astype(numpy.uint8)
+	image[draw_holes(holes, size) != 0] = 1
+	
+	fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(image, get_wcs_header(date, size), name = 'SegmentedMap')]).writeto(filepath, overwrite = True)
+	return filepath
+
+
+def write_region_map(filepath, date, holes, past_holes, cadence, size = 256, seed = 0):
+	'''Write a tracked region map of the holes, with the Regions, the stats and the TrackingRelations tables to the holes one cadence before'''
+	
+	rng = numpy.random.default_rng([seed, int(date.timestamp()), 1])
+	image = draw_holes(holes, size)
+	
+	regions = get_regions_table(holes, image, date, cadence, size)
+	
+	hdulist = fits.HDUList([
+		fits.PrimaryHDU(),
+		fits.CompImageHDU(image, get_wcs_header(date, size), name = IMAGE_HDU_NAME),
+		regions,
+		get_regions_stats_table(regions, date, REGIONS_STATS_AIA_HDU_NAME, rng, 1000),
+		get_regions_stats_table(regions, date, REGIONS_STATS_HMI_HDU_NAME, rng, 10),
+		get_tracking_relations_table(holes, past_holes, image, draw_holes(past_holes, size), date, cadence),
+	])
+	hdulist.writeto(filepath, overwrite = True)
+	return filepath
+
+
+def write_region_maps(output_directory, start_date, count, cadence, coronal_holes, size = 256, seed = 0):
+	'''Write count tracked region maps of the coronal holes every cadence from start date, and return their paths'''
+	
+	output_directory = Path(output_directory)
+	output_directory.mkdir(parents = True, exist_ok = True)
+	
+	region_maps = list()
+	past_holes = coronal_holes.get_holes(start_date - cadence)
+	for index in range(count):
+		date = start_date + index * cadence
+		holes = coronal_holes.get_holes(date)
+		region_maps.append(write_region_map(output_directory / ('%s.ch_map.fits' % date_to_filename(date)), date, holes, past_holes, cadence, size, seed))
+		past_holes = holes
+	
+	return region_maps
+
+
+# Start point of the script
+if __name__ == '__main__':
+	
+	# Get the arguments
+	parser = argparse.ArgumentParser(description = 'Write synthetic tracked region maps of coronal holes, with a tile compressed CoronalHoleMap with an AIA WCS header, and the Regions, stats and TrackingRelations tables')
+	parser.add_argument('--verbose', '-v', choices = ['DEBUG', 'INFO', 'ERROR'], default = 'INFO', help='Set the logging level (default is INFO)')
+	parser.add_argument('--output-directory', '-o', default = '.', help = 'The directory where to write the region maps (default is the current directory)')
+	parser.add_argument('--start-date', '-s', type = datetime.fromisoformat, default = datetime(2012, 1, 1), help = 'Date of the first map (ISO 8601 format, default is 2012-01-01)')
+	parser.add_argument('--count', '-n', type = int, default = 10, help = 'Number of maps (default is 10)')
+	parser.add_argument('--interval', '-i', type = int, default = 6, help = 'Number of hours between two maps (default is 6)')
+	parser.add_argument('--regions', type = int, default = 10, help = 'Mean number of regions on a map (default is 10)')
+	parser.add_argument('--lifespan', type = float, default = 5, help = 'Mean lifespan of the regions in days (default is 5)')
+	parser.add_argument('--max-lifespan', type = float, default = 27, help = 'Maximum lifespan of the regions in days (default is 27)')
+	parser.add_argument('--max-radius', type = float, default = 10, help = 'Maximum radius of the regions in heliographic degrees (default is 10)')
+	parser.add_argument('--size', type = int, default = 256, help = 'Size in pixels of the maps (default is 256)')
+	parser.add_argument('--seed', type = int, default = 0, help = 'Seed of the random generator (default is 0)')
+	
+	args = parser.parse_args()
+	
+	# Setup the logging
+	logging.basicConfig(level = getattr(logging, args.verbose), format = '%(asctime)s %(levelname)-8s: %(message)s')
+	
+	coronal_holes = SyntheticCoronalHoles(
+		seed = args.seed,
+		regions_per_map = args.regions,
+		mean_lifespan = timedelta(days = args.lifespan),
+		max_lifespan = timedelta(days = args.max_lifespan),
+		max_radius = args.max_radius
+	)
+	
+	region_maps = write_region_maps(args.output_directory, args.start_date, args.count, timedelta(hours = args.interval), coronal_holes, args.size, args.seed)
+	
+	logging.info('Wrote %s region maps to %s', len(region_maps), args.output_directory)
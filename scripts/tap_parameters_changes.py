@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import json
+import logging
+import hashlib
+from pathlib import Path
+
+from utils import date_to_filename, write_tap_parameters_to_csv
+
+__all__ = ['PublishedState', 'get_tap_parameters_changes', 'write_tap_parameters_changes']
+
+# The columns that uniquely identify a record in each TAP table
+TABLE_KEY_COLUMNS = {
+	'epn_core': ['granule_uid'],
+	'tracking': ['previous', 'next'],
+	'datalink': ['granule_uid'],
+}
+
+# The columns that change each time a map file is rewritten, even if its content is identical
+# They are not taken into account to decide if a record has changed
+VOLATILE_COLUMNS = {'creation_date', 'release_date', 'modification_date'}
+
+# The type of changes, in the order they must be applied to the TAP database
+CHANGES = ['delete', 'update', 'insert']
+
+
+class PublishedState:
+	'''Hashes of the TAP parameters records already published, by table, date and record key'''
+	
+	def __init__(self, filepath):
+		self.filepath = Path(filepath)
+		try:
+			with gzip.open(self.filepath, 'rt') as file:
+				self.tables = json.load(file)
+		except FileNotFoundError:
+			logging.info('Published state file %s does not exist yet, all records will be inserted', self.filepath)
+			self.tables = dict()
+	
+	def get(self, table, date):
+		return self.tables.get(table, {}).get(date_to_filename(date), {})
+	
+	def set(self, table, date, record_hashes):
+		self.tables.setdefault(table, {})[date_to_filename(date)] = record_hashes
+	
+	def save(self):
+		'''Write the state to a temporary file and rename it, so that an interrupted run does not corrupt the state'''
+		self.filepath.parent.mkdir(parents = True, exist_ok = True)
+		temporary_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+		with gzip.open(temporary_filepath, 'wt') as file:
+			json.dump(self.tables, file, separators = (',', ':'), sort_keys = True)
+		os.replace(temporary_filepath, self.filepath)
+
+
+def get_record_key(record, key_columns):
+	'''Return the key of a record as a string'''
+	return '\t'.join(str(record[column]) for column in key_columns)
+
+
+def get_record_hash(record):
+	'''Return a short hash of the non volatile values of a record'''
+	values = {column: value for column, value in record.items() if column not in VOLATILE_COLUMNS}
+	return hashlib.sha1(json.dumps(values, sort_keys = True, default = str).encode('utf8')).hexdigest()[:16]
+
+
+def get_tap_parameters_changes(records, published_record_hashes, key_columns):
+	'''Compare the records of a date to the hashes of the published ones, and return the changes and the new record hashes'''
+	
+	changes = {change: list() for change in CHANGES}
+	record_hashes = dict()
+	
+	for record in records:
+		key = get_record_key(record, key_columns)
+		record_hashes[key] = get_record_hash(record)
+		
+		if key not in published_record_hashes:
+			changes['insert'].append(record)
+		elif published_record_hashes[key] != record_hashes[key]:
+			changes['update'].append(record)
+	
+	for key in published_record_hashes.keys() - record_hashes.keys():
+		changes['delete'].append(dict(zip(key_columns, key.split('\t'))))
+	
+	return changes, record_hashes
+
+
+def write_tap_parameters_changes(tap_parameters, table, state, output_file_pattern, run):
+	'''Write the insert, update and delete change sets of the TAP parameters of a table compared to the published state'''
+	
+	key_columns = TABLE_KEY_COLUMNS[table]
+	changes = {change: list() for change in CHANGES}
+	new_state = dict()
+	
+	for date, records in sorted(tap_parameters.items()):
+		date_changes, new_state[date] = get_tap_parameters_changes(records, state.get(table, date), key_columns)
+		for change, change_records in date_changes.items():
+			changes[change].extend(change_records)
+	
+	output_files = dict()
+	
+	for change, change_records in changes.items():
+		if change_records:
+			output_files[change] = output_file_pattern.format(run = run, table = table, change = change)
+			write_tap_parameters_to_csv(change_records, output_files[change])
+			logging.info('Wrote %s %s changes for table %s to CSV file %s', len(change_records), change, table, output_files[change])
+		else:
+			logging.info('No %s changes for table %s', change, table)
+	
+	# Only update the state once the change sets have been written
+	for date, record_hashes in new_state.items():
+		state.set(table, date, record_hashes)
+	
+	return output_files
+
@@ -1,17 +1,26 @@
 #!/usr/bin/env python3
+import os
 import re
+import sys
+import math
+import time
+import random
+import hashlib
 import inspect
+import cProfile
+import threading
+import logging
+import tracemalloc
+import csv
 import json
 import configparser
 from datetime import datetime
-import git
-from pandas import DataFrame, Timedelta
 from pathlib import Path
 from urllib.parse import urljoin
 from functools import wraps
 
 
-__all__ = ['date_range', 'get_config', 'date_to_filename', 'date_from_filename', 'get_url', 'get_commit_version', 'write_tap_parameters_to_csv', 'save_activity_log']
+__all__ = ['date_range', 'get_config', 'date_to_filename', 'date_from_filename', 'get_url', 'get_thumbnail_files', 'get_commit_version', 'get_commit_info', 'get_file_checksum', 'write_tap_parameters_to_csv', 'get_file_paths', 'write_activity_log', 'save_activity_log', 'append_benchmark_results', 'check_benchmark_threshold']
 
 def date_range(start, end, step):
 	'''Equivalent to range for date'''
@@ -26,11 +35,17 @@ def date_range(start, end, step):
 def getintlist(value):
 	return [int(i) for i in value.split(',')]
 
+# ConfigParser converter for time durations (e.g. "3 days")
+# pandas is imported only when the value is parsed, because it is slow to import
+def gettimedelta(value):
+	from pandas import Timedelta
+	return Timedelta(value)
+
 def get_config(config_file):
 	'''Parse a ini config file'''
 	config = configparser.ConfigParser(converters = {
 		'intlist': getintlist,
-		'timedelta': Timedelta,
+		'timedelta': gettimedelta,
 	})
 	config.read(config_file)
 	return config
@@ -55,52 +70,208 @@ def get_url(filepath, base_url, base_dir = None):
 	relative_path = path.relative_to(base_dir or path.parent)
 	return urljoin(base_url, str(relative_path))
 
+def get_thumbnail_files(overlay_image, config):
+	'''Return the paths of the thumbnails of an overlay image for each size of the GET_OVERLAY_IMAGE config, next to the overlay image'''
+	if overlay_image is None or not config.get('thumbnail_sizes', ''):
+		return dict()
+	overlay_image = Path(overlay_image)
+	extension = config.get('thumbnail_format', 'png')
+	return {size: overlay_image.with_name('%s.%s.%s' % (overlay_image.stem, size, extension)) for size in config.getintlist('thumbnail_sizes')}
+
+def get_repository_root(path):
+	'''Return the root directory of the git repository containing the file specified in path'''
+	path = Path(path).absolute()
+	for directory in [path, *path.parents]:
+		if (directory / '.git').exists():
+			return directory
+	raise ValueError('No git repository found for path %s' % path)
+
+def get_commit_info(path):
+	'''Return the commit version of the file specified in path, and if the repository has uncommitted changes'''
+	root = str(get_repository_root(path))
+	
+	# The HEAD of each repository is resolved only once per process, the cache can be passed to worker processes
+	try:
+		return get_commit_info.cache[root]
+	except KeyError:
+		# Imported here because GitPython is slow to import, and most scripts only need it to write activity logs
+		import git
+		repo = git.Repo(root)
+		commit_info = get_commit_info.cache[root] = {
+			'commit': repo.head.object.hexsha,
+			'dirty': repo.is_dirty(untracked_files = False)
+		}
+		return commit_info
+
+get_commit_info.cache = dict()
+
 def get_commit_version(path):
 	'''Return the commit version of the file specified in path'''
-	repo = git.Repo(path, search_parent_directories=True)
-	return repo.head.object.hexsha
+	return get_commit_info(path)['commit']
+
+def get_file_checksum(filepath, chunk_size = 1024 * 1024):
+	'''Return the SHA256 checksum of the content of a file'''
+	checksum = hashlib.sha256()
+	with open(filepath, 'rb') as file:
+		for chunk in iter(lambda: file.read(chunk_size), b''):
+			checksum.update(chunk)
+	return checksum.hexdigest()
 
 def write_tap_parameters_to_csv(records, filepath):
-	'''Write a CSV file with the records'''
+	'''Write a CSV file with the records, the missing, None and NaN values are written as empty strings like pandas does
+	An empty list of records writes a file with only an empty header line, like pandas does for an empty DataFrame'''
 	Path(filepath).parent.mkdir(exist_ok = True)
-	DataFrame.from_records(records).to_csv(filepath, index = False)
+	
+	# The columns are the keys of all the records, in the order of first appearance
+	fieldnames = dict()
+	for record in records:
+		fieldnames.update(dict.fromkeys(record))
+	
+	with open(filepath, 'wt', newline = '') as file:
+		writer = csv.DictWriter(file, fieldnames = list(fieldnames), restval = '', lineterminator = '\n')
+		writer.writeheader()
+		writer.writerows({name: '' if value is None or (isinstance(value, float) and math.isnan(value)) else value for name, value in record.items()} for record in records)
+
+def json_encoder(value):
+	'''Convert the values that the json module cannot serialize'''
+	if isinstance(value, configparser.SectionProxy):
+		return dict(value)
+	elif isinstance(value, datetime):
+		return value.isoformat()
+	elif isinstance(value, Path):
+		return str(value)
+	elif isinstance(value, set):
+		return list(value)
+	elif hasattr(value, 'tolist'):
+		# numpy arrays and scalars
+		return value.tolist()
+	else:
+		return value
+
+def get_file_paths(value):
+	'''Return the absolute file paths in a value that is a file path or a list of file paths'''
+	if isinstance(value, (str, Path)):
+		return [os.path.abspath(value)]
+	elif isinstance(value, (list, tuple)):
+		return [os.path.abspath(item) for item in value if isinstance(item, (str, Path))]
+	else:
+		return []
 
-def save_activity_log(get_activity_id):
-	'''Decorator for a function that will record every call to a function and the call arguments to a JSON file to create provenance documentation'''
+def write_activity_log(activity_info, output_directory):
+	'''Write an activity log to a JSON file named after the activity id'''
+	output_directory = Path(output_directory)
+	output_directory.mkdir(exist_ok = True)
+	with open(output_directory / (activity_info['activity_id'] + '.json'), 'wt') as file:
+		json.dump(activity_info, file, indent = 3, default = json_encoder)
+
+def append_benchmark_results(output_file, results):
+	'''Append the results of a benchmark run, with the date and the python version, to the list of runs of a JSON file, to track the performance over time'''
+	try:
+		with open(output_file, 'rt') as file:
+			history = json.load(file)
+	except FileNotFoundError:
+		history = list()
+	
+	history.append({'date': datetime.utcnow().isoformat(), 'python': sys.version, **results})
+	
+	# Write to a temporary file and rename, so that an interrupted run does not lose the previous runs
+	temporary_file = str(output_file) + '.tmp'
+	with open(temporary_file, 'wt') as file:
+		json.dump(history, file, indent = 3)
+	os.replace(temporary_file, output_file)
+
+def check_benchmark_threshold(times, threshold, description):
+	'''Return the names of the times that are larger than the threshold, and log them with the description of the times, e.g. "The import time of scripts"
+	No time is too large if the threshold is None'''
+	if threshold is None:
+		return []
+	
+	too_slow = [name for name, time in times.items() if time > threshold]
+	if too_slow:
+		logging.error('%s %s is larger than %s', description, ', '.join(str(name) for name in too_slow), threshold)
+	return too_slow
+
+def call_profiled(function, *args, **kwargs):
+	'''Call a function under cProfile and tracemalloc, and return its output, the profiler and the peak size of the Python memory allocations in bytes during the call
+	tracemalloc traces the allocations of all the threads of the process, so the peak is only measured if the call is the only thread of the process (e.g. in a worker process), else it is None'''
+	
+	# The allocations made before the call are not counted in the peak
+	trace_memory = threading.active_count() == 1
+	started_tracing = trace_memory and not tracemalloc.is_tracing()
+	if started_tracing:
+		tracemalloc.start()
+	elif trace_memory:
+		tracemalloc.reset_peak()
+	start_memory = tracemalloc.get_traced_memory()[0] if trace_memory else None
 	
-	def json_encoder(value):
-		if isinstance(value, configparser.SectionProxy):
-			return dict(value)
-		elif isinstance(value, datetime):
-			return value.isoformat()
-		elif isinstance(value, Path):
-			return str(value)
-		elif isinstance(value, set):
-			return list(value)
-		else:
-			return value
+	profiler = cProfile.Profile()
+	start = time.perf_counter()
+	profiler.enable()
+	try:
+		function_output = function(*args, **kwargs)
+	finally:
+		profiler.disable()
+		duration = time.perf_counter() - start
+		peak_memory = tracemalloc.get_traced_memory()[1] - start_memory if trace_memory else None
+		if started_tracing:
+			tracemalloc.stop()
+	
+	return function_output, profiler, {'duration': duration, 'peak_memory': peak_memory}
+
+def save_activity_log(get_activity_id, get_activity_files = None):
+	'''Decorator for a function that will record every call to a function and the call arguments to a JSON file to create provenance documentation
+	get_activity_files returns the input and output files of the activity, to index the lineage of the files, by default the output files are the files returned by the function
+	A fraction profile_rate of the calls are profiled, the pstats file and the peak Python allocation are recorded in the activity log'''
 	
 	def decorator(function):
 		
 		@wraps(function)
 		def wrapper(*args, **kwargs):
-			output_directory = Path(save_activity_log.output_directory)
-			output_directory.mkdir(exist_ok = True)
 			
-			function_output = function(*args, **kwargs)
+			# The profilers cannot be nested, so the decorated functions called by a profiled function are not profiled
+			# The flag is per thread, a call profiled in a worker thread does not prevent the calls of the other threads from being profiled
+			if save_activity_log.profile_rate and not getattr(save_activity_log.thread_state, 'profiling', False) and random.random() < save_activity_log.profile_rate:
+				save_activity_log.thread_state.profiling = True
+				try:
+					function_output, profiler, profile_info = call_profiled(function, *args, **kwargs)
+				finally:
+					save_activity_log.thread_state.profiling = False
+			else:
+				function_output, profiler, profile_info = function(*args, **kwargs), None, None
 			
 			function_callargs = inspect.getcallargs(function, *args, **kwargs)
 			activity_id = get_activity_id(function.__name__, function_callargs)
+			commit_info = get_commit_info(inspect.getfile(function))
+			
+			if get_activity_files is None:
+				function_inputs, function_outputs = list(), function_output
+			else:
+				function_inputs, function_outputs = get_activity_files(function_callargs, function_output)
+			
 			activity_info = {
 				'activity_id': activity_id,
 				'function_name': function.__name__,
-				'function_commit': get_commit_version(inspect.getfile(function)),
+				'function_commit': commit_info['commit'],
+				'function_commit_dirty': commit_info['dirty'],
 				'function_callargs': function_callargs,
 				'function_output': function_output,
+				'function_inputs': get_file_paths(function_inputs),
+				'function_outputs': get_file_paths(function_outputs),
 				'function_docstring' : inspect.getdoc(function)
 			}
-			with open(output_directory / (activity_id + '.json'), 'wt') as file:
-				json.dump(activity_info, file, indent = 3, default = json_encoder )
+			
+			if profiler is not None:
+				profile_directory = Path(save_activity_log.profile_directory)
+				profile_directory.mkdir(parents = True, exist_ok = True)
+				profile_info['pstats_file'] = str((profile_directory / (activity_id + '.pstats')).absolute())
+				profiler.dump_stats(profile_info['pstats_file'])
+				activity_info['function_profile'] = profile_info
+			
+			# If no activity store has been setup, the activity log is written to a JSON file in the output directory
+			if save_activity_log.store is None:
+				write_activity_log(activity_info, save_activity_log.output_directory)
+			else:
+				save_activity_log.store.add(activity_info)
 			
 			return function_output
 		
@@ -109,3 +280,7 @@ def save_activity_log(get_activity_id):
 	return decorator
 
 save_activity_log.output_directory = './activity_log'
+save_activity_log.store = None
+save_activity_log.profile_rate = 0
+save_activity_log.profile_directory = './profiles'
+save_activity_log.thread_state = threading.local()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+'''Visual regression check of the python overlay engine against the SPoCA overlay program
+The SPoCA overlay program is taken from the SPOCA_BIN environment variable, or from the DEFAULT section of the config, and the test is skipped if it is not installed'''
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+import pytest
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPOSITORY / 'scripts'))
+
+from synthetic_data import SyntheticCoronalHoles, write_sdo_image, write_region_maps
+from overlay_image import create_overlay_image
+from compare_overlay_images import get_spoca_overlay_image, compare_overlay_images
+from utils import get_config
+
+# The maximum mean absolute difference of the pixel values, and the maximum fraction of pixels that differ by more than the pixel threshold
+MAX_MEAN_DIFFERENCE = 10
+MAX_DIFFERENT_FRACTION = 0.05
+PIXEL_THRESHOLD = 32
+
+
+@pytest.fixture
+def config():
+	config = get_config(REPOSITORY / 'configs' / 'rob_spoca_ch.ini')
+	config['DEFAULT']['SPOCA_BIN'] = os.environ.get('SPOCA_BIN', config['DEFAULT']['SPOCA_BIN'])
+	config['DEFAULT']['SPOCA_CONFIG'] = str(REPOSITORY / 'configs')
+	
+	if not Path(config.get('GET_OVERLAY_IMAGE', 'executable')).is_file():
+		pytest.skip('The SPoCA overlay program %s is not installed' % config.get('GET_OVERLAY_IMAGE', 'executable'))
+	
+	return config['GET_OVERLAY_IMAGE']
+
+
+@pytest.fixture
+def fixture_map(tmp_path):
+	'''Write a synthetic region map and AIA image of the same date'''
+	date = datetime(2020, 1, 1)
+	region_map = write_region_maps(tmp_path, date, 1, timedelta(hours = 1), SyntheticCoronalHoles(seed = 0), size = 512)[0]
+	background_image = tmp_path / 'aia.fits'
+	write_sdo_image(background_image, date, 'AIA', size = 512)
+	return str(region_map), str(background_image)
+
+
+def test_python_overlay_matches_spoca_overlay(config, fixture_map, tmp_path):
+	region_map, background_image = fixture_map
+	
+	spoca_image = get_spoca_overlay_image(region_map, background_image, tmp_path / 'spoca.png', config)
+	python_image = create_overlay_image(region_map, background_image, tmp_path / 'python.png', config)
+	
+	mean_difference, different_fraction, difference = compare_overlay_images(spoca_image, python_image, PIXEL_THRESHOLD)
+	
+	assert mean_difference < MAX_MEAN_DIFFERENCE, 'Mean absolute difference %.2f of the overlay images is above %s' % (mean_difference, MAX_MEAN_DIFFERENCE)
+	assert different_fraction < MAX_DIFFERENT_FRACTION, '%.2f%% of the pixels differ by more than %s' % (different_fraction * 100, PIXEL_THRESHOLD)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+'''Check the ADQL parser and the query engine of the TAP parameters index, and that the invalid queries to the TAP sync endpoint get an HTTP 400 error'''
+import sys
+import threading
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from http.server import ThreadingHTTPServer
+import pytest
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPOSITORY / 'scripts'))
+
+from query_tap_parameters import TapParametersIndex, TapSyncRequestHandler, parse_adql
+from utils import write_tap_parameters_to_csv
+
+
+@pytest.fixture
+def index(tmp_path):
+	'''Write an epn_core TAP parameters CSV file with 3 regions of 2 granule_gid, the area of the last region is missing'''
+	records = list()
+	for number, (granule_gid, area) in enumerate([('spoca_coronalhole_1', 10), ('spoca_coronalhole_1', 20), ('spoca_coronalhole_2', None)]):
+		records.append({
+			'granule_uid': 'spoca_coronalhole_%s_%s' % (granule_gid[-1], number),
+			'granule_gid': granule_gid,
+			'obs_id': "it's AND %s" % number,
+			'time_min': 2455927.5 + number,
+			'time_max': 2455927.75 + number,
+			'c1min': -10. * number,
+			'c1max': -10. * number + 5,
+			'c2min': 0.,
+			'c2max': 5.,
+			'ch_area_pixels': area,
+		})
+	write_tap_parameters_to_csv(records, tmp_path / 'epn_core.csv')
+	return TapParametersIndex([tmp_path / 'epn_core.csv'])
+
+
+@pytest.fixture
+def server_url(index):
+	'''Answer the TAP sync queries on the index in a thread'''
+	TapSyncRequestHandler.index = index
+	server = ThreadingHTTPServer(('localhost', 0), TapSyncRequestHandler)
+	thread = threading.Thread(target = server.serve_forever)
+	thread.start()
+	yield 'http://localhost:%s/tap/sync' % server.server_address[1]
+	server.shutdown()
+	server.server_close()
+	thread.join()
+
+
+def test_parse_adql():
+	columns, table, conditions, limit = parse_adql("SELECT TOP 5 granule_uid, time_min FROM rob_spoca_ch.epn_core WHERE obs_id = 'it''s AND 1' and (ch_area_pixels >= 5)")
+	assert columns == ['granule_uid', 'time_min']
+	assert table == 'rob_spoca_ch.epn_core'
+	assert conditions == [('obs_id', '=', "it's AND 1"), ('ch_area_pixels', '>=', 5.)]
+	assert limit == 5
+
+
+def test_parse_adql_unsupported():
+	with pytest.raises(ValueError):
+		parse_adql('SELECT * FROM epn_core WHERE time_min > 1 OR time_max < 2')
+
+
+def test_query(index):
+	assert index.query([('ch_area_pixels', '>', 5)]).tolist() == [0, 1]
+	assert index.query([('obs_id', '=', "it's AND 1")]).tolist() == [1]
+	assert index.get_rows(index.query([('granule_gid', '=', 'spoca_coronalhole_2')]), ['granule_uid', 'ch_area_pixels']) == [{'granule_uid': 'spoca_coronalhole_2_2', 'ch_area_pixels': None}]
+
+
+def test_query_different_granule_gid(index):
+	assert index.query([('granule_gid', '=', 'spoca_coronalhole_1'), ('granule_gid', '=', 'spoca_coronalhole_2')]).tolist() == []
+
+
+@pytest.mark.parametrize('condition', [('granule_uid', '=', 5.), ('time_min', '>', 'x'), ('ch_area_pixels', '<', 'x')])
+def test_query_wrong_literal_type(index, condition):
+	with pytest.raises(ValueError):
+		index.query([condition])
+
+
+@pytest.mark.parametrize('parameters', [{'REQUEST': 'doQuery'}, {'QUERY': 'SELECT * FROM epn_core WHERE granule_uid = 5'}, {'QUERY': "SELECT * FROM epn_core WHERE time_min > 'x'"}])
+def test_sync_invalid_query(server_url, parameters):
+	with pytest.raises(HTTPError) as error:
+		urlopen(server_url + '?' + urlencode(parameters))
+	assert error.value.code == 400
+
+
+def test_sync_query(server_url):
+	with urlopen(server_url + '?' + urlencode({'QUERY': "SELECT granule_uid FROM epn_core WHERE granule_gid = 'spoca_coronalhole_1'"})) as response:
+		assert response.read().decode('utf8').splitlines() == ['granule_uid', 'spoca_coronalhole_1_0', 'spoca_coronalhole_1_1']